@@ -6,6 +6,9 @@ if [ "$HH" -ne "00" ]
  	 exit
 fi 
 
+# The date being processed, which the stage_spans.py timings are filed by
+export DEP_RUN=$(date --date '16 hours ago' +'%Y-%m-%d')
+
 # Remove any previous run's error files
 find /i/0/error -type f -exec rm {} \;
 
@@ -16,5 +19,17 @@ python proctor_tile_edit.py 0 $(date --date '16 hours ago' +'%Y %m %d')
 cd ../RT
 python enqueue_jobs.py 0 && python env2database.py -s 0 --date $(date --date '16 hours ago' +'%Y-%m-%d') && python spam_twitter.py
 
+# Append tonight's output to the Parquet warehouse, the .wb files are left
+# to a rebuild as these are read in full
+python event_warehouse.py 0 --kind env --date $(date --date '16 hours ago' +'%Y-%m-%d')
+# Merge the week's nightly part files on Sundays
+if [ "$(date +%u)" -eq 7 ]
+ then
+	python event_warehouse.py 0 --kind env --compact
+fi
+
 # Run Wind Erosion!
 python proctor_sweep.py -s 0 --date $(date --date '16 hours ago' +'%Y-%m-%d')
+
+# Compare tonight's stage timings against the trailing 30 nights
+python stage_spans.py --run $DEP_RUN
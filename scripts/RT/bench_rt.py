@@ -0,0 +1,64 @@
+"""Benchmarks of the realtime WEPP job and harvest hot paths.
+
+    python -m pytest bench_rt.py --benchmark-autosave
+
+Each benchmark is run at several data sizes and reports its throughput as
+``extra_info``, see `scripts/run_benchmarks.sh` for tracking these over time.
+The env files come from `synthetic_env.py`.
+"""
+import glob
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import env2database
+import stage_spans
+from env2database import do_huc12, share_precip
+from enqueue_jobs import WeppRun
+from rate_report import report_rate
+from synthetic_env import make_env_tree
+
+HUC12 = "102400130105"
+YEARS = 15
+
+
+@pytest.mark.parametrize("cache", ["cold", "warm"])
+@pytest.mark.parametrize("flowpaths", [10, 50, 200])
+def test_do_huc12(benchmark, tmp_path, monkeypatch, flowpaths, cache):
+    """Harvesting one date from the env files of a HUC12."""
+    envdir = tmp_path / "0" / "env"
+    lengths = make_env_tree(
+        str(envdir), [HUC12], flowpaths, YEARS, np.random.default_rng(0)
+    )
+    monkeypatch.setattr(env2database, "ENV_DIR", str(tmp_path / "%s" / "env"))
+    monkeypatch.setattr(stage_spans, "SPANS_DIR", str(tmp_path / "spans"))
+    dates = [pd.Timestamp("2019-06-01")]
+    npdates = np.array(dates, dtype="datetime64[ns]")
+    precipfn = share_precip(np.ones((1, 1)), str(tmp_path))
+    arg = [0, HUC12, lengths[HUC12], npdates, (precipfn, 0)]
+
+    def _setup():
+        """Remove the env_cache files for a cold start."""
+        if cache == "cold":
+            for fn in glob.glob(f"{tmp_path}/0/envcache/*/*/*.npy"):
+                os.unlink(fn)
+
+    res = benchmark.pedantic(do_huc12, args=(arg,), setup=_setup, rounds=5)
+    assert res[1] is not None
+    report_rate(benchmark, flowpaths, "files")
+
+
+@pytest.mark.parametrize("runs", [100, 1000, 10000])
+def test_make_runfile(benchmark, runs):
+    """Rendering the WEPP runfiles of a night's queue."""
+    wrs = [
+        WeppRun(HUC12, fpath, f"/i/0/cli/095x038/095.{fpath:02d}.cli", 0)
+        for fpath in range(runs)
+    ]
+
+    def _run():
+        return [wr.make_runfile() for wr in wrs]
+
+    benchmark(_run)
+    report_rate(benchmark, runs, "files")
@@ -0,0 +1,92 @@
+"""Aggregate a HUC12's worth of WEPP output by date in a single pass.
+
+The harvesters concatenate the output of all of a HUC12's flowpaths into one
+DataFrame with a `date` column.  Rather than filtering that frame once per
+date of interest, these helpers group it by date once and reindex onto the
+dates wanted, so that dates without any output come back as empty rows.
+"""
+import pandas as pd
+
+# WEPP env variables summarized for results_by_huc12, with the name used
+ENV_VARS = {
+    "precip": "precip",
+    "av_det": "loss",
+    "runoff": "runoff",
+    "delivery": "delivery",
+}
+
+
+def date_index(dates):
+    """Return a DatetimeIndex for the given dates."""
+    return pd.DatetimeIndex(pd.to_datetime(list(dates))).normalize()
+
+
+def filter_dates(df, dates, column="date"):
+    """Return the rows of df on the given dates, ordered by date."""
+    idx = date_index(dates)
+    df = df[df[column].isin(idx)]
+    order = pd.Series(range(len(idx)), index=idx)
+    order = order[~order.index.duplicated()]
+    return df.iloc[order.loc[df[column]].argsort(kind="stable")]
+
+
+def daily_mean(df, dates, varnames, column="date"):
+    """Return the daily mean of varnames, one row per date (NaN when none)."""
+    idx = date_index(dates)
+    return df.groupby(column)[varnames].mean().reindex(idx)
+
+
+def daily_stats(df, dates, slopes, column="date"):
+    """Compute the results_by_huc12 summary for each date.
+
+    The minimum is only computed when every hillslope had an event on that
+    date, otherwise it is zero.  The average considers all `slopes`.
+
+    Args:
+      df (pd.DataFrame): the combined env output of the HUC12.
+      dates (list): the dates of interest.
+      slopes (int): the number of hillslopes in the HUC12.
+
+    Returns:
+      pd.DataFrame with a row per date, `count` of events and the min, avg
+      and max columns.  Dates without events have NaN max values.
+    """
+    idx = date_index(dates)
+    varnames = list(ENV_VARS)
+    grouped = df.groupby(column)[varnames]
+    stats = {
+        "min": grouped.min().reindex(idx),
+        "sum": grouped.sum().reindex(idx),
+        "max": grouped.max().reindex(idx),
+    }
+    count = grouped.size().reindex(idx, fill_value=0)
+    allhits = (count == slopes).values
+    res = pd.DataFrame({"count": count.values}, index=idx)
+    for varname, label in ENV_VARS.items():
+        res[f"min_{label}"] = stats["min"][varname].where(allhits, 0)
+        res[f"avg_{label}"] = stats["sum"][varname].fillna(0) / float(slopes)
+        res[f"max_{label}"] = stats["max"][varname]
+    return res
+
+
+def test_daily_stats():
+    """Test the allhits handling and empty dates."""
+    df = pd.DataFrame(
+        {
+            "date": pd.to_datetime(["2020-01-02", "2020-01-02", "2020-01-03"]),
+            "precip": [10.0, 20.0, 5.0],
+            "av_det": [1.0, 2.0, 3.0],
+            "runoff": [0.0, 1.0, 1.0],
+            "delivery": [0.1, 0.2, 0.3],
+        }
+    )
+    dates = pd.date_range("2020-01-01", "2020-01-03")
+    res = daily_stats(df, dates, 2)
+    assert list(res["count"]) == [0, 2, 1]
+    assert res["min_precip"].iloc[1] == 10
+    assert res["min_precip"].iloc[2] == 0
+    assert res["avg_precip"].iloc[2] == 2.5
+    assert res["avg_precip"].iloc[0] == 0
+    assert pd.isna(res["max_precip"].iloc[0])
+    rows = filter_dates(df, list(reversed(dates)))
+    assert list(rows["precip"]) == [5.0, 10.0, 20.0]
@@ -1,4 +1,9 @@
-"""Place jobs into our DEP queue!"""
+"""Place jobs into our DEP queue!
+
+    # See usage
+    python enqueue_jobs.py -h
+"""
+import argparse
 import sys
 import os
 import datetime
@@ -7,8 +12,21 @@ from io import StringIO
 
 import pika
 from pyiem.util import get_dbconn, logger
+from job_cost import estimate_cost, load_runtimes
+from run_state import (
+    MAX_LOOKBACK,
+    last_wet_grid,
+    load_state,
+    plan_runs,
+    save_state,
+    update_state,
+)
+from stage_spans import span
+from wepp_pool import BUNDLE_TYPE, make_bundle
 
 YEARS = datetime.date.today().year - 2006
+# Maximum number of runfiles to place in one queue message
+BUNDLE_SIZE = 64
 
 
 class WeppRun:
@@ -45,6 +63,10 @@ class WeppRun:
         """Return the filename used for OFE output"""
         return self._getfn("ofe")
 
+    def get_error_fn(self):
+        """Return the WEPP error filename for this run"""
+        return self._getfn("error")
+
     def get_man_fn(self):
         """Return the management filename for this run"""
         return self._getfn("man")
@@ -122,9 +144,94 @@ class WeppRun:
         return out.read()
 
 
+def job_costs(runs, runtimes):
+    """Return the expected runtime of each WeppRun and how many are modeled.
+
+    The runtime history is used when available, otherwise the cost model.
+    """
+    costs = [runtimes.get((wr.huc12, wr.fpid)) for wr in runs]
+    modeled = 0
+    for i, wr in enumerate(runs):
+        if costs[i] is None:
+            costs[i] = estimate_cost(wr.get_slope_fn(), YEARS)
+            modeled += 1
+    return costs, modeled
+
+
+def make_bundles(runs, costs, size=BUNDLE_SIZE):
+    """Group the WeppRuns by HUC12 into bundles, longest expected first.
+
+    Each HUC12 is split into bundles of at most `size` runs and the bundles
+    are ordered by their total expected runtime, so that the slowest work
+    is started first and does not straggle at the end of the night.
+    """
+    byhuc12 = {}
+    for wr, cost in zip(runs, costs):
+        byhuc12.setdefault(wr.huc12, []).append((cost, wr))
+    bundles = []
+    for jobs in byhuc12.values():
+        jobs.sort(key=lambda x: x[0], reverse=True)
+        for i in range(0, len(jobs), size):
+            chunk = jobs[i : i + size]
+            bundles.append((sum(x[0] for x in chunk), [x[1] for x in chunk]))
+    bundles.sort(key=lambda x: x[0], reverse=True)
+    return [x[1] for x in bundles]
+
+
+def incremental_runs(args, runs, log):
+    """Return the run state, runs needed, their runfiles and inputs."""
+    state = load_state(args.scenario)
+    runfiles = [wr.make_runfile() for wr in runs]
+    if args.full:
+        log.warning("Full run forced, %s jobs", len(runs))
+        return state, runs, runfiles, {}
+    lastwet = last_wet_grid(
+        args.date - datetime.timedelta(days=MAX_LOOKBACK), args.date
+    )
+    needed, reasons, inputs = plan_runs(
+        runs, runfiles, state, args.date, lastwet
+    )
+    log.info(
+        "Incremental run for %s skipped %s of %s jobs, ran due to %s",
+        args.date,
+        reasons.pop("skip"),
+        len(runs),
+        reasons,
+    )
+    runs = [wr for wr, need in zip(runs, needed) if need]
+    runfiles = [rf for rf, need in zip(runfiles, needed) if need]
+    return state, runs, runfiles, inputs
+
+
+def usage():
+    """Create the argparse instance."""
+    parser = argparse.ArgumentParser("Place WEPP jobs into the queue")
+    parser.add_argument("scenario", type=int, help="Scenario to enqueue")
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only run flowpaths impacted by changes since their last run",
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="Run every flowpath, while recording the incremental run state",
+    )
+    parser.add_argument(
+        "--date",
+        type=datetime.date.fromisoformat,
+        default=(
+            datetime.datetime.now() - datetime.timedelta(hours=16)
+        ).date(),
+        help="Date being processed for the incremental run state",
+    )
+    return parser
+
+
 def main(argv):
     """Go main Go."""
-    scenario = int(argv[1])
+    args = usage().parse_args(argv[1:])
+    scenario = args.scenario
     log = logger()
     myhucs = []
     if os.path.isfile("myhucs.txt"):
@@ -147,13 +254,7 @@ def main(argv):
         "where scenario = %s",
         (flscenario,),
     )
-    totaljobs = icursor.rowcount
-    connection = pika.BlockingConnection(
-        pika.ConnectionParameters(host="iem-rabbitmq.local")
-    )
-    channel = connection.channel()
-    channel.queue_declare(queue="dep", durable=True)
-    sts = datetime.datetime.now()
+    runs = []
     for row in icursor:
         if myhucs and row[0] not in myhucs:
             continue
@@ -161,42 +262,90 @@ def main(argv):
         if scenario >= 142:
             # le sigh
             clfile = clfile.replace("/0/", f"/{scenario}/")
-        wr = WeppRun(row[0], row[1], clfile, scenario)
+        runs.append(WeppRun(row[0], row[1], clfile, scenario))
+    incremental = args.incremental or args.full
+    if incremental:
+        state, runs, runfiles, inputs = incremental_runs(args, runs, log)
+    costs, modeled = job_costs(runs, load_runtimes(scenario))
+    bundles = make_bundles(runs, costs)
+    log.info(
+        "Bundled %s jobs into %s messages, %s without runtime history",
+        len(runs),
+        len(bundles),
+        modeled,
+    )
+    totaljobs = len(bundles)
+    connection = pika.BlockingConnection(
+        pika.ConnectionParameters(host="iem-rabbitmq.local")
+    )
+    channel = connection.channel()
+    channel.queue_declare(queue="dep", durable=True)
+    # The workers report each bundle here once all of its runs are done,
+    # as the dep queue's count does not include the bundles being run
+    donequeue = channel.queue_declare(queue="", exclusive=True).method.queue
+    sts = datetime.datetime.now()
+    since = time.time()
+    for bundle in bundles:
         channel.basic_publish(
             exchange="",
             routing_key="dep",
-            body=wr.make_runfile(),
+            body=make_bundle([wr.make_runfile() for wr in bundle]),
             properties=pika.BasicProperties(
-                delivery_mode=2  # make message persistent
+                content_type=BUNDLE_TYPE,
+                delivery_mode=2,  # make message persistent
+                reply_to=donequeue,
             ),
         )
-    # Wait a few seconds for the dust to settle
-    time.sleep(10)
-    percentile = 1.0001
-    while True:
-        now = datetime.datetime.now()
-        cnt = channel.queue_declare(
-            queue="dep", durable=True
-        ).method.message_count
-        done = totaljobs - cnt
-        if (cnt / float(totaljobs)) < percentile:
-            log.info(
-                "%6i/%s [%.3f /s]",
-                cnt,
-                totaljobs,
-                done / (now - sts).total_seconds(),
-            )
-            percentile -= 0.1
-        if (now - sts).total_seconds() > 36000:
-            log.error("ERROR, 10 Hour Job Limit Hit")
-            break
-        if cnt == 0:
-            log.info("%s Done!", now.strftime("%H:%M"))
-            break
-        time.sleep(30)
+    with span("enqueue_jobs.wait") as rec:
+        rec["items"] = len(runs)
+        # Wait a few seconds for the dust to settle
+        time.sleep(10)
+        percentile = 1.0001
+        while totaljobs > 0:
+            now = datetime.datetime.now()
+            done = channel.queue_declare(
+                queue=donequeue, passive=True
+            ).method.message_count
+            cnt = totaljobs - done
+            if (cnt / float(totaljobs)) < percentile:
+                log.info(
+                    "%6i/%s [%.3f /s]",
+                    cnt,
+                    totaljobs,
+                    done / (now - sts).total_seconds(),
+                )
+                percentile -= 0.1
+            if (now - sts).total_seconds() > 36000:
+                log.error("ERROR, 10 Hour Job Limit Hit")
+                break
+            if cnt <= 0:
+                log.info("%s Done!", now.strftime("%H:%M"))
+                break
+            time.sleep(30)
 
     connection.close()
+    if incremental:
+        updated = update_state(state, runs, runfiles, inputs, args.date, since)
+        log.info("Recorded run state of %s/%s jobs", updated, len(runs))
+        save_state(scenario, state)
+
+
+def test_make_bundles():
+    """Test that history wins over the cost model and bundle ordering."""
+    runs = [WeppRun("070600060701", i, None, 0) for i in range(3)]
+    runs.append(WeppRun("070600060702", 1, None, 0))
+    runtimes = {
+        ("070600060701", 0): 1.0,
+        ("070600060701", 2): 90.0,
+        ("070600060702", 1): 200.0,
+    }
+    costs, modeled = job_costs(runs, runtimes)
+    assert modeled == 1
+    bundles = make_bundles(runs, costs, size=2)
+    assert [[wr.fpid for wr in b] for b in bundles] == [[1], [2, 1], [0]]
+    assert bundles[0][0].huc12 == "070600060702"
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    with span("enqueue_jobs"):
+        main(sys.argv)
@@ -6,17 +6,15 @@ from multiprocessing import Pool
 import sys
 
 # third party
-import numpy as np
 import pandas as pd
 from tqdm import tqdm
-import geopandas as gpd
-from rasterstats import zonal_stats
-from affine import Affine
 from pyiem import dep as dep_utils
 from pyiem.util import get_dbconn, logger
+from daily_aggregate import filter_dates
+from env_cache import read_env
+from huc12_precip import load_huc12_precip
 
 LOG = logger()
-PRECIP_AFF = Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
 CONFIG = {"subset": False}
 
 
@@ -37,7 +35,7 @@ def find_huc12s(scenario):
 def readfile(fn, lengths):
     """Our env reader."""
     try:
-        df = dep_utils.read_env(fn)
+        df = read_env(fn)
     except Exception as exp:
         print("\nABORT: Attempting to read: %s resulted in: %s\n" % (fn, exp))
         return None
@@ -96,43 +94,12 @@ def load_precip(dates, huc12s):
       huc12s (list): listing of huc12s of interest, use if CONFIG['subset']
 
     Returns:
-      dict of [date][huc12]
+      dict of [huc12][date index]
     """
-    # 1. Build GeoPandas DataFrame of HUC12s of interest
-    idep = get_dbconn("idep")
-    huc12df = gpd.GeoDataFrame.from_postgis(
-        """
-        SELECT huc_12, ST_Transform(simple_geom, 4326) as geo
-        from huc12 WHERE scenario = 0
-    """,
-        idep,
-        index_col="huc_12",
-        geom_col="geo",
+    huc12s, precip = load_huc12_precip(
+        dates, huc12s if CONFIG["subset"] else None
     )
-    if CONFIG["subset"]:
-        huc12df = huc12df.loc[huc12s]
-    # 2. Loop over dates
-    res = {}
-    for date in tqdm(dates, disable=(not sys.stdout.isatty())):
-        fn = date.strftime("/mnt/idep2/data/dailyprecip/%Y/%Y%m%d.npy")
-        if not os.path.isfile(fn):
-            print("Missing precip: %s" % (fn,))
-            for huc12 in huc12df.index.values:
-                d = res.setdefault(huc12, [])
-                d.append(0)
-            continue
-        pcp = np.flipud(np.load(fn))
-        # nodata here represents the value that is set to missing within the
-        # source dataset!, setting to zero has strange side affects
-        zs = zonal_stats(
-            huc12df["geo"], pcp, affine=PRECIP_AFF, nodata=-1, all_touched=True
-        )
-        i = 0
-        for huc12, _ in huc12df.itertuples():
-            d = res.setdefault(huc12, [])
-            d.append(zs[i]["mean"])
-            i += 1
-    return res
+    return {huc12: list(row) for huc12, row in zip(huc12s, precip)}
 
 
 def load_lengths(scenario):
@@ -164,22 +131,19 @@ def do_huc12(arg):
     # Push all dataframes into one
     df = pd.concat(frames)
     df.fillna(0, inplace=True)
-    res = ""
-    for _, date in enumerate(dates):
-        # df['date'] is datetime64, so need to cast
-        df2 = df[df["date"].dt.date == date]
-        for _, row in df2.iterrows():
-            # hillslope ID, HUC12 ID, precip, runoff, detachment, soil loss
-            res += "%s,%s,%.2f,%.4f,%.4f,%.4f\n" % (
-                row["fpath"],
-                huc12,
-                row["precip"],
-                row["runoff"],
-                row["av_det"],
-                row["delivery"],
-            )
-
-    return res
+    df2 = filter_dates(df, dates)
+    # hillslope ID, HUC12 ID, precip, runoff, detachment, soil loss
+    return "".join(
+        "%s,%s,%.2f,%.4f,%.4f,%.4f\n"
+        % (fpath, huc12, precip, runoff, av_det, delivery)
+        for fpath, precip, runoff, av_det, delivery in zip(
+            df2["fpath"],
+            df2["precip"],
+            df2["runoff"],
+            df2["av_det"],
+            df2["delivery"],
+        )
+    )
 
 
 def main(argv):
@@ -5,29 +5,61 @@ also do any of the following:
 
     # See usage
     python env2database.py -h
+
+Long date ranges, ie ``--date all``, are processed in windows of a calendar
+year at most.  Each window's HUC12 precip is written to a memory mapped
+array that the workers read their row from, and the window's results are
+loaded before moving on, so memory use does not grow with the history.
 """
 import os
 import re
 import argparse
 import datetime
+from io import StringIO
 from multiprocessing import Pool
 import sys
+import tempfile
+import time
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-import geopandas as gpd
-from rasterstats import zonal_stats
-from affine import Affine
 from pyiem import dep as dep_utils
 from pyiem.util import get_dbconn, logger
+from daily_aggregate import daily_stats
+from env_cache import read_env
+from huc12_precip import load_huc12_precip
+from stage_spans import span
 
 LOG = logger()
-PRECIP_AFF = Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
 CONFIG = {"subset": False}
+# The WEPP env output tree, ie ENV_DIR/<huc8>/<huc12[8:]>/<huc12>_<fpath>.env
+ENV_DIR = "/i/%s/env"
+# The memory mapped precip array of the current window, per worker
+PRECIP = {"fn": None, "data": None}
 
 # Maximum precip value allowed, will alert otherwise, see dailyerosion/dep#65
 PRECIP_CEILING = 750.0
+# Number of rows to buffer before each COPY into the database
+CHUNKSIZE = 100000
+RESULT_COLUMNS = [
+    "huc_12",
+    "valid",
+    "scenario",
+    "min_precip",
+    "avg_precip",
+    "max_precip",
+    "min_loss",
+    "avg_loss",
+    "max_loss",
+    "min_runoff",
+    "avg_runoff",
+    "max_runoff",
+    "min_delivery",
+    "avg_delivery",
+    "max_delivery",
+    "qc_precip",
+]
 
 
 def find_huc12s(scenario):
@@ -38,8 +70,9 @@ def find_huc12s(scenario):
         return [s.strip() for s in open("myhucs.txt").readlines()]
 
     res = []
-    for huc8 in os.listdir("/i/%s/env" % (scenario,)):
-        for huc12 in os.listdir("/i/%s/env/%s" % (scenario, huc8)):
+    envdir = ENV_DIR % (scenario,)
+    for huc8 in os.listdir(envdir):
+        for huc12 in os.listdir(f"{envdir}/{huc8}"):
             res.append(huc8 + huc12)
     return res
 
@@ -47,7 +80,7 @@ def find_huc12s(scenario):
 def readfile(fn, lengths):
     """Our env reader."""
     try:
-        df = dep_utils.read_env(fn)
+        df = read_env(fn)
     except Exception as exp:
         LOG.info("ABORT: Attempting to read: %s resulted in: %s", fn, exp)
         return None
@@ -90,31 +123,6 @@ def determine_dates(args):
     return res
 
 
-def compute_res(df, date, slopes, qc_precip):
-    """Compute things"""
-    allhits = slopes == len(df.index)
-    slopes = float(slopes)
-    # NB: code was added to WEPP to output every precipitation/runoff event,
-    # so the average precip here is more accurate than before.
-    return dict(
-        date=date,
-        count=len(df.index),
-        min_precip=(df.precip.min() if allhits else 0),
-        avg_precip=(df.precip.sum() / slopes),
-        max_precip=df.precip.max(),
-        min_loss=(df.av_det.min() if allhits else 0),
-        avg_loss=(df.av_det.sum() / slopes),
-        max_loss=df.av_det.max(),
-        min_runoff=(df.runoff.min() if allhits else 0),
-        avg_runoff=(df.runoff.sum() / slopes),
-        max_runoff=df.runoff.max(),
-        min_delivery=(df.delivery.min() if allhits else 0),
-        avg_delivery=(df.delivery.sum() / slopes),
-        max_delivery=df.delivery.max(),
-        qc_precip=qc_precip,
-    )
-
-
 def load_precip(dates, huc12s):
     """Compute the HUC12 spatially averaged precip
 
@@ -128,48 +136,48 @@ def load_precip(dates, huc12s):
       huc12s (list): listing of huc12s of interest, use if CONFIG['subset']
 
     Returns:
-      dict of [date][huc12]
+      dict of huc12 to row index, (huc12, date) array of precip
     """
-    # 1. Build GeoPandas DataFrame of HUC12s of interest
-    idep = get_dbconn("idep")
-    huc12df = gpd.GeoDataFrame.from_postgis(
-        """
-        SELECT huc_12, ST_Transform(simple_geom, 4326) as geo
-        from huc12 WHERE scenario = 0
-    """,
-        idep,
-        index_col="huc_12",
-        geom_col="geo",
+    huc12s, precip = load_huc12_precip(
+        dates, huc12s if CONFIG["subset"] else None
     )
-    if CONFIG["subset"]:
-        huc12df = huc12df.loc[huc12s]
-    # 2. Loop over dates
-    res = {}
-    progress = tqdm(dates, disable=(not sys.stdout.isatty()))
-    for date in progress:
-        progress.set_description(date.strftime("%Y-%m-%d"))
-        fn = date.strftime("/mnt/idep2/data/dailyprecip/%Y/%Y%m%d.npy")
-        if not os.path.isfile(fn):
-            LOG.info("Missing precip: %s", fn)
-            for huc12 in huc12df.index.values:
-                d = res.setdefault(huc12, [])
-                d.append(0)
-            continue
-        pcp = np.flipud(np.load(fn))
-        # nodata here represents the value that is set to missing within the
-        # source dataset!, setting to zero has strange side affects
-        zs = zonal_stats(
-            huc12df["geo"], pcp, affine=PRECIP_AFF, nodata=-1, all_touched=True
-        )
-        i = 0
-        for huc12, _ in huc12df.itertuples():
-            d = res.setdefault(huc12, [])
-            if zs[i]["mean"] > PRECIP_CEILING:
-                LOG.info("%s precip %.2f > QC, zeroing", huc12, zs[i]["mean"])
-                zs[i]["mean"] = 0.0
-            d.append(zs[i]["mean"])
-            i += 1
-    return res
+    for row, col in zip(*np.nonzero(precip > PRECIP_CEILING)):
+        LOG.info("%s precip %.2f > QC, zeroing", huc12s[row], precip[row, col])
+        precip[row, col] = 0.0
+    return {huc12: i for i, huc12 in enumerate(huc12s)}, precip
+
+
+def share_precip(precip, tmpdir):
+    """Write the precip array to a new file for workers to memory map.
+
+    The filename is unique, so workers know to map the new window's array.
+    """
+    fd, fn = tempfile.mkstemp(suffix=".npy", dir=tmpdir)
+    os.close(fd)
+    arr = np.lib.format.open_memmap(
+        fn, mode="w+", dtype=precip.dtype, shape=precip.shape
+    )
+    arr[:] = precip
+    arr.flush()
+    return fn
+
+
+def get_precip(precipfn, row):
+    """Return the precip row from the window's memory mapped array."""
+    if PRECIP["fn"] != precipfn:
+        PRECIP["data"] = np.load(precipfn, mmap_mode="r")
+        PRECIP["fn"] = precipfn
+    return np.array(PRECIP["data"][row])
+
+
+def date_windows(dates):
+    """Split the dates into lists of the same year, keeping their order."""
+    windows = []
+    for date in dates:
+        if not windows or windows[-1][-1].year != date.year:
+            windows.append([])
+        windows[-1].append(date)
+    return windows
 
 
 def load_lengths(scenario):
@@ -191,74 +199,91 @@ def load_lengths(scenario):
     return res
 
 
-def delete_previous_entries(icursor, scenario, huc12, dates):
-    """Remove whatever previous data we have for this huc12 and dates"""
-    if len(dates) > 366:
-        # Means we are running for 'all'
-        icursor.execute(
-            """
-            DELETE from results_by_huc12 WHERE
-            scenario = %s and huc_12 = %s
-        """,
-            (scenario, huc12),
+class ResultsLoader:
+    """Stream results_by_huc12 rows into the database with COPY.
+
+    Rows are buffered and, once per chunk, copied into a temporary staging
+    table, the previous entries for the chunk's HUC12s are deleted and the
+    staged rows inserted, all within one transaction.
+    """
+
+    def __init__(self, scenario, dates, chunksize=CHUNKSIZE):
+        """Setup the staging table."""
+        self.scenario = scenario
+        self.dates = [pd.Timestamp(date).date() for date in dates]
+        self.chunksize = chunksize
+        self.pgconn = get_dbconn("idep")
+        self.cursor = self.pgconn.cursor()
+        self.cursor.execute(
+            "CREATE TEMP TABLE results_stage ON COMMIT DELETE ROWS AS "
+            f"SELECT {','.join(RESULT_COLUMNS)} from results_by_huc12 "
+            "WITH NO DATA"
         )
-    else:
-        icursor.execute(
-            """
-            DELETE from results_by_huc12 WHERE
-            valid in %s and scenario = %s and huc_12 = %s
-        """,
-            (tuple(dates), scenario, huc12),
+        self.pgconn.commit()
+        self.buffer = StringIO()
+        self.huc12s = []
+        self.rows = 0
+        self.inserts = 0
+        self.deleted = 0
+        self.sts = time.perf_counter()
+
+    def add(self, huc12, df):
+        """Buffer the rows for this huc12, flushing if the chunk is full."""
+        self.huc12s.append(huc12)
+        if not df.empty:
+            df.to_csv(self.buffer, sep="\t", index=False, header=False)
+            self.rows += len(df.index)
+        if self.rows >= self.chunksize or len(self.huc12s) >= 1000:
+            self.flush()
+
+    def flush(self):
+        """Replace the database entries for the buffered huc12s."""
+        if not self.huc12s:
+            return
+        self.buffer.seek(0)
+        self.cursor.copy_from(
+            self.buffer, "results_stage", columns=RESULT_COLUMNS
         )
-    return icursor.rowcount
+        self.cursor.execute(
+            "DELETE from results_by_huc12 WHERE scenario = %s and "
+            "huc_12 = ANY(%s) and valid = ANY(%s)",
+            (self.scenario, self.huc12s, self.dates),
+        )
+        self.deleted += self.cursor.rowcount
+        cols = ",".join(RESULT_COLUMNS)
+        self.cursor.execute(
+            f"INSERT into results_by_huc12 ({cols}) "
+            f"SELECT {cols} from results_stage"
+        )
+        self.inserts += self.cursor.rowcount
+        self.pgconn.commit()
+        self.buffer = StringIO()
+        self.huc12s = []
+        self.rows = 0
+
+    def rate(self):
+        """Return the rows inserted per second."""
+        return self.inserts / max(time.perf_counter() - self.sts, 1e-6)
+
+    def close(self):
+        """Flush what remains and close the connection."""
+        self.flush()
+        self.cursor.close()
+        self.pgconn.close()
 
 
-def save_results(icursor, scenario, huc12, df, dates):
-    """Save our output to the database"""
-    inserts = 0
+def results_frame(scenario, huc12, df, dates):
+    """Return the rows to store and how many dates were skipped."""
     skipped = len(dates) - len(df.index)
-    for _, row in df.iterrows():
-        # test both sides of the coin to see that we can indeed skip dumping
-        # this date to the databse.
-        if row["qc_precip"] < 0.254 and row["count"] == 0:
-            skipped += 1
-            continue
-        inserts += 1
-        icursor.execute(
-            """
-            INSERT into results_by_huc12
-            (huc_12, valid, scenario,
-            min_precip, avg_precip, max_precip,
-            min_loss, avg_loss, max_loss,
-            min_runoff, avg_runoff, max_runoff,
-            min_delivery, avg_delivery, max_delivery,
-            qc_precip) VALUES
-            (%s, %s, %s,
-            coalesce(%s, 0), coalesce(%s, 0), coalesce(%s, 0),
-            coalesce(%s, 0), coalesce(%s, 0), coalesce(%s, 0),
-            coalesce(%s, 0), coalesce(%s, 0), coalesce(%s, 0),
-            coalesce(%s, 0), coalesce(%s, 0), coalesce(%s, 0), %s)
-        """,
-            (
-                huc12,
-                row["date"],
-                scenario,
-                row["min_precip"],
-                row["avg_precip"],
-                row["max_precip"],
-                row["min_loss"],
-                row["avg_loss"],
-                row["max_loss"],
-                row["min_runoff"],
-                row["avg_runoff"],
-                row["max_runoff"],
-                row["min_delivery"],
-                row["avg_delivery"],
-                row["max_delivery"],
-                row["qc_precip"],
-            ),
-        )
-    return inserts, skipped
+    # test both sides of the coin to see that we can indeed skip dumping
+    # this date to the databse.
+    keep = ~((df["qc_precip"] < 0.254) & (df["count"] == 0))
+    skipped += int((~keep).sum())
+    df = df[keep].copy()
+    df["huc_12"] = huc12
+    df["valid"] = pd.to_datetime(df["date"]).dt.strftime("%Y-%m-%d")
+    df["scenario"] = scenario
+    return df[RESULT_COLUMNS], skipped
 
 
 def update_metadata(scenario, dates):
@@ -297,47 +322,37 @@ def update_metadata(scenario, dates):
 
 
 def do_huc12(arg):
-    """Process a huc12's worth of WEPP output files"""
-    scenario, huc12, lengths, dates, precip = arg
-    pgconn = get_dbconn("idep")
-    icursor = pgconn.cursor()
-    basedir = "/i/%s/env/%s/%s" % (scenario, huc12[:8], huc12[8:])
-    frames = [
-        readfile(basedir + "/" + f, lengths) for f in os.listdir(basedir)
-    ]
-    if not frames or any([f is None for f in frames]):
-        return huc12, None, None, None
-    # Push all dataframes into one
-    df = pd.concat(frames)
-    if df.empty:
-        LOG.info("FAIL huc12: %s resulted in empty data frame", huc12)
-        return huc12, None, None, None
-    df.fillna(0, inplace=True)
-    hillslopes = len(frames)
-    rows = []
-    deleted = delete_previous_entries(icursor, scenario, huc12, dates)
-    for i, date in enumerate(dates):
-        # df['date'] is datetime64, so need to cast
-        df2 = df[df["date"] == pd.Timestamp(date)]
-        # We have no data, any previous entries were deleted above already
-        qc_precip = precip[i]
-        if df2.empty and qc_precip == 0:
-            continue
-        # Do computation
-        rows.append(compute_res(df2, date, hillslopes, qc_precip))
-    if not rows:
-        icursor.close()
-        pgconn.commit()
-        return huc12, 0, len(dates), deleted
-    # save results
-    df = pd.DataFrame(rows)
-    # Prevent any NaN values
-    df.fillna(0, inplace=True)
-    inserts, skipped = save_results(icursor, scenario, huc12, df, dates)
-    icursor.close()
-    pgconn.commit()
+    """Process a huc12's worth of WEPP output files
 
-    return huc12, inserts, skipped, deleted
+    Returns:
+      huc12, DataFrame of rows to store (None on error), skipped count
+    """
+    scenario, huc12, lengths, dates, (precipfn, row) = arg
+    with span("env2database", key=huc12) as rec:
+        basedir = f"{ENV_DIR % (scenario,)}/{huc12[:8]}/{huc12[8:]}"
+        frames = [
+            readfile(basedir + "/" + f, lengths) for f in os.listdir(basedir)
+        ]
+        rec["items"] = len(frames)
+        if not frames or any([f is None for f in frames]):
+            return huc12, None, None
+        # Push all dataframes into one
+        df = pd.concat(frames)
+        if df.empty:
+            LOG.info("FAIL huc12: %s resulted in empty data frame", huc12)
+            return huc12, None, None
+        df.fillna(0, inplace=True)
+        # NB: code was added to WEPP to output every precipitation/runoff
+        # event, so the average precip here is more accurate than before.
+        df = daily_stats(df, dates, len(frames))
+        df["date"] = df.index
+        df["qc_precip"] = get_precip(precipfn, row).astype(float)
+        # We have no data, any previous entries get deleted by the loader
+        df = df[(df["count"] > 0) | (df["qc_precip"] != 0)]
+        # Prevent any NaN values
+        df = df.fillna(0)
+        df, skipped = results_frame(scenario, huc12, df, dates)
+        return huc12, df, skipped
 
 
 def usage():
@@ -348,6 +363,45 @@ def usage():
     return parser
 
 
+def process_window(pool, args, lengths, huc12s, dates, tmpdir):
+    """Harvest one window of dates, returns the loader and skipped count."""
+    lookup, precip = load_precip(dates, huc12s)
+    precipfn = share_precip(precip, tmpdir)
+    del precip
+    npdates = np.array(dates, dtype="datetime64[ns]")
+    jobs = []
+    for huc12 in huc12s:
+        if huc12 not in lookup:
+            LOG.info("Skipping huc12 %s with no precip", huc12)
+            continue
+        jobs.append(
+            [
+                args.scenario,
+                huc12,
+                lengths[huc12],
+                npdates,
+                (precipfn, lookup[huc12]),
+            ]
+        )
+    totalskipped = 0
+    loader = ResultsLoader(args.scenario, dates)
+    progress = tqdm(
+        pool.imap_unordered(do_huc12, jobs),
+        total=len(jobs),
+        disable=(not sys.stdout.isatty()),
+    )
+    for huc12, df, skipped in progress:
+        if df is None:
+            LOG.info("ERROR: huc12 %s returned 0 data", huc12)
+            continue
+        totalskipped += skipped
+        loader.add(huc12, df)
+        progress.set_postfix(rows_s=f"{loader.rate():.0f}")
+    loader.close()
+    os.unlink(precipfn)
+    return loader, totalskipped
+
+
 def main(argv):
     """Go Main Go."""
     parser = usage()
@@ -355,53 +409,47 @@ def main(argv):
     lengths = load_lengths(args.scenario)
     dates = determine_dates(args)
     huc12s = find_huc12s(args.scenario)
-    precip = load_precip(dates, huc12s)
-    jobs = []
-    for huc12 in huc12s:
-        if huc12 not in precip:
-            LOG.info("Skipping huc12 %s with no precip", huc12)
-            continue
-        jobs.append(
-            [args.scenario, huc12, lengths[huc12], dates, precip[huc12]]
-        )
 
     # Begin the processing work now!
     # NB: Usage of a ThreadPool here ended in tears (so slow)
-    totalinserts = 0
-    totalskipped = 0
-    totaldeleted = 0
-    with Pool() as pool:
-        for huc12, inserts, skipped, deleted in tqdm(
-            pool.imap_unordered(do_huc12, jobs),
-            total=len(jobs),
-            disable=(not sys.stdout.isatty()),
-        ):
-            if inserts is None:
-                LOG.info("ERROR: huc12 %s returned 0 data", huc12)
-                continue
-            totalinserts += inserts
-            totalskipped += skipped
-            totaldeleted += deleted
-    LOG.info(
-        "env2database.py inserts: %s skips: %s deleted: %s",
-        totalinserts,
-        totalskipped,
-        totaldeleted,
-    )
-    update_metadata(args.scenario, dates)
+    with tempfile.TemporaryDirectory() as tmpdir, Pool() as pool:
+        for window in date_windows(dates):
+            loader, skipped = process_window(
+                pool, args, lengths, huc12s, window, tmpdir
+            )
+            LOG.info(
+                "env2database.py %s-%s inserts: %s skips: %s deleted: %s "
+                "[%.0f rows/s]",
+                window[0].strftime("%Y%m%d"),
+                window[-1].strftime("%Y%m%d"),
+                loader.inserts,
+                skipped,
+                loader.deleted,
+                loader.rate(),
+            )
+            update_metadata(args.scenario, window)
 
 
 if __name__ == "__main__":
-    main(sys.argv)
+    with span("env2database"):
+        main(sys.argv)
 
 
 def test_dohuc12():
     """Can we process a huc12"""
     lengths = load_lengths(0)
     myhuc = "102400130105"
-    res, _, _, _ = do_huc12(
-        [0, myhuc, lengths[myhuc], [datetime.date(2014, 9, 9)], [0]]
-    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        precipfn = share_precip(np.zeros((1, 1)), tmpdir)
+        res, _, _ = do_huc12(
+            [
+                0,
+                myhuc,
+                lengths[myhuc],
+                [datetime.date(2014, 9, 9)],
+                (precipfn, 0),
+            ]
+        )
     assert res == myhuc
 
 
@@ -440,3 +488,35 @@ def test_all_dates():
     dates = determine_dates(args)
     assert len(dates) > 600  # arb
     assert dates[0] == pd.Timestamp("2007/01/01")
+
+
+def test_results_frame():
+    """Test the filtering and formatting of rows to store."""
+    dates = [datetime.date(2019, 12, 3), datetime.date(2019, 12, 4)]
+    df = pd.DataFrame(columns=["date", "precip", "av_det", "runoff"])
+    df = daily_stats(df.assign(delivery=0), dates, 10)
+    df["date"] = df.index
+    df["qc_precip"] = 0.1
+    df.loc[df.index[1], "count"] = 2
+    df = df.fillna(0)
+    df, skipped = results_frame(0, "102400130105", df, dates + dates)
+    assert skipped == 3
+    assert df.iloc[0]["valid"] == "2019-12-04"
+    assert list(df.columns) == RESULT_COLUMNS
+
+
+def test_date_windows():
+    """Test that long date ranges get split by year."""
+    dates = list(pd.date_range("2019/12/30", "2021/01/02"))
+    windows = date_windows(dates)
+    assert [len(w) for w in windows] == [2, 366, 2]
+    assert date_windows(dates[:1]) == [dates[:1]]
+
+
+def test_share_precip(tmp_path):
+    """Test the memory mapped precip handoff."""
+    precip = np.arange(6.0).reshape(2, 3)
+    precipfn = share_precip(precip, str(tmp_path))
+    np.testing.assert_array_equal(get_precip(precipfn, 1), [3, 4, 5])
+    precipfn = share_precip(precip * 2, str(tmp_path))
+    np.testing.assert_array_equal(get_precip(precipfn, 1), [6, 8, 10])
@@ -0,0 +1,128 @@
+"""A cached reader of WEPP .env (event) files.
+
+The first read of an .env file parses the text with `pyiem.dep.read_env` and
+saves the columns as a typed NumPy structured array within a parallel
+``envcache`` directory tree, ie ``/i/0/envcache/07100004/0102/...npy``.  The
+first record of that array holds the modification time and size of the
+.env file it was made from, so later reads of an unchanged .env file are
+a memory map of the cache.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+from pyiem.dep import read_env as read_env_text
+
+ENV_COLUMNS = [
+    "precip",
+    "runoff",
+    "ir_det",
+    "av_det",
+    "mx_det",
+    "point",
+    "av_dep",
+    "max_dep",
+    "point2",
+    "sed_del",
+    "er",
+]
+ENV_DTYPE = np.dtype(
+    [("day", "i2"), ("month", "i2"), ("year", "i2"), ("pad", "i2")]
+    + [(col, "f8") for col in ENV_COLUMNS]
+)
+
+
+def get_cache_fn(envfn):
+    """Return the cache filename for this .env file."""
+    if "/env/" in envfn:
+        return envfn.replace("/env/", "/envcache/", 1) + ".npy"
+    return f"{envfn}.npy"
+
+
+def _stamp(st):
+    """Return the cache key for the given stat result."""
+    return np.array([st.st_mtime_ns, st.st_size], np.int64)
+
+
+def _load_cache(cachefn, stamp):
+    """Return the cached records or None if missing or stale."""
+    try:
+        arr = np.load(cachefn, mmap_mode="r")
+    except (OSError, ValueError):
+        return None
+    if arr.dtype != ENV_DTYPE or arr.shape[0] == 0:
+        return None
+    key = np.frombuffer(arr[:1].tobytes()[:16], np.int64)
+    if not np.array_equal(key, stamp):
+        return None
+    return arr[1:]
+
+
+def _save_cache(cachefn, df, stamp, year0):
+    """Write the records of this dataframe to the cache."""
+    arr = np.zeros(len(df.index) + 1, ENV_DTYPE)
+    arr[:1].view(np.uint8)[:16] = stamp.view(np.uint8)
+    arr["day"][1:] = df["day"].values
+    arr["month"][1:] = df["month"].values
+    arr["year"][1:] = df["year"].values - year0
+    for col in ENV_COLUMNS:
+        arr[col][1:] = df[col].values
+    os.makedirs(os.path.dirname(cachefn), exist_ok=True)
+    tmpfn = f"{cachefn}.{os.getpid()}.tmp"
+    with open(tmpfn, "wb") as fh:
+        np.save(fh, arr)
+    os.rename(tmpfn, cachefn)
+
+
+def to_dataframe(arr, year0=2006):
+    """Return the `pyiem.dep.read_env` style dataframe for these records."""
+    year = arr["year"].astype(np.int64) + year0
+    data = {
+        "day": arr["day"].astype(np.int64),
+        "month": arr["month"].astype(np.int64),
+        "year": year,
+    }
+    for col in ENV_COLUMNS:
+        data[col] = np.array(arr[col])
+    data["date"] = (
+        (year - 1970).astype("M8[Y]").astype("M8[M]")
+        + (data["month"] - 1).astype("m8[M]")
+    ).astype("M8[ns]") + (data["day"] - 1).astype("m8[D]")
+    return pd.DataFrame(data)
+
+
+def read_env(envfn, year0=2006):
+    """Read a WEPP .env file, using and maintaining its cache.
+
+    Returns the same dataframe as `pyiem.dep.read_env`.
+    """
+    stamp = _stamp(os.stat(envfn))
+    cachefn = get_cache_fn(envfn)
+    arr = _load_cache(cachefn, stamp)
+    if arr is not None:
+        return to_dataframe(arr, year0)
+    df = read_env_text(envfn, year0=year0)
+    try:
+        _save_cache(cachefn, df, stamp, year0)
+    except OSError:
+        pass
+    return df
+
+
+def test_read_env(tmp_path):
+    """Test that the cached result matches the text reader."""
+    envfn = tmp_path / "env" / "test.env"
+    envfn.parent.mkdir()
+    envfn.write_text(
+        "header\nheader\nheader\n"
+        "  3   5  13   25.0   1.0  0.1  0.2  0.3  10.0  0.0  0.0  0.0  "
+        "0.5  1.0\n"
+        " 10   6  18   25.0   2.0  0.1  ******  0.3  10.0  0.0  0.0  0.0  "
+        "0.5  1.0\n"
+    )
+    envfn = str(envfn)
+    df = read_env(envfn)
+    assert os.path.isfile(get_cache_fn(envfn))
+    df2 = read_env(envfn)
+    pd.testing.assert_frame_equal(df, df2, check_dtype=False)
+    pd.testing.assert_frame_equal(df, read_env_text(envfn), check_dtype=False)
@@ -0,0 +1,326 @@
+"""Consolidate the WEPP outputs of a scenario into a Parquet warehouse.
+
+The .env, .wb, .ofe and .yld outputs of every flowpath are collected into
+one columnar dataset per scenario and output kind, hive partitioned by HUC8
+and year, ie ``/i/0/warehouse/env/huc8=07100004/year=2023/``.  Each row has
+the `huc12`, `fpath`, `ofe` and `date` of the output, .env rows (which are
+for the whole hillslope) have an `ofe` of 0.
+
+A rebuild (re)writes everything from the output files.  The nightly
+incremental mode adds the rows of one date as a ``part-YYYYMMDD.parquet``
+file within each partition, replacing any prior rows for that date, and the
+compact mode merges those into a single file per partition, which
+REALTIME.sh does weekly.  Only the .env files are read through `env_cache`,
+the other kinds are parsed in full, so the nightly run only appends env.
+As with the incremental run state, edits to the historical portion of the
+climate files are not detected, so a rebuild needs to be done after such
+changes.
+
+    # See usage
+    python event_warehouse.py -h
+"""
+import argparse
+import datetime
+from multiprocessing import Pool
+import os
+import shutil
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pyiem import dep as dep_utils
+from pyiem.util import logger
+from env_cache import read_env
+
+LOG = logger()
+OUTPUT_DIR = "/i/{scenario}/{kind}"
+WAREHOUSE_DIR = "/i/{scenario}/warehouse/{kind}"
+KINDS = ["env", "wb", "ofe", "yld"]
+# Columns that are redundant with the date or partitioning
+DROP_COLUMNS = ["day", "month", "jday", "year", "valid"]
+BASE_PART = "part-base.parquet"
+PARTITIONING = ds.partitioning(
+    pa.schema([("huc8", pa.string()), ("year", pa.int16())]), flavor="hive"
+)
+
+
+def read_output(kind, fn):
+    """Return the normalized dataframe of one WEPP output file."""
+    if kind == "env":
+        df = read_env(fn)
+        df["ofe"] = 0
+    elif kind == "wb":
+        df = dep_utils.read_wb(fn)
+    elif kind == "ofe":
+        df = dep_utils.read_ofe(fn)
+    else:
+        df = dep_utils.read_yld(fn)
+        if not df.empty:
+            df["date"] = pd.to_datetime(df["valid"])
+    if df.empty:
+        return None
+    huc12, fpath = os.path.basename(fn).split(".")[0].split("_")
+    df = df.drop(columns=[c for c in DROP_COLUMNS if c in df.columns])
+    for col in df.columns:
+        if col not in ["date", "ofe", "crop"]:
+            df[col] = df[col].astype("float64")
+    df["date"] = df["date"].astype("datetime64[ns]")
+    df["ofe"] = df["ofe"].astype("int16")
+    df.insert(0, "huc12", huc12)
+    df.insert(1, "fpath", int(fpath))
+    return df
+
+
+def read_huc8(scenario, kind, huc8, sts=None, ets=None):
+    """Return the combined outputs of a HUC8, optionally limited to dates."""
+    mydir = f"{OUTPUT_DIR.format(scenario=scenario, kind=kind)}/{huc8}"
+    frames = []
+    for huc4 in sorted(os.listdir(mydir)):
+        for fn in sorted(os.listdir(f"{mydir}/{huc4}")):
+            if not fn.endswith(f".{kind}"):
+                continue
+            try:
+                df = read_output(kind, f"{mydir}/{huc4}/{fn}")
+            except Exception as exp:
+                LOG.info("Failed to read %s/%s: %s", huc4, fn, exp)
+                continue
+            if df is None:
+                continue
+            if sts is not None:
+                df = df[(df["date"] >= sts) & (df["date"] <= ets)]
+            frames.append(df)
+    if not frames:
+        return None
+    return pd.concat(frames, ignore_index=True)
+
+
+def write_part(df, partdir, partname):
+    """Atomically write a dataframe as a part file of a partition."""
+    os.makedirs(partdir, exist_ok=True)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    tmpfn = f"{partdir}/.{partname}.{os.getpid()}.tmp"
+    pq.write_table(table, tmpfn)
+    os.rename(tmpfn, f"{partdir}/{partname}")
+
+
+def drop_dates(partdir, dates):
+    """Remove rows of these dates from the base part of a partition."""
+    basefn = f"{partdir}/{BASE_PART}"
+    if not os.path.isfile(basefn):
+        return
+    dates = pd.DatetimeIndex(dates)
+    found = pq.read_table(basefn, columns=["date"]).column("date")
+    if not pd.Series(found.to_pandas()).isin(dates).any():
+        return
+    df = pq.read_table(basefn).to_pandas()
+    write_part(df[~df["date"].isin(dates)], partdir, BASE_PART)
+
+
+def rebuild_huc8(job):
+    """Rewrite all partitions of one HUC8, returns the number of rows."""
+    scenario, kind, huc8 = job
+    df = read_huc8(scenario, kind, huc8)
+    root = WAREHOUSE_DIR.format(scenario=scenario, kind=kind)
+    tmpdir = f"{root}/.huc8={huc8}.tmp"
+    shutil.rmtree(tmpdir, ignore_errors=True)
+    if df is not None:
+        for year, gdf in df.groupby(df["date"].dt.year):
+            write_part(gdf, f"{tmpdir}/year={year}", BASE_PART)
+    shutil.rmtree(f"{root}/huc8={huc8}", ignore_errors=True)
+    if os.path.isdir(tmpdir):
+        os.rename(tmpdir, f"{root}/huc8={huc8}")
+    return 0 if df is None else len(df.index)
+
+
+def append_huc8(job):
+    """Write one date's rows of a HUC8 as a part file, returns row count."""
+    scenario, kind, huc8, date = job
+    valid = pd.Timestamp(date)
+    df = read_huc8(scenario, kind, huc8, valid, valid)
+    root = WAREHOUSE_DIR.format(scenario=scenario, kind=kind)
+    partdir = f"{root}/huc8={huc8}/year={date.year}"
+    partname = f"part-{date:%Y%m%d}.parquet"
+    drop_dates(partdir, [valid])
+    if df is None or df.empty:
+        if os.path.isfile(f"{partdir}/{partname}"):
+            os.unlink(f"{partdir}/{partname}")
+        return 0
+    write_part(df, partdir, partname)
+    return len(df.index)
+
+
+def compact_partition(partdir):
+    """Merge the part files of a partition into the base part."""
+    parts = sorted(fn for fn in os.listdir(partdir) if fn.endswith(".parquet"))
+    if parts == [BASE_PART] or not parts:
+        return 0
+    frames = [pq.read_table(f"{partdir}/{fn}").to_pandas() for fn in parts]
+    df = pd.concat(frames, ignore_index=True)
+    df = df.sort_values(["date", "huc12", "fpath", "ofe"], kind="stable")
+    write_part(df, partdir, BASE_PART)
+    for fn in parts:
+        if fn != BASE_PART:
+            os.unlink(f"{partdir}/{fn}")
+    return len(parts)
+
+
+def find_huc8s(scenario, kind):
+    """Return the HUC8s with output of this kind."""
+    mydir = OUTPUT_DIR.format(scenario=scenario, kind=kind)
+    if not os.path.isdir(mydir):
+        return []
+    return sorted(os.listdir(mydir))
+
+
+def open_dataset(scenario, kind):
+    """Return the `pyarrow.dataset.Dataset` of a scenario's output kind."""
+    return ds.dataset(
+        WAREHOUSE_DIR.format(scenario=scenario, kind=kind),
+        format="parquet",
+        partitioning=PARTITIONING,
+        exclude_invalid_files=False,
+        ignore_prefixes=["."],
+    )
+
+
+def load_events(
+    kind, scenarios, columns=None, huc8s=None, sts=None, ets=None, huc12s=None
+):
+    """Load warehouse rows of one or more scenarios into a dataframe.
+
+    The HUC8 and date limits are pushed down to the partitioning and the
+    Parquet row group statistics, so only the needed files are read.
+
+    Args:
+      kind (str): the WEPP output kind, ie ``env``.
+      scenarios (list): the scenarios to load, added as a `scenario` column.
+      columns (list, optional): the columns to load, default is all.
+      huc8s (list, optional): limit to these HUC8s.
+      sts (date, optional): inclusive start date.
+      ets (date, optional): inclusive end date.
+      huc12s (list, optional): limit to these HUC12s.
+    """
+    expr = None
+    filters = []
+    if huc8s is not None:
+        filters.append(ds.field("huc8").isin(list(huc8s)))
+    if huc12s is not None:
+        filters.append(ds.field("huc12").isin(list(huc12s)))
+        if huc8s is None:
+            huc8s = sorted({huc12[:8] for huc12 in huc12s})
+            filters.append(ds.field("huc8").isin(huc8s))
+    if sts is not None:
+        filters.append(ds.field("year") >= sts.year)
+        filters.append(ds.field("date") >= pd.Timestamp(sts))
+    if ets is not None:
+        filters.append(ds.field("year") <= ets.year)
+        filters.append(ds.field("date") <= pd.Timestamp(ets))
+    for item in filters:
+        expr = item if expr is None else expr & item
+    frames = []
+    for scenario in scenarios:
+        table = open_dataset(scenario, kind).to_table(
+            columns=columns, filter=expr
+        )
+        df = table.to_pandas()
+        df.insert(0, "scenario", scenario)
+        frames.append(df)
+    return pd.concat(frames, ignore_index=True)
+
+
+def usage():
+    """Create the argparse instance."""
+    parser = argparse.ArgumentParser("Maintain the Parquet output warehouse")
+    parser.add_argument("scenario", type=int, help="Scenario to process")
+    parser.add_argument(
+        "--kind",
+        action="append",
+        choices=KINDS,
+        help="WEPP output kind to process, can be repeated, default env",
+    )
+    parser.add_argument(
+        "--rebuild",
+        action="store_true",
+        help="Rewrite the warehouse from all of the output files",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Merge the nightly part files into one file per partition",
+    )
+    parser.add_argument(
+        "--date",
+        type=datetime.date.fromisoformat,
+        default=(
+            datetime.datetime.now() - datetime.timedelta(hours=16)
+        ).date(),
+        help="Date to append in the incremental mode",
+    )
+    return parser
+
+
+def main(argv):
+    """Go main Go."""
+    args = usage().parse_args(argv[1:])
+    with Pool() as pool:
+        for kind in args.kind or ["env"]:
+            huc8s = find_huc8s(args.scenario, kind)
+            if args.compact:
+                root = WAREHOUSE_DIR.format(scenario=args.scenario, kind=kind)
+                partdirs = [
+                    os.path.join(dirname, yeardir)
+                    for dirname in (f"{root}/huc8={huc8}" for huc8 in huc8s)
+                    if os.path.isdir(dirname)
+                    for yeardir in os.listdir(dirname)
+                ]
+                merged = sum(pool.imap_unordered(compact_partition, partdirs))
+                LOG.info("%s: merged %s part files", kind, merged)
+                continue
+            if args.rebuild:
+                func = rebuild_huc8
+                jobs = [(args.scenario, kind, huc8) for huc8 in huc8s]
+            else:
+                func = append_huc8
+                jobs = [
+                    (args.scenario, kind, huc8, args.date) for huc8 in huc8s
+                ]
+            rows = sum(pool.imap_unordered(func, jobs))
+            LOG.info("%s: wrote %s rows for %s HUC8s", kind, rows, len(jobs))
+
+
+def test_warehouse(tmp_path, monkeypatch):
+    """Test a rebuild, incremental append and load."""
+    monkeypatch.setattr(
+        "event_warehouse.OUTPUT_DIR", str(tmp_path / "{scenario}/{kind}")
+    )
+    monkeypatch.setattr(
+        "event_warehouse.WAREHOUSE_DIR",
+        str(tmp_path / "{scenario}/warehouse/{kind}"),
+    )
+    mydir = tmp_path / "0" / "env" / "07100004" / "0102"
+    mydir.mkdir(parents=True)
+    envfn = mydir / "071000040102_1.env"
+    header = "header\nheader\nheader\n"
+    envfn.write_text(header + "  3   5  13   25.0   1.0  0.1  0.2\n")
+    assert rebuild_huc8((0, "env", "07100004")) == 1
+    envfn.write_text(
+        header
+        + "  3   5  13   25.0   2.0  0.1  0.2\n"
+        + "  4   5  13   25.0   1.0  0.1  0.2\n"
+    )
+    for _ in range(2):
+        append_huc8((0, "env", "07100004", datetime.date(2019, 5, 3)))
+    df = load_events("env", [0], sts=datetime.date(2019, 5, 3))
+    assert len(df.index) == 1
+    assert df["runoff"].iloc[0] == 2
+    assert df["huc8"].iloc[0] == "07100004"
+    partdir = tmp_path / "0/warehouse/env/huc8=07100004/year=2019"
+    assert compact_partition(str(partdir)) == 2
+    assert compact_partition(str(partdir)) == 0
+    assert len(load_events("env", [0], huc12s=["071000040102"]).index) == 1
+
+
+if __name__ == "__main__":
+    main(sys.argv)
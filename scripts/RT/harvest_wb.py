@@ -8,12 +8,8 @@ import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from pyiem import dep as dep_utils
-from pyiem.util import get_dbconn
-import geopandas as gpd
-from rasterstats import zonal_stats
-from affine import Affine
-
-PRECIP_AFF = Affine(0.01, 0.0, dep_utils.WEST, 0.0, -0.01, dep_utils.NORTH)
+from daily_aggregate import daily_mean
+from huc12_precip import load_huc12_precip
 
 
 def find_huc12s():
@@ -105,37 +101,10 @@ def load_precip():
     Returns:
       dict of [date][huc12]
     """
-    # 1. Build GeoPandas DataFrame of HUC12s of interest
-    idep = get_dbconn("idep")
-    huc12df = gpd.GeoDataFrame.from_postgis(
-        """
-        SELECT huc_12, ST_Transform(simple_geom, 4326) as geo
-        from huc12 WHERE scenario = 0
-    """,
-        idep,
-        index_col="huc_12",
-        geom_col="geo",
-    )
-    # 2. Loop over dates
+    huc12s, precip = load_huc12_precip(DATES)
     myres = {}
-    for mydate in tqdm(DATES, disable=(not sys.stdout.isatty())):
-        myres[mydate] = {}
-        fn = mydate.strftime("/mnt/idep2/data/dailyprecip/%Y/%Y%m%d.npy")
-        if not os.path.isfile(fn):
-            print("Missing precip: %s" % (fn,))
-            for myhuc12 in huc12df.index.values:
-                myres[mydate][myhuc12] = 0
-            continue
-        pcp = np.flipud(np.load(fn))
-        # nodata here represents the value that is set to missing within the
-        # source dataset!, setting to zero has strange side affects
-        zs = zonal_stats(
-            huc12df["geo"], pcp, affine=PRECIP_AFF, nodata=-1, all_touched=True
-        )
-        i = 0
-        for _huc12, _ in huc12df.itertuples():
-            myres[mydate][_huc12] = zs[i]["mean"]
-            i += 1
+    for i, mydate in enumerate(DATES):
+        myres[mydate] = dict(zip(huc12s, precip[:, i]))
     return myres
 
 
@@ -148,11 +117,10 @@ def do_huc12(_huc12):
         return rows
     # Push all dataframes into one
     df = pd.concat(frames)
-    for mydate in DATES:
-        df2 = df[df.date == mydate].mean()
-        rows.append(
-            [mydate, _huc12, df2["ep"] + df2["es"] + df2["er"], df2["runoff"]]
-        )
+    df2 = daily_mean(df, DATES, ["ep", "es", "er", "runoff"])
+    et = df2["ep"] + df2["es"] + df2["er"]
+    for mydate, _et, runoff in zip(DATES, et, df2["runoff"]):
+        rows.append([mydate, _huc12, _et, runoff])
     return rows
 
 
@@ -177,7 +145,7 @@ if __name__ == "__main__":
         total=len(HUC12S),
         disable=(not sys.stdout.isatty()),
     ):
-        for (date, huc12, et, runoff) in res:
+        for date, huc12, et, runoff in res:
             if et is None or np.isnan(et):
                 continue
             key = date.strftime("%Y%m%d")
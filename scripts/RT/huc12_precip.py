@@ -0,0 +1,193 @@
+"""HUC12 spatially averaged precipitation from the daily precip grids.
+
+Rather than having rasterstats rasterize every HUC12 polygon for every date,
+the grid cells touched by each HUC12 (all_touched semantics, same windowing
+as rasterstats) are computed once into a sparse HUC12 x grid cell matrix.
+The daily means are then a pair of sparse matrix products, done for a
+stack of dates at once.  The matrix is cached on disk along with a digest of
+the `huc12` table geometries, so it gets rebuilt when those change.
+"""
+import os
+
+import numpy as np
+from affine import Affine
+from pyiem.dep import EAST, NORTH, SOUTH, WEST
+from pyiem.util import get_dbconn, logger
+from rasterio import features
+from rasterstats.io import bounds_window
+from scipy import sparse
+from shapely import wkb
+
+LOG = logger()
+CACHE_FN = "/mnt/idep2/data/huc12_precip_weights.npz"
+PRECIP_FN = "/mnt/idep2/data/dailyprecip/{date:%Y}/{date:%Y%m%d}.npy"
+PRECIP_AFF = Affine(0.01, 0.0, WEST, 0.0, -0.01, NORTH)
+GRID_SHAPE = (int((NORTH - SOUTH) * 100.0), int((EAST - WEST) * 100.0))
+# Value within the precip grids denoting missing data
+NODATA = -1
+# Number of dates to stack into one matrix product
+BATCH = 32
+HUC12_SQL = (
+    "SELECT huc_12, ST_AsBinary(ST_Transform(simple_geom, 4326)) "
+    "from huc12 WHERE scenario = 0 ORDER by huc_12"
+)
+DIGEST_SQL = (
+    "SELECT md5(string_agg(huc_12 || md5(ST_AsBinary(simple_geom)), ',' "
+    "ORDER by huc_12)) from huc12 WHERE scenario = 0"
+)
+
+
+def touched_cells(geom, affine=PRECIP_AFF, shape=GRID_SHAPE):
+    """Return the flat south-up grid indices that the geometry touches."""
+    (row0, row1), (col0, col1) = bounds_window(geom.bounds, affine)
+    west = affine.c + col0 * affine.a
+    north = affine.f + row0 * affine.e
+    mask = features.rasterize(
+        [(geom, 1)],
+        out_shape=(row1 - row0, col1 - col0),
+        transform=Affine(affine.a, affine.b, west, affine.d, affine.e, north),
+        fill=0,
+        dtype="uint8",
+        all_touched=True,
+    )
+    rows, cols = np.nonzero(mask)
+    rows += row0
+    cols += col0
+    inside = (rows >= 0) & (rows < shape[0]) & (cols >= 0) & (cols < shape[1])
+    # The precip grids are stored south-up
+    return (shape[0] - 1 - rows[inside]) * shape[1] + cols[inside]
+
+
+def build_weights(rows, affine=PRECIP_AFF, shape=GRID_SHAPE):
+    """Return the huc12 list and sparse matrix for (huc12, geometry) rows."""
+    huc12s = []
+    hucidx = []
+    cells = []
+    for i, (huc12, geom) in enumerate(rows):
+        huc12s.append(huc12)
+        touched = touched_cells(geom, affine, shape)
+        hucidx.append(np.full(touched.size, i, np.int32))
+        cells.append(touched)
+    hucidx = np.concatenate(hucidx) if hucidx else np.zeros(0, np.int32)
+    cells = np.concatenate(cells) if cells else np.zeros(0, np.int64)
+    weights = sparse.csr_matrix(
+        (np.ones(cells.size, np.float32), (hucidx, cells)),
+        shape=(len(huc12s), shape[0] * shape[1]),
+    )
+    return huc12s, weights
+
+
+def load_weights(pgconn=None):
+    """Return the huc12 list and weight matrix, rebuilding when stale."""
+    pgconn = get_dbconn("idep") if pgconn is None else pgconn
+    cursor = pgconn.cursor()
+    cursor.execute(DIGEST_SQL)
+    digest = cursor.fetchone()[0]
+    if os.path.isfile(CACHE_FN):
+        with np.load(CACHE_FN) as npz:
+            if str(npz["digest"]) == digest:
+                weights = sparse.csr_matrix(
+                    (npz["data"], npz["indices"], npz["indptr"]),
+                    shape=tuple(npz["shape"]),
+                )
+                return list(npz["huc12s"]), weights
+    LOG.info("Building HUC12 precip weights %s", CACHE_FN)
+    cursor.execute(HUC12_SQL)
+    huc12s, weights = build_weights(
+        (row[0], wkb.loads(bytes(row[1]))) for row in cursor
+    )
+    with open(f"{CACHE_FN}.tmp", "wb") as fh:
+        np.savez(
+            fh,
+            digest=digest,
+            huc12s=np.array(huc12s),
+            data=weights.data,
+            indices=weights.indices,
+            indptr=weights.indptr,
+            shape=np.array(weights.shape),
+        )
+    os.rename(f"{CACHE_FN}.tmp", CACHE_FN)
+    return huc12s, weights
+
+
+def zonal_means(weights, grids):
+    """Return the (huc12, grid) means of a (cells, grids) stack.
+
+    Missing and NaN values are excluded, HUC12s without any valid cells are
+    NaN.
+    """
+    valid = (grids != NODATA) & ~np.isnan(grids)
+    sums = weights @ np.where(valid, grids, 0).astype(np.float64)
+    counts = weights @ valid.astype(np.float32)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def huc12_precip(dates, weights):
+    """Return the (huc12, date) array of mean precip.
+
+    Dates without a precip grid are zero for all HUC12s.
+    """
+    res = np.zeros((weights.shape[0], len(dates)))
+    for start in range(0, len(dates), BATCH):
+        batch = []
+        for i, date in enumerate(dates[start : start + BATCH], start):
+            fn = PRECIP_FN.format(date=date)
+            if not os.path.isfile(fn):
+                LOG.info("Missing precip: %s", fn)
+                continue
+            batch.append((i, np.load(fn).ravel()))
+        if not batch:
+            continue
+        cols = [x[0] for x in batch]
+        res[:, cols] = zonal_means(weights, np.stack([x[1] for x in batch], 1))
+    return res
+
+
+def load_huc12_precip(dates, huc12s=None):
+    """Return the huc12 list and (huc12, date) array of mean precip.
+
+    Args:
+      dates (list): the dates we need precip data for.
+      huc12s (list, optional): limit the result to these HUC12s.
+    """
+    allhucs, weights = load_weights()
+    if huc12s is not None:
+        lookup = {huc12: i for i, huc12 in enumerate(allhucs)}
+        rows = [lookup[huc12] for huc12 in huc12s]
+        allhucs = [allhucs[i] for i in rows]
+        weights = weights[rows]
+    return allhucs, huc12_precip(dates, weights)
+
+
+def test_zonal_means():
+    """Test against rasterstats."""
+    from rasterstats import zonal_stats
+    from shapely.geometry import Polygon
+
+    shape = (40, 50)
+    aff = Affine(0.01, 0.0, WEST, 0.0, -0.01, SOUTH + 0.4)
+    geoms = [
+        Polygon(
+            [
+                (WEST + 0.053, SOUTH + 0.011),
+                (WEST + 0.2, SOUTH + 0.1),
+                (WEST + 0.1, SOUTH + 0.37),
+            ]
+        ),
+        Polygon(
+            [
+                (WEST - 0.05, SOUTH + 0.2),
+                (WEST + 0.03, SOUTH + 0.2),
+                (WEST + 0.03, SOUTH + 0.3),
+            ]
+        ),
+    ]
+    grid = np.arange(shape[0] * shape[1], dtype=float).reshape(shape)
+    grid[20:25, 0:2] = NODATA
+    _, weights = build_weights(enumerate(geoms), aff, shape)
+    res = zonal_means(weights, grid.ravel()[:, None])
+    zs = zonal_stats(
+        geoms, np.flipud(grid), affine=aff, nodata=-1, all_touched=True
+    )
+    np.testing.assert_allclose(res[:, 0], [z["mean"] for z in zs])
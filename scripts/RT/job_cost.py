@@ -0,0 +1,193 @@
+"""Expected WEPP runtime of a flowpath, for ordering the nightly queue.
+
+The queue workers append the walltime of each run to a per-process file
+within a directory of the day, ``/i/<scenario>/runtime/YYYYMMDD/``, which
+`load_runtimes` collects.  Once a day has settled, so that no worker is
+writing to its files anymore, these are compacted into a single
+``history.csv`` of the recent runs and removed.  When a flowpath has no
+history, a rough cost model based on the slope file (number of OFEs and
+slope points) and the number of years simulated is used instead.
+"""
+from contextlib import suppress
+import datetime
+import glob
+import os
+import socket
+
+import pandas as pd
+from pyiem.util import logger
+
+LOG = logger()
+RUNTIME_DIR = "/i/{scenario}/runtime"
+HISTORY_FILE = "history.csv"
+# Number of recent runs to average for the expected runtime
+HISTORY_RUNS = 5
+# Days after which the files of a day are no longer written to
+SETTLE_DAYS = 2
+# Fallback cost model, seconds, roughly fit to observed nightly runs
+COST_BASE = 0.5
+COST_PER_OFE_YEAR = 0.04
+COST_PER_POINT_YEAR = 0.0005
+# Open (day, history file handle) of this process by scenario
+_HISTORY = {}
+
+
+def record_runtime(scenario, huc12, fpath, walltime):
+    """Append the runtime of one WEPP run to this process' history file.
+
+    This is called from the queue worker's pool callbacks, so any failure is
+    only logged.
+    """
+    day = datetime.date.today().strftime("%Y%m%d")
+    try:
+        fhday, fh = _HISTORY.get(scenario, (None, None))
+        if fhday != day:
+            _HISTORY.pop(scenario, None)
+            if fh is not None:
+                with suppress(OSError):
+                    fh.close()
+            mydir = f"{RUNTIME_DIR.format(scenario=scenario)}/{day}"
+            os.makedirs(mydir, exist_ok=True)
+            fn = f"{mydir}/{socket.gethostname()}_{os.getpid()}.csv"
+            fh = open(fn, "a", encoding="ascii", buffering=1)
+            _HISTORY[scenario] = (day, fh)
+        fh.write(f"{huc12},{fpath},{walltime:.3f}\n")
+    except OSError as exp:
+        LOG.warning("Failed to record runtime of %s_%s: %s", huc12, fpath, exp)
+        _HISTORY.pop(scenario, None)
+
+
+def read_runtimes(fn):
+    """Return the dataframe of a runtime history file."""
+    return pd.read_csv(
+        fn,
+        names=["huc12", "fpath", "walltime"],
+        dtype={"huc12": str, "fpath": int, "walltime": float},
+    )
+
+
+def recent_runs(frames):
+    """Return the last `HISTORY_RUNS` rows of each flowpath."""
+    return (
+        pd.concat(frames, ignore_index=True)
+        .groupby(["huc12", "fpath"])
+        .tail(HISTORY_RUNS)
+    )
+
+
+def load_runtimes(scenario):
+    """Return a dict of (huc12, fpath) to expected runtime in seconds.
+
+    The history files are appended to in run order and the day directories
+    are read in order, so the last rows of each flowpath are the most recent
+    ones.  The days older than `SETTLE_DAYS` are compacted into the
+    `HISTORY_FILE`, the files of more recent days may still be open by the
+    queue workers and are only read.
+    """
+    mydir = RUNTIME_DIR.format(scenario=scenario)
+    histfn = f"{mydir}/{HISTORY_FILE}"
+    settled = (
+        datetime.date.today() - datetime.timedelta(days=SETTLE_DAYS)
+    ).strftime("%Y%m%d")
+    days = []
+    if os.path.isdir(mydir):
+        days = sorted(day for day in os.listdir(mydir) if day.isdigit())
+    frames = []
+    if os.path.isfile(histfn):
+        frames.append(read_runtimes(histfn))
+    olddays = [day for day in days if day <= settled]
+    for day in olddays:
+        for fn in sorted(glob.glob(f"{mydir}/{day}/*.csv")):
+            frames.append(read_runtimes(fn))
+    if olddays:
+        df = recent_runs(frames)
+        df.to_csv(
+            f"{histfn}.tmp", header=False, index=False, float_format="%.3f"
+        )
+        os.replace(f"{histfn}.tmp", histfn)
+        for day in olddays:
+            for fn in glob.glob(f"{mydir}/{day}/*.csv"):
+                os.unlink(fn)
+            with suppress(OSError):
+                os.rmdir(f"{mydir}/{day}")
+        frames = [df]
+    for day in days:
+        if day > settled:
+            for fn in sorted(glob.glob(f"{mydir}/{day}/*.csv")):
+                frames.append(read_runtimes(fn))
+    if not frames:
+        return {}
+    return (
+        recent_runs(frames)
+        .groupby(["huc12", "fpath"])["walltime"]
+        .mean()
+        .to_dict()
+    )
+
+
+def read_slope_size(slpfn):
+    """Return the number of OFEs and slope points within this slope file."""
+    with open(slpfn, encoding="ascii") as fh:
+        lines = [line for line in fh if not line.startswith("#")]
+    ofes = int(lines[1].split()[0])
+    points = 0
+    # The aspect and width line is followed by two lines per OFE, the
+    # number of points and length, then the points
+    for ofe in range(ofes):
+        points += int(lines[3 + 2 * ofe].split()[0])
+    return ofes, points
+
+
+def estimate_cost(slpfn, years):
+    """Estimate the runtime of a flowpath without any history."""
+    try:
+        ofes, points = read_slope_size(slpfn)
+    except (OSError, IndexError, ValueError):
+        ofes, points = 1, 2
+    return COST_BASE + years * (
+        ofes * COST_PER_OFE_YEAR + points * COST_PER_POINT_YEAR
+    )
+
+
+def test_slope_size(tmp_path):
+    """Test our parsing of a slope file."""
+    slpfn = tmp_path / "test.slp"
+    slpfn.write_text(
+        "97.3\n#\n# comment\n#\n#\n1\n"
+        "180.0 1.0\n3 30.0\n0.0, 0.01 0.5, 0.02 1.0, 0.03\n"
+    )
+    assert read_slope_size(slpfn) == (1, 3)
+    slpfn.write_text(
+        "97.3\n#\n# comment\n#\n#\n2\n180.0 1.0\n"
+        "3 30.0\n0.0, 0.01 0.5, 0.02 1.0, 0.03\n"
+        "2 10.0\n0.0, 0.03 1.0, 0.04\n"
+    )
+    assert read_slope_size(slpfn) == (2, 5)
+    assert estimate_cost(tmp_path / "missing.slp", 10) > COST_BASE
+
+
+def test_load_runtimes(tmp_path, monkeypatch):
+    """Test that the settled days are compacted to the recent runs."""
+    monkeypatch.setattr("job_cost.RUNTIME_DIR", str(tmp_path / "{scenario}"))
+    olddir = tmp_path / "0" / "20000101"
+    olddir.mkdir(parents=True)
+    (olddir / "other_1.csv").write_text(
+        "".join(f"070600060701,1,{i}\n" for i in range(HISTORY_RUNS + 2))
+        + "070600060701,2,4.0\n"
+    )
+    record_runtime(0, "070600060701", 2, 6.0)
+    expected = {
+        ("070600060701", 1): sum(range(2, HISTORY_RUNS + 2)) / HISTORY_RUNS,
+        ("070600060701", 2): 5.0,
+    }
+    assert load_runtimes(0) == expected
+    assert not olddir.exists()
+    assert (tmp_path / "0" / HISTORY_FILE).is_file()
+    # Today's file is still being written to
+    record_runtime(0, "070600060701", 2, 8.0)
+    assert load_runtimes(0)[("070600060701", 2)] == 6.0
+    _HISTORY.pop(0)[1].close()
+    # A failure to write is only logged
+    monkeypatch.setattr("job_cost.RUNTIME_DIR", "/dev/null/{scenario}")
+    record_runtime(0, "070600060701", 2, 6.0)
+    assert 0 not in _HISTORY
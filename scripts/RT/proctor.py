@@ -4,12 +4,11 @@
 """
 import sys
 import os
-import subprocess
 import datetime
-from multiprocessing.pool import ThreadPool
 
 from pyiem.dep import load_scenarios
 from pyiem.util import get_dbconn
+from wepp_pool import STATE, WeppPool, init_worker, run_job
 
 YEARS = datetime.date.today().year - 2006
 # need to regenerate run files on 2 January
@@ -128,28 +127,26 @@ class WeppRun(object):
 
         out.close()
 
-    def run(self):
-        """Actually run wepp for this event"""
+    def get_job(self):
+        """Return a `wepp_pool` job tuple for this run."""
         runfile = self.get_runfile_fn()
         if FORCE_RUNFILE_REGEN or not os.path.isfile(runfile):
             # If this scenario does not have a run file, hmmm
             self.make_runfile()
-        proc = subprocess.Popen(
-            ["wepp"],
-            stderr=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stdin=subprocess.PIPE,
-        )
-        (stdoutdata, stderrdata) = proc.communicate(open(runfile, "rb").read())
-        if stdoutdata[-13:-1] != b"SUCCESSFULLY":
+        with open(runfile, "rb") as fh:
+            rundata = fh.read()
+        return (self.huc12, self.fpid), rundata, self.get_error_fn()
+
+    def run(self):
+        """Actually run wepp for this event"""
+        if STATE["scratch"] is None:
+            init_worker("/dev/shm", None)
+        res = run_job(self.get_job())
+        if not res.success:
             print(
                 ('Run HUC12: %s FPATH: %4s errored! "%s"')
-                % (self.huc12, self.fpid, stdoutdata[-13:-1])
+                % (self.huc12, self.fpid, res.tail[-13:-1])
             )
-            efp = open(self.get_error_fn(), "wb")
-            efp.write(stdoutdata)
-            efp.write(stderrdata)
-            efp.close()
             return False
         return True
 
@@ -182,44 +179,49 @@ def main(argv):
     scenario = int(argv[1])
     sdf = load_scenarios()
     queue = realtime_run(sdf.loc[scenario], scenario)
-    pool = ThreadPool()  # defaults to cpu-count
     sz = len(queue)
     failures = 0
 
-    def _run(row):
-        """Run !"""
-        wr = WeppRun(row[0], row[1], row[2], scenario)
-        return wr.run()
-
-    sts00 = datetime.datetime.now()
-    sts0 = datetime.datetime.now()
-    for i, res in enumerate(pool.imap_unordered(_run, queue), 1):
-        if not res:
-            failures += 1
-        if failures > 100:
-            print("ABORT due to more than 100 failures...")
-            sys.exit(10)
-        if i > 0 and i % 5000 == 0:
-            delta00 = datetime.datetime.now() - sts00
-            delta0 = datetime.datetime.now() - sts0
-            speed00 = i / delta00.total_seconds()
-            speed0 = 5000 / delta0.total_seconds()
-            remaining = ((sz - i) / speed00) / 3600.0
-            sts0 = datetime.datetime.now()
-            print(
-                (
-                    "%5.2fh Processed %6s/%6s [inst/tot %.2f/%.2f rps] "
-                    "remaining: %5.2fh"
+    def _jobs():
+        """Generate the jobs as the pool consumes them."""
+        for row in queue:
+            yield WeppRun(row[0], row[1], row[2], scenario).get_job()
+
+    # The pool's scratch dir is cleaned up on an abort as well
+    with WeppPool() as pool:  # defaults to cpu-count
+        sts00 = datetime.datetime.now()
+        sts0 = datetime.datetime.now()
+        for i, res in enumerate(pool.imap(_jobs()), 1):
+            if not res.success:
+                failures += 1
+                print(
+                    ('Run HUC12: %s FPATH: %4s errored! "%s" %.1fs')
+                    % (*res.jobid, res.tail[-13:-1], res.walltime)
                 )
-                % (
-                    delta00.total_seconds() / 3600.0,
-                    i,
-                    sz,
-                    speed0,
-                    speed00,
-                    remaining,
+            if failures > 100:
+                print("ABORT due to more than 100 failures...")
+                sys.exit(10)
+            if i > 0 and i % 5000 == 0:
+                delta00 = datetime.datetime.now() - sts00
+                delta0 = datetime.datetime.now() - sts0
+                speed00 = i / delta00.total_seconds()
+                speed0 = 5000 / delta0.total_seconds()
+                remaining = ((sz - i) / speed00) / 3600.0
+                sts0 = datetime.datetime.now()
+                print(
+                    (
+                        "%5.2fh Processed %6s/%6s [inst/tot %.2f/%.2f rps] "
+                        "remaining: %5.2fh"
+                    )
+                    % (
+                        delta00.total_seconds() / 3600.0,
+                        i,
+                        sz,
+                        speed0,
+                        speed00,
+                        remaining,
+                    )
                 )
-            )
 
 
 if __name__ == "__main__":
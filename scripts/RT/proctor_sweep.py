@@ -29,6 +29,7 @@ import pandas as pd
 import requests
 from tqdm import tqdm
 from pandas.io.sql import read_sql
+from stage_spans import span
 
 HUC12S = ["090201081101", "090201081102", "090201060605"]
 LOG = logger()
@@ -152,7 +153,8 @@ def main(argv):
     df["date"] = pd.Timestamp(date)
     LOG.debug("found %s flowpaths to run for %s", len(df.index), date)
     jobs = list(df.iterrows())
-    with Pool() as pool:
+    with span("proctor_sweep") as rec, Pool() as pool:
+        rec["items"] = len(jobs)
         progress = tqdm(
             pool.imap_unordered(workflow, jobs),
             total=len(df.index),
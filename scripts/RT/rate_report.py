@@ -0,0 +1,15 @@
+"""Throughput reporting of the bench_*.py benchmarks.
+
+This module is shared with scripts/cligen and scripts/import by symlinks.
+"""
+
+
+def report_rate(benchmark, count, unit):
+    """Add the throughput at the mean time to the benchmark's extra info.
+
+    There are no stats with ``--benchmark-disable``, which runs each
+    benchmark once as a quick smoke test.
+    """
+    if benchmark.stats is None:
+        return
+    benchmark.extra_info[f"{unit}/s"] = count / benchmark.stats.stats.mean
@@ -0,0 +1,270 @@
+"""Bookkeeping for the incremental nightly WEPP run.
+
+For each flowpath we record the date of its last WEPP run, a digest of its
+inputs (the runfile and the .man, .slp and .sol files) and the first event
+found in its .env output after that date.  The following night, a flowpath
+can keep its previous output when
+
+  1. its input digest is unchanged,
+  2. there was no precipitation at its climate file's grid cell on any day
+     since its last run, per the daily precip grids, and
+  3. its last run had no event on those days either, as those days were
+     placeholder climate data at that time.
+
+Edits to the historical portion of the climate files are not detected, so a
+full run needs to be forced after such changes.
+"""
+import datetime
+import hashlib
+from multiprocessing import Pool
+import os
+import re
+
+import numpy as np
+import pandas as pd
+from pyiem.dep import SOUTH, WEST
+from pyiem.util import logger
+
+LOG = logger()
+STATE_FN = "/i/{scenario}/runstate.csv"
+PRECIP_FN = "/mnt/idep2/data/dailyprecip/{date:%Y}/{date:%Y%m%d}.npy"
+CLIFN_RE = re.compile(r"(?P<lon>[0-9.]+)x(?P<lat>[0-9.]+)\.cli$")
+# Flowpaths not run within this many days are run regardless
+MAX_LOOKBACK = 30
+# Ordinal used when a run had no events after its run date
+NO_EVENT = datetime.date(9999, 12, 31).toordinal()
+STATE_COLUMNS = ["huc12", "fpath", "rundate", "stamp", "digest", "nextevent"]
+
+
+def load_state(scenario):
+    """Return a dict of (huc12, fpath) to state tuple, empty when missing."""
+    fn = STATE_FN.format(scenario=scenario)
+    if not os.path.isfile(fn):
+        LOG.info("No run state found at %s", fn)
+        return {}
+    df = pd.read_csv(fn, dtype={"huc12": str, "stamp": str, "digest": str})
+    return {
+        (row[0], row[1]): row[2:]
+        for row in df[STATE_COLUMNS].itertuples(index=False, name=None)
+    }
+
+
+def save_state(scenario, state):
+    """Atomically write the run state."""
+    fn = STATE_FN.format(scenario=scenario)
+    df = pd.DataFrame(
+        [(*key, *value) for key, value in state.items()],
+        columns=STATE_COLUMNS,
+    )
+    df.to_csv(f"{fn}.tmp", index=False)
+    os.rename(f"{fn}.tmp", fn)
+
+
+def input_files(wr):
+    """Return the input filenames that are part of the digest."""
+    return [wr.get_man_fn(), wr.get_slope_fn(), wr.get_soil_fn()]
+
+
+def input_stamp(fns):
+    """Return the cheap to compute (size, mtime) stamp of the input files."""
+    parts = []
+    for fn in fns:
+        try:
+            st = os.stat(fn)
+        except OSError:
+            return None
+        parts.append(f"{st.st_size}:{st.st_mtime_ns}")
+    return ";".join(parts)
+
+
+def input_digest(fns, runfile):
+    """Return the digest of the runfile and the input files."""
+    digest = hashlib.sha1(runfile.encode("ascii"))
+    for fn in fns:
+        with open(fn, "rb") as fh:
+            digest.update(fh.read())
+    return digest.hexdigest()
+
+
+def get_cell(clifn):
+    """Return the (y, x) precip grid index for this climate file."""
+    m = CLIFN_RE.search(clifn)
+    if m is None:
+        return None
+    lon = 0 - float(m.group("lon"))
+    lat = float(m.group("lat"))
+    return int(round((lat - SOUTH) * 100)), int(round((lon - WEST) * 100))
+
+
+def last_wet_grid(sts, ets):
+    """Return a grid of the last date ordinal with precip, sts to ets.
+
+    Cells that were dry over the period are sts - 1.  A missing precip grid
+    marks every cell as wet on that date, in which case a scalar may be
+    returned.
+    """
+    res = sts.toordinal() - 1
+    allwet = res
+    now = sts
+    while now <= ets:
+        fn = PRECIP_FN.format(date=now)
+        if os.path.isfile(fn):
+            grid = np.load(fn)
+            if not isinstance(res, np.ndarray):
+                res = np.full(grid.shape, res, np.int32)
+            res[grid > 0] = now.toordinal()
+        else:
+            LOG.info("Missing %s, assuming precip everywhere", fn)
+            allwet = now.toordinal()
+        now += datetime.timedelta(days=1)
+    return np.maximum(res, allwet)
+
+
+def next_event(envfn, valid, year0=2006):
+    """Return the ordinal of the first event in the env file after valid."""
+    target = (valid.year - year0, valid.month, valid.day)
+    with open(envfn, encoding="ascii") as fh:
+        for line in fh.readlines()[3:]:
+            tokens = line.split()
+            if len(tokens) < 3:
+                continue
+            day, month, year = int(tokens[0]), int(tokens[1]), int(tokens[2])
+            if (year, month, day) > target:
+                return datetime.date(year + year0, month, day).toordinal()
+    return NO_EVENT
+
+
+def plan_runs(runs, runfiles, state, valid, lastwet):
+    """Decide which WeppRuns need to be run.
+
+    Args:
+      runs (list): the WeppRun instances.
+      runfiles (list): the runfile text of each run.
+      state (dict): as returned by `load_state`.
+      valid (date): the date being processed.
+      lastwet: as returned by `last_wet_grid`.
+
+    Returns:
+      list of bool for if the run is needed, dict of the reason counts,
+      dict of (huc12, fpath) to (stamp, digest) of the current inputs
+    """
+    needed = []
+    reasons = {"nostate": 0, "inputs": 0, "precip": 0, "event": 0, "skip": 0}
+    inputs = {}
+    mindate = valid.toordinal() - MAX_LOOKBACK
+    for wr, runfile in zip(runs, runfiles):
+        key = (wr.huc12, wr.fpid)
+        stamp = input_stamp(input_files(wr))
+        previous = state.get(key)
+        if stamp is None or previous is None or previous[0] < mindate:
+            needed.append(True)
+            reasons["nostate"] += 1
+            continue
+        rundate, oldstamp, olddigest, nextevent = previous
+        digest = olddigest
+        if stamp != oldstamp:
+            digest = input_digest(input_files(wr), runfile)
+        inputs[key] = (stamp, digest)
+        if digest != olddigest:
+            reason = "inputs"
+        elif nextevent <= valid.toordinal():
+            reason = "event"
+        else:
+            cell = get_cell(wr.get_clifile_fn())
+            if lastwet.ndim == 0:
+                wet = lastwet > rundate
+            else:
+                wet = cell is None or lastwet[cell] > rundate
+            reason = "precip" if wet else "skip"
+        needed.append(reason != "skip")
+        reasons[reason] += 1
+    return needed, reasons, inputs
+
+
+def _refresh(job):
+    """Compute the new state of a flowpath that was run."""
+    key, fns, runfile, envfn, errorfn, inputs, valid, since = job
+    try:
+        if os.stat(envfn).st_mtime < since:
+            return key, None
+        if os.path.isfile(errorfn) and os.stat(errorfn).st_mtime >= since:
+            return key, None
+        stamp, digest = inputs
+        if stamp is None:
+            stamp = input_stamp(fns)
+            digest = input_digest(fns, runfile)
+        return key, (
+            valid.toordinal(),
+            stamp,
+            digest,
+            next_event(envfn, valid),
+        )
+    except (OSError, ValueError) as exp:
+        LOG.info("Failed to refresh state for %s: %s", key, exp)
+        return key, None
+
+
+def update_state(state, runs, runfiles, inputs, valid, since):
+    """Record the new state of the flowpaths that were run.
+
+    Flowpaths whose .env output was not written after `since` (a timestamp)
+    or that errored are dropped from the state, so they get run next time.
+    """
+    jobs = [
+        (
+            (wr.huc12, wr.fpid),
+            input_files(wr),
+            runfile,
+            wr.get_env_fn(),
+            wr.get_error_fn(),
+            inputs.get((wr.huc12, wr.fpid), (None, None)),
+            valid,
+            since,
+        )
+        for wr, runfile in zip(runs, runfiles)
+    ]
+    updated = 0
+    with Pool() as pool:
+        for key, value in pool.imap_unordered(_refresh, jobs, 1000):
+            if value is None:
+                state.pop(key, None)
+                continue
+            state[key] = value
+            updated += 1
+    return updated
+
+
+def test_next_event(tmp_path):
+    """Test that we find the first event after the date."""
+    envfn = tmp_path / "test.env"
+    envfn.write_text(
+        "header\nheader\nheader\n"
+        "  3   5  13   25.0   1.0\n"
+        " 10   6  18   25.0   1.0\n"
+    )
+    valid = datetime.date(2018, 6, 1)
+    assert next_event(envfn, valid) == datetime.date(2019, 5, 3).toordinal()
+    assert next_event(envfn, datetime.date(2024, 6, 10)) == NO_EVENT
+
+
+def test_last_wet_grid(tmp_path, monkeypatch):
+    """Test that a missing grid marks everything wet."""
+    monkeypatch.setattr(
+        "run_state.PRECIP_FN", str(tmp_path / "{date:%Y%m%d}.npy")
+    )
+    grid = np.zeros((2, 2))
+    grid[0, 1] = 1.0
+    np.save(tmp_path / "20230102.npy", grid)
+    sts = datetime.date(2023, 1, 1)
+    res = last_wet_grid(sts, datetime.date(2023, 1, 2))
+    assert (res == sts.toordinal()).sum() == 3
+    np.save(tmp_path / "20230101.npy", grid)
+    res = last_wet_grid(sts, datetime.date(2023, 1, 2))
+    assert res[0, 1] == sts.toordinal() + 1
+    assert res[0, 0] == sts.toordinal() - 1
+
+
+def test_get_cell():
+    """Test the climate filename to grid cell."""
+    clifn = f"/i/0/cli/095x042/{0 - WEST:06.2f}x{SOUTH + 0.05:06.2f}.cli"
+    assert get_cell(clifn) == (5, 0)
@@ -4,6 +4,7 @@ from io import BytesIO
 
 from pyiem import util
 import requests
+from stage_spans import span
 
 LOG = util.logger()
 
@@ -45,4 +46,5 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    with span("spam_twitter"):
+        main()
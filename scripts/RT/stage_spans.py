@@ -0,0 +1,248 @@
+"""Structured timing spans of the nightly REALTIME.sh stages.
+
+The stages wrap their work, and optionally each tile or HUC12, with `span`:
+
+    with span("env2database", key=huc12) as rec:
+        ...
+        rec["items"] = len(df.index)
+
+Every span appends one JSON line to the night's file within SPANS_DIR with
+the wall and CPU seconds, the peak RSS of the process so far [MB], the bytes
+read and written to storage by the process and the item count.  Spans
+without a key cover a whole stage and also count the CPU time of the
+child processes that were waited on.  The night is the date being
+processed, which REALTIME.sh provides with the DEP_RUN environment variable.
+
+To compare a night against the trailing nights:
+
+    python stage_spans.py [--run YYYY-MM-DD] [--nights 30]
+
+This module is shared with scripts/cligen by a symlink.
+"""
+import argparse
+import datetime
+import json
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+import pandas as pd
+
+SPANS_DIR = "/mnt/idep2/data/spans"
+# The enqueue_jobs.py limit on waiting for the queue to drain [s]
+QUEUE_LIMIT = 36000
+# Ratio to the trailing median that is flagged as a slowdown
+SLOWDOWN = 1.25
+
+
+def get_run():
+    """Return the night being processed, as YYYY-MM-DD."""
+    return os.environ.get("DEP_RUN") or datetime.date.today().isoformat()
+
+
+def get_spans_fn(run):
+    """Return the spans filename for this night."""
+    return f"{SPANS_DIR}/{run[:4]}/spans_{run}.jsonl"
+
+
+def read_io():
+    """Return the storage (read, write) bytes of this process, if known."""
+    res = {}
+    try:
+        with open("/proc/self/io", encoding="ascii") as fh:
+            for line in fh:
+                name, value = line.split(":")
+                res[name] = int(value)
+    except (OSError, ValueError):
+        return None, None
+    return res.get("read_bytes"), res.get("write_bytes")
+
+
+def _delta(end, start):
+    """Return end - start, None if either is unknown."""
+    if end is None or start is None:
+        return None
+    return end - start
+
+
+def _cpu(children):
+    """Return the user and system CPU seconds used."""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    res = usage.ru_utime + usage.ru_stime
+    if children:
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        res += usage.ru_utime + usage.ru_stime
+    return res
+
+
+def _maxrss(children):
+    """Return the peak RSS [MB], Linux reports KB."""
+    res = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if children:
+        res = max(res, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return res / 1024.0
+
+
+def write_span(rec):
+    """Append the span to the night's file, never failing the caller."""
+    line = json.dumps(rec, default=str) + "\n"
+    fn = get_spans_fn(rec["run"])
+    try:
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        # Appends of a single short write do not interleave between processes
+        fd = os.open(fn, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode("utf-8"))
+        finally:
+            os.close(fd)
+    except OSError:
+        pass
+
+
+@contextmanager
+def span(stage, key=None):
+    """Time the enclosed work, yielding the record to set ``items`` on."""
+    children = key is None
+    rec = {
+        "run": get_run(),
+        "stage": stage,
+        "key": key,
+        "pid": os.getpid(),
+        "start": datetime.datetime.now().isoformat(timespec="seconds"),
+        "items": None,
+        "error": None,
+    }
+    read0, write0 = read_io()
+    cpu0 = _cpu(children)
+    sts = time.perf_counter()
+    try:
+        yield rec
+    except BaseException as exp:
+        rec["error"] = type(exp).__name__
+        raise
+    finally:
+        read1, write1 = read_io()
+        rec["wall"] = round(time.perf_counter() - sts, 3)
+        rec["cpu"] = round(_cpu(children) - cpu0, 3)
+        rec["maxrss"] = round(_maxrss(children), 1)
+        rec["read_bytes"] = _delta(read1, read0)
+        rec["write_bytes"] = _delta(write1, write0)
+        write_span(rec)
+
+
+def load_spans(runs):
+    """Return a DataFrame of the spans of these nights."""
+    frames = []
+    for run in runs:
+        fn = get_spans_fn(run)
+        if not os.path.isfile(fn):
+            continue
+        with open(fn, encoding="utf-8") as fh:
+            frames.append(pd.DataFrame([json.loads(line) for line in fh]))
+    if not frames:
+        return pd.DataFrame()
+    return pd.concat(frames, ignore_index=True)
+
+
+def summarize(df):
+    """Return the per night and stage totals of the spans."""
+    df = df.assign(keyed=df["key"].notna())
+    whole = df[~df["keyed"]].groupby(["run", "stage"])
+    keyed = df[df["keyed"]].groupby(["run", "stage"])
+    res = pd.DataFrame(
+        {
+            "wall": whole["wall"].sum(),
+            "cpu": whole["cpu"].sum(),
+            "maxrss": whole["maxrss"].max(),
+            "items": whole["items"].sum(min_count=1),
+            "errors": whole["error"].count(),
+        }
+    )
+    parts = pd.DataFrame(
+        {
+            "parts": keyed["wall"].size(),
+            "parts_wall": keyed["wall"].sum(),
+            "parts_p95": keyed["wall"].quantile(0.95),
+            "parts_maxrss": keyed["maxrss"].max(),
+            "parts_read": keyed["read_bytes"].sum(min_count=1),
+            "parts_write": keyed["write_bytes"].sum(min_count=1),
+        }
+    )
+    return res.join(parts, how="outer")
+
+
+def report(run, nights):
+    """Return the text comparing the night to the trailing nights."""
+    sts = datetime.date.fromisoformat(run)
+    runs = [
+        (sts - datetime.timedelta(days=i)).isoformat()
+        for i in range(nights + 1)
+    ]
+    df = load_spans(runs)
+    if df.empty or run not in set(df["run"]):
+        return f"No spans found for {run}"
+    stats = summarize(df)
+    tonight = stats.xs(run, level="run")
+    trailing = stats.drop(run, level="run").groupby(level="stage").median()
+    lines = [
+        f"DEP nightly stages for {run} vs the median of "
+        f"{len(set(df['run'])) - 1} of the trailing {nights} nights",
+        f"{'stage':32s} {'wall[s]':>9s} {'median':>9s} {'ratio':>6s} "
+        f"{'cpu[s]':>9s} {'rss[MB]':>8s} {'items':>9s} {'p95[s]':>7s}",
+    ]
+    for stage, row in tonight.iterrows():
+        base = trailing["wall"].get(stage)
+        ratio = row["wall"] / base if base else float("nan")
+        flag = " SLOWER" if ratio > SLOWDOWN else ""
+        lines.append(
+            f"{stage:32s} {row['wall']:9.0f} {base or float('nan'):9.0f} "
+            f"{ratio:6.2f} {row['cpu']:9.0f} {row['maxrss']:8.0f} "
+            f"{row['items']:9.0f} {row['parts_p95']:7.1f}{flag}"
+        )
+    if "enqueue_jobs.wait" in tonight.index:
+        wall = tonight.at["enqueue_jobs.wait", "wall"]
+        lines.append(
+            f"enqueue_jobs queue wait used {wall / QUEUE_LIMIT:.0%} of the "
+            f"{QUEUE_LIMIT / 3600:.0f} hour limit"
+        )
+    return "\n".join(lines)
+
+
+def usage():
+    """Create the argparse instance."""
+    parser = argparse.ArgumentParser("Report on the nightly stage spans")
+    parser.add_argument("--run", default=get_run(), help="YYYY-MM-DD night")
+    parser.add_argument("--nights", type=int, default=30)
+    return parser
+
+
+def main(argv):
+    """Go Main Go."""
+    args = usage().parse_args(argv[1:])
+    print(report(args.run, args.nights))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_report(tmp_path, monkeypatch):
+    """Test that spans are written and reported on."""
+    monkeypatch.setattr("stage_spans.SPANS_DIR", str(tmp_path))
+    for i, run in enumerate(["2021-06-01", "2021-06-02", "2021-06-03"]):
+        monkeypatch.setenv("DEP_RUN", run)
+        with span("enqueue_jobs") as rec:
+            rec["items"] = 10
+            with span("env2database", key="102400130105") as rec2:
+                rec2["items"] = 3
+        with span("enqueue_jobs.wait"):
+            time.sleep(0.01 * (1 + 5 * (i == 2)))
+    df = load_spans(["2021-06-03"])
+    assert len(df.index) == 3
+    assert df["key"].tolist()[0] == "102400130105"
+    text = report("2021-06-03", 30)
+    assert "2 of the trailing 30 nights" in text
+    assert "SLOWER" in text.split("enqueue_jobs.wait")[1]
+    assert "hour limit" in text
@@ -0,0 +1,68 @@
+"""Synthetic WEPP env output for the benchmarks, see `bench_rt.py`.
+
+The files follow the layout of ``/i/<scenario>/env`` below any directory,
+with events drawn from a seeded random state.
+"""
+import os
+
+import numpy as np
+
+ENV_HEADER = (
+    " EVENT OUTPUT\n"
+    " day mo year  Precp  Runoff  IR-det Av-det Mx-det  Point  Av-dep "
+    "Max-dep  Point Sed.Del    ER\n"
+    " --- -- ----  (mm)   (mm)   kg/m^2 kg/m^2 kg/m^2    (m)  kg/m^2  "
+    "kg/m^2    (m)   (kg/m)   ----\n"
+)
+
+
+def make_envfile(fn, years, rng, events_per_year=40):
+    """Write a .env file with events over the simulation years."""
+    doys = np.sort(rng.choice(365, (years, events_per_year)), axis=1)
+    lines = [ENV_HEADER]
+    for year in range(years):
+        for doy in doys[year]:
+            month = int(doy // 31) + 1
+            day = int(doy % 28) + 1
+            precip = rng.gamma(1.0, 15.0)
+            runoff = precip * rng.uniform(0, 0.4)
+            det = rng.gamma(0.5, 0.5)
+            lines.append(
+                f"{day:4d}{month:3d}{year + 1:5d}{precip:7.1f}{runoff:8.1f}"
+                f"{det * 0.1:8.3f}{det:7.3f}{det * 3:7.3f}{det * 10:7.1f}"
+                f"{det * 0.2:8.3f}{det * 0.5:8.3f}{det * 20:7.1f}"
+                f"{det * 40:9.2f}{rng.uniform(1, 3):6.1f}\n"
+            )
+    with open(fn, "w", encoding="ascii") as fh:
+        fh.write("".join(lines))
+
+
+def make_env_tree(envdir, huc12s, flowpaths, years, rng):
+    """Write the env files of these HUC12s.
+
+    Returns:
+      dict of huc12 to dict of flowpath to flowpath length [m]
+    """
+    lengths = {}
+    for huc12 in huc12s:
+        basedir = f"{envdir}/{huc12[:8]}/{huc12[8:]}"
+        os.makedirs(basedir, exist_ok=True)
+        lengths[huc12] = {}
+        for fpath in range(1, flowpaths + 1):
+            make_envfile(f"{basedir}/{huc12}_{fpath}.env", years, rng)
+            lengths[huc12][fpath] = rng.uniform(20, 300)
+    return lengths
+
+
+def test_make_env_tree(tmp_path):
+    """Test that the files parse."""
+    from pyiem.dep import read_env
+
+    lengths = make_env_tree(
+        str(tmp_path), ["102400130105"], 2, 3, np.random.default_rng(0)
+    )
+    assert list(lengths["102400130105"]) == [1, 2]
+    df = read_env(str(tmp_path / "10240013/0105/102400130105_1.env"))
+    assert len(df.index) == 3 * 40
+    assert df["date"].dt.year.unique().tolist() == [2007, 2008, 2009]
+    assert not df.isna().any().any()
@@ -0,0 +1,205 @@
+"""A pool of long-lived WEPP worker processes.
+
+The WEPP binary runs one hillslope per invocation, so we still exec it once
+per job, but the worker processes around it stick around for the life of the
+pool.  Each worker is pinned to a core, runs `wepp` from its own scratch
+directory on tmpfs and sends the binary's output to a scratch file rather
+than buffering it through `communicate`, so only the tail gets read back.
+
+Usage:
+    with WeppPool() as pool:
+        for res in pool.imap(jobs):
+            ...
+
+where `jobs` yields (jobid, runfile bytes, error filename) tuples.
+
+The queue carries bundles of runfiles, see `make_bundle` and `read_bundle`.
+"""
+from collections import namedtuple
+from multiprocessing import Pool, Queue, cpu_count
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+import zlib
+
+from pyiem.util import logger
+
+LOG = logger()
+WEPP = "wepp"
+# Number of trailing bytes of stdout kept for each job
+TAILSIZE = 512
+JobResult = namedtuple(
+    "JobResult", ["jobid", "success", "status", "walltime", "tail"]
+)
+# AMQP content type of a message holding many runfiles
+BUNDLE_TYPE = "application/x-dep-bundle"
+# Per worker process state, set by `init_worker`
+STATE = {"scratch": None, "timeout": None}
+
+
+def cpu_queue(workers):
+    """Return a Queue of core ids for `init_worker` to pin processes to."""
+    cpus = Queue()
+    available = sorted(os.sched_getaffinity(0))
+    for i in range(workers):
+        cpus.put(available[i % len(available)])
+    return cpus
+
+
+def make_bundle(runfiles):
+    """Return the compressed message body carrying these runfile strings."""
+    return zlib.compress("\0".join(runfiles).encode("ascii"))
+
+
+def read_bundle(body, content_type=None):
+    """Return the list of runfile bytes within this message body.
+
+    Messages without our content type hold a single runfile.
+    """
+    if content_type != BUNDLE_TYPE:
+        return [body]
+    return zlib.decompress(body).split(b"\0")
+
+
+def init_worker(scratchroot, timeout, cpus=None):
+    """Setup this worker process, called once per process.
+
+    Args:
+      scratchroot (str): directory to create our scratch directory within.
+      timeout (int): number of seconds to allow for one WEPP run, or None.
+      cpus (Queue, optional): core ids to pin the worker processes to.
+    """
+    if not os.path.isdir(scratchroot):
+        scratchroot = tempfile.gettempdir()
+    if cpus is not None:
+        try:
+            os.sched_setaffinity(0, {cpus.get_nowait()})
+        except Exception as exp:
+            LOG.info("Failed to pin worker %s: %s", os.getpid(), exp)
+    STATE["scratch"] = tempfile.mkdtemp(prefix="wepp_", dir=scratchroot)
+    STATE["timeout"] = timeout
+
+
+def run_job(job):
+    """Run WEPP for this job within a worker process.
+
+    Args:
+      job (tuple): (jobid, runfile bytes, error filename or None)
+
+    Returns:
+      JobResult
+    """
+    jobid, rundata, errorfn = job
+    scratch = STATE["scratch"]
+    sts = time.perf_counter()
+    with open(f"{scratch}/stdout", "w+b") as stdout, open(
+        f"{scratch}/stderr", "w+b"
+    ) as stderr:
+        try:
+            status = subprocess.run(
+                [WEPP],
+                input=rundata,
+                stdout=stdout,
+                stderr=stderr,
+                cwd=scratch,
+                timeout=STATE["timeout"],
+                check=False,
+            ).returncode
+        except subprocess.TimeoutExpired:
+            status = None
+        size = stdout.seek(0, os.SEEK_END)
+        stdout.seek(max(0, size - TAILSIZE))
+        tail = stdout.read()
+        success = tail[-13:-1] == b"SUCCESSFULLY"
+        if not success and errorfn is not None:
+            with open(errorfn, "wb") as fp:
+                hn = f"Hostname: {socket.gethostname()}\n"
+                fp.write(hn.encode("ascii"))
+                stdout.seek(0)
+                shutil.copyfileobj(stdout, fp)
+                stderr.seek(0)
+                shutil.copyfileobj(stderr, fp)
+    return JobResult(
+        jobid=jobid,
+        success=success,
+        status=status,
+        walltime=time.perf_counter() - sts,
+        tail=tail.decode("ascii", "ignore"),
+    )
+
+
+class WeppPool:
+    """A pool of pinned WEPP worker processes."""
+
+    def __init__(self, workers=None, scratchroot="/dev/shm", timeout=None):
+        """Start the worker processes.
+
+        Args:
+          workers (int, optional): number of processes, defaults to cpu count.
+          scratchroot (str): tmpfs location for the worker scratch dirs.
+          timeout (int, optional): seconds to allow for one WEPP run.
+        """
+        workers = cpu_count() if workers is None else workers
+        if not os.path.isdir(scratchroot):
+            scratchroot = tempfile.gettempdir()
+        self.scratch = tempfile.mkdtemp(prefix="wepppool_", dir=scratchroot)
+        self.pool = Pool(
+            workers,
+            initializer=init_worker,
+            initargs=(self.scratch, timeout, cpu_queue(workers)),
+        )
+
+    def imap(self, jobs, chunksize=16):
+        """Stream the jobs to the workers and yield JobResults as done."""
+        return self.pool.imap_unordered(run_job, jobs, chunksize)
+
+    def apply_async(self, job, callback, error_callback):
+        """Run one job, calling back from the pool's result thread."""
+        return self.pool.apply_async(
+            run_job, (job,), callback=callback, error_callback=error_callback
+        )
+
+    def close(self):
+        """Wait for the workers to finish and cleanup."""
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def terminate(self):
+        """Stop the workers, dropping any queued jobs, and cleanup."""
+        self.pool.terminate()
+        self.pool.join()
+        shutil.rmtree(self.scratch, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        # An abort should not wait on the rest of the jobs
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+def test_bundle():
+    """Test the roundtrip of a bundle."""
+    runfiles = ["E\nYes\n1\n", "E\nNo\n"]
+    body = make_bundle(runfiles)
+    res = read_bundle(body, BUNDLE_TYPE)
+    assert [x.decode("ascii") for x in res] == runfiles
+    assert read_bundle(b"E\n") == [b"E\n"]
+
+
+def test_pool_cleanup(tmp_path):
+    """Test that the scratch dir is removed when aborting."""
+    try:
+        with WeppPool(1, scratchroot=str(tmp_path)) as pool:
+            scratch = pool.scratch
+            raise SystemExit(10)
+    except SystemExit:
+        pass
+    assert not os.path.isdir(scratch)
@@ -5,13 +5,21 @@
 The previous year is choosen based on if the year to add is a leap year or not,
 if it is, then pick a year four years ago, if it isn't, use last year
 """
+import datetime
 import glob
 import sys
 import os
-import subprocess
 
+import numpy as np
 from tqdm import tqdm
 from pyiem.util import logger
+from clifile_index import (
+    append_days,
+    has_day,
+    read_days,
+    replace_header_line,
+)
+from clifile_store import CliBlock, years_header
 
 LOG = logger()
 
@@ -27,24 +35,31 @@ def workflow(filename, newyear, analogyear):
     # Figure out what this file's lon/lat values are
     lon, lat = parse_filename(filename)
     # LOG.debug("%s -> %.2f %.2f", filename, lon, lat)
-    lines = open(filename).readlines()
+    if has_day(filename, datetime.date(newyear, 1, 1)):
+        LOG.info("%s already has %s data", filename, newyear)
+        return
     # Replace the header information denoting years simulated
     years_simulated = (newyear - 2007) + 1
-    lines[4] = (
-        "    %.2f   %.2f         289          %i        2007"
-        "              %i\n"
-    ) % (lat, lon, years_simulated, years_simulated)
-    data = "".join(lines)
-    if data.find("1\t1\t%s" % (newyear,)) > 0:
-        LOG.info("%s already has %s data", filename, newyear)
+    replace_header_line(filename, 4, years_header(lat, lon, years_simulated))
+    content = read_days(
+        filename,
+        datetime.date(analogyear, 1, 1),
+        datetime.date(analogyear, 12, 31),
+    )
+    append_days(filename, content.replace(str(analogyear), str(newyear)))
+
+
+def store_workflow(blockdir, newyear, analogyear):
+    """Effort this climate store block, please"""
+    block = CliBlock(blockdir, "r+")
+    tidx = block.day_index(datetime.date(newyear, 1, 1))
+    if (
+        tidx < block.meta["ndays"]
+        and not np.isnan(block.daily["high"][:, tidx]).all()
+    ):
+        LOG.info("%s already has %s data", blockdir, newyear)
         return
-    pos = data.find("1\t1\t%s" % (analogyear,))
-    pos2 = data.find("1\t1\t%s" % (analogyear + 1,))
-    content = data[pos:pos2] if pos2 > 0 else data[pos:]
-    with open("/tmp/%s" % (filename,), "w") as fh:
-        # careful here to get the line feeds right
-        fh.write(data + content.replace(str(analogyear), str(newyear)))
-    subprocess.call("mv /tmp/%s %s" % (filename, filename), shell=True)
+    block.copy_year(analogyear, newyear)
 
 
 def compute_analog_year(year):
@@ -65,6 +80,9 @@ def main(argv):
     year = int(argv[2])
     analogyear = compute_analog_year(year)
     LOG.info("Using analog year %s for new year %s", analogyear, year)
+    if os.path.isdir(f"/i/{scenario}/clistore"):
+        for blockdir in tqdm(glob.glob(f"/i/{scenario}/clistore/*")):
+            store_workflow(blockdir, year, analogyear)
     os.chdir("/i/%s/cli" % (scenario,))
     for mydir in tqdm(glob.glob("*")):
         os.chdir(mydir)
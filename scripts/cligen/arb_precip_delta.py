@@ -7,6 +7,7 @@ import sys
 from multiprocessing.pool import ThreadPool
 
 from tqdm import tqdm
+from clifile_store import read_clilines
 
 
 def conservative_adjust(times, accum, multipler):
@@ -48,41 +49,40 @@ def editor(arg):
             os.makedirs(newdir)
         except FileExistsError:
             pass
+    lines = read_clilines(fn)
     with open(newfn, "w", encoding="utf8") as fp:
-        with open(fn, encoding="utf8") as fpin:
-            linenum = 0
-            lines = fpin.readlines()
-            while linenum < len(lines):
-                line = lines[linenum].strip()
-                if linenum < 15:
-                    fp.write(f"{line}\n")
-                    linenum += 1
-                    continue
-                tokens = line.split()
-                if len(tokens) < 3:
-                    fp.write(f"{line}\n")
-                    linenum += 1
-                    continue
-                breakpoints = int(tokens[3])
-                if breakpoints == 0:
-                    fp.write(f"{line}\n")
-                    linenum += 1
-                    continue
-                times = []
-                accum = []
-                for _ in range(breakpoints):
-                    linenum += 1
-                    tokens = lines[linenum].split()
-                    times.append(float(tokens[0]))
-                    accum.append(float(tokens[1]))
-                if conserve_total:
-                    times = conservative_adjust(times, accum, multiplier)
-                else:
-                    accum = [x * multiplier for x in accum]
+        linenum = 0
+        while linenum < len(lines):
+            line = lines[linenum].strip()
+            if linenum < 15:
                 fp.write(f"{line}\n")
-                for i in range(breakpoints):
-                    fp.write(f"{times[i]:.4f} {accum[i]:.2f}\n")
                 linenum += 1
+                continue
+            tokens = line.split()
+            if len(tokens) < 3:
+                fp.write(f"{line}\n")
+                linenum += 1
+                continue
+            breakpoints = int(tokens[3])
+            if breakpoints == 0:
+                fp.write(f"{line}\n")
+                linenum += 1
+                continue
+            times = []
+            accum = []
+            for _ in range(breakpoints):
+                linenum += 1
+                tokens = lines[linenum].split()
+                times.append(float(tokens[0]))
+                accum.append(float(tokens[1]))
+            if conserve_total:
+                times = conservative_adjust(times, accum, multiplier)
+            else:
+                accum = [x * multiplier for x in accum]
+            fp.write(f"{line}\n")
+            for i in range(breakpoints):
+                fp.write(f"{times[i]:.4f} {accum[i]:.2f}\n")
+            linenum += 1
 
 
 def finder(scenario, multiplier, conserve_total):
@@ -90,6 +90,8 @@ def finder(scenario, multiplier, conserve_total):
     res = []
     for dirname, _dirpath, filenames in os.walk("/i/0/cli"):
         for fn in filenames:
+            if not fn.endswith(".cli"):
+                continue
             res.append(
                 [f"{dirname}/{fn}", scenario, multiplier, conserve_total]
             )
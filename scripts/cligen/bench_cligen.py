@@ -0,0 +1,126 @@
+"""Benchmarks of the climate file editing hot paths.
+
+    python -m pytest bench_cligen.py --benchmark-autosave
+
+Each benchmark is run at several data sizes and reports its throughput as
+``extra_info``, see `scripts/run_benchmarks.sh` for tracking these over time.
+The inputs come from `synthetic_weather.py`.
+"""
+import datetime
+
+import numpy as np
+import pytest
+import daily_clifile_editor
+from daily_clifile_editor import (
+    compute_breakpoint,
+    compute_tile_breakpoints,
+    compute_tile_bounds,
+    edit_clifile,
+    frame_precip,
+    load_precip,
+)
+from sparse_precip import SparsePrecip
+from rate_report import report_rate
+from synthetic_weather import (
+    make_a2m_frames,
+    make_clifile,
+    make_precip,
+    write_a2m_png,
+)
+
+VALID = datetime.date(2021, 6, 1)
+
+
+def empty_tile(shp, sparse=False):
+    """Return the data dict of a tile with no precip."""
+    data = {}
+    for vname in "high low dwpt wind solar stage4".split():
+        data[vname] = np.ones(shp, np.float16)
+    if sparse:
+        data["precip"] = SparsePrecip((*shp, 30 * 24))
+    else:
+        data["precip"] = np.zeros((*shp, 30 * 24), np.float16)
+    return data
+
+
+@pytest.mark.parametrize("cells", [10, 100, 1000])
+def test_compute_breakpoint(benchmark, cells):
+    """The per cell breakpoint computation."""
+    precip = make_precip(30 * 24, 0.25, np.random.default_rng(0), (cells,))
+
+    def _run():
+        return [compute_breakpoint(ar) for ar in precip]
+
+    benchmark(_run)
+    report_rate(benchmark, cells, "cells")
+
+
+@pytest.mark.parametrize("size", [50, 100, 200])
+def test_compute_tile_breakpoints(benchmark, size):
+    """The batched breakpoint computation of a tile."""
+    precip = make_precip(30 * 24, 0.25, np.random.default_rng(0), (size, size))
+    benchmark(compute_tile_breakpoints, precip)
+    report_rate(benchmark, size * size, "cells")
+
+
+@pytest.mark.parametrize("years", [2, 8, 16])
+def test_edit_clifile(benchmark, tmp_path, years):
+    """Replacing one day within climate files of increasing length."""
+    rng = np.random.default_rng(0)
+    nfiles = 20
+    fns = []
+    for i in range(nfiles):
+        fn = str(tmp_path / f"{i}.cli")
+        make_clifile(
+            fn,
+            datetime.date(VALID.year - years + 1, 1, 1),
+            datetime.date(VALID.year, 12, 31),
+            rng,
+        )
+        fns.append(fn)
+    data = empty_tile((1, nfiles))
+    data["precip"][:] = make_precip(30 * 24, 0.1, rng, (1, nfiles))
+    data["bp"] = compute_tile_breakpoints(data["precip"])
+
+    def _run():
+        return [
+            edit_clifile(xidx, 0, fn, data, VALID)
+            for xidx, fn in enumerate(fns)
+        ]
+
+    assert all(benchmark(_run))
+    report_rate(benchmark, nfiles, "files")
+
+
+@pytest.mark.parametrize("frames", [8, 32])
+def test_load_precip(benchmark, tmp_path, monkeypatch, frames):
+    """Decoding the a2m images of a one degree tile."""
+    rng = np.random.default_rng(0)
+    tile_bounds = compute_tile_bounds(30, 10, 1)
+    images = make_a2m_frames((100, 100), 0.25, rng, frames)
+    fns = [None] * (30 * 24)
+    for tidx in range(frames):
+        fns[tidx * 2] = str(tmp_path / f"a2m_{tidx}.png")
+        write_a2m_png(fns[tidx * 2], images[tidx], tile_bounds)
+    monkeypatch.setattr(
+        daily_clifile_editor, "a2m_filenames", lambda valid: (fns, True)
+    )
+    data = empty_tile((100, 100))
+    benchmark(load_precip, data, VALID, tile_bounds)
+    report_rate(benchmark, frames, "files")
+
+
+@pytest.mark.parametrize("sparse", [False, True])
+@pytest.mark.parametrize("size", [100, 250])
+def test_frame_precip(benchmark, size, sparse):
+    """Converting a `weather_cube` tile's a2m frames to precip."""
+    tile = {
+        "frames": np.ones(30 * 24, bool),
+        "a2m": make_a2m_frames((size, size), 0.1, np.random.default_rng(0)),
+    }
+
+    def _run():
+        frame_precip(empty_tile((size, size), sparse), tile, VALID)
+
+    benchmark(_run)
+    report_rate(benchmark, size * size, "cells")
@@ -0,0 +1,260 @@
+"""Day-offset index sidecar for .cli files.
+
+The sidecar lives next to the climate file as ``<clifile>.idx.npy`` and maps
+each day to the byte offset and length of that day's record (the daily line
+plus its breakpoint lines).  Row zero of the index is special and holds the
+ordinal of the first date in the file and the file size, which is checked to
+detect a file edited without the index being updated.
+
+With the index, reading or replacing one day is an `os.pread` / `os.pwrite`
+of the bytes involved, plus a shift of whatever follows the edited day,
+instead of reading and rewriting the whole file.
+"""
+import datetime
+import os
+
+import numpy as np
+
+INDEX_DTYPE = np.dtype([("offset", "i8"), ("length", "i8")])
+
+
+def get_index_fname(clifn):
+    """Return the sidecar filename for this climate file."""
+    return f"{clifn}.idx.npy"
+
+
+def dayprefix(valid):
+    """Return the bytes that a day's record starts with."""
+    return f"{valid.day}\t{valid.month}\t{valid.year}\t".encode("ascii")
+
+
+def parse_records(lines, offset):
+    """Yield (date ordinal, byte offset, byte length) of each daily record.
+
+    Args:
+      lines (list): bytes lines starting with a daily record.
+      offset (int): the byte offset of the first line.
+    """
+    linenum = 0
+    while linenum < len(lines):
+        tokens = lines[linenum].split()
+        if len(tokens) < 4:
+            offset += len(lines[linenum])
+            linenum += 1
+            continue
+        valid = datetime.date(int(tokens[2]), int(tokens[1]), int(tokens[0]))
+        bpcount = int(tokens[3])
+        length = sum(
+            len(line) for line in lines[linenum : linenum + bpcount + 1]
+        )
+        yield valid.toordinal(), offset, length
+        offset += length
+        linenum += bpcount + 1
+
+
+def build_index(clifn):
+    """Parse the climate file and write its sidecar index."""
+    with open(clifn, "rb") as fh:
+        lines = fh.readlines()
+    days = list(parse_records(lines[15:], sum(len(x) for x in lines[:15])))
+    if not days:
+        raise ValueError(f"{clifn} has no daily data")
+    sts = days[0][0]
+    index = np.zeros(days[-1][0] - sts + 2, INDEX_DTYPE)
+    index["length"][1:] = -1
+    index["offset"][0] = sts
+    index["length"][0] = sum(len(line) for line in lines)
+    for ordinal, dayoffset, length in days:
+        index[ordinal - sts + 1] = (dayoffset, length)
+    save_index(clifn, index)
+    return index
+
+
+def save_index(clifn, index):
+    """Atomically write the sidecar index."""
+    idxfn = get_index_fname(clifn)
+    with open(f"{idxfn}.tmp", "wb") as fh:
+        np.save(fh, index)
+    os.rename(f"{idxfn}.tmp", idxfn)
+
+
+def load_index(clifn):
+    """Return the index for this climate file, (re)building when stale."""
+    idxfn = get_index_fname(clifn)
+    if os.path.isfile(idxfn):
+        index = np.load(idxfn)
+        if index[0]["length"] == os.path.getsize(clifn):
+            return index
+    return build_index(clifn)
+
+
+def _lookup(index, valid):
+    """Return the index row for this date or None."""
+    row = valid.toordinal() - index[0]["offset"] + 1
+    if row < 1 or row >= index.shape[0] or index[row]["length"] < 0:
+        return None
+    return row
+
+
+def _verified(fd, clifn, valid, index):
+    """Return the index after making sure the row points at this date."""
+    for attempt in range(2):
+        row = _lookup(index, valid)
+        if row is None:
+            return index, None
+        prefix = dayprefix(valid)
+        if os.pread(fd, len(prefix), int(index[row]["offset"])) == prefix:
+            return index, row
+        if attempt == 0:
+            index = build_index(clifn)
+    raise ValueError(f"{clifn} index does not agree with file for {valid}")
+
+
+def has_day(clifn, valid):
+    """Does this climate file have data for the given date."""
+    return _lookup(load_index(clifn), valid) is not None
+
+
+def read_days(clifn, sts, ets=None):
+    """Return the text of the records for dates sts through ets (inclusive)."""
+    ets = sts if ets is None else ets
+    index = load_index(clifn)
+    fd = os.open(clifn, os.O_RDONLY)
+    try:
+        index, row1 = _verified(fd, clifn, sts, index)
+        index, row2 = _verified(fd, clifn, ets, index)
+        if row1 is None or row2 is None:
+            return None
+        start = int(index[row1]["offset"])
+        end = int(index[row2]["offset"] + index[row2]["length"])
+        return os.pread(fd, end - start, start).decode("ascii")
+    finally:
+        os.close(fd)
+
+
+def splice(fd, pos, oldlen, newdata, size):
+    """Replace `oldlen` bytes at `pos` with `newdata`, return the new size."""
+    delta = len(newdata) - oldlen
+    if delta == 0:
+        os.pwrite(fd, newdata, pos)
+        return size
+    tail = os.pread(fd, size - (pos + oldlen), pos + oldlen)
+    os.pwrite(fd, newdata + tail, pos)
+    if delta < 0:
+        os.ftruncate(fd, size + delta)
+    return size + delta
+
+
+def replace_day(clifn, valid, text):
+    """Replace the record for the given date with `text`.
+
+    Returns:
+      bool for if the date was found
+    """
+    index = load_index(clifn)
+    newdata = text.encode("ascii")
+    fd = os.open(clifn, os.O_RDWR)
+    try:
+        index, row = _verified(fd, clifn, valid, index)
+        if row is None:
+            return False
+        oldlen = int(index[row]["length"])
+        index["length"][0] = splice(
+            fd,
+            int(index[row]["offset"]),
+            oldlen,
+            newdata,
+            int(index[0]["length"]),
+        )
+    finally:
+        os.close(fd)
+    index["length"][row] = len(newdata)
+    index["offset"][row + 1 :] += len(newdata) - oldlen
+    save_index(clifn, index)
+    return True
+
+
+def replace_header_line(clifn, linenum, line):
+    """Replace one of the 15 header lines of the climate file."""
+    index = load_index(clifn)
+    fd = os.open(clifn, os.O_RDWR)
+    try:
+        header = os.pread(fd, int(index[1]["offset"]), 0)
+        lines = header.splitlines(True)
+        pos = sum(len(x) for x in lines[:linenum])
+        newdata = line.encode("ascii")
+        oldlen = len(lines[linenum])
+        index["length"][0] = splice(
+            fd, pos, oldlen, newdata, int(index[0]["length"])
+        )
+    finally:
+        os.close(fd)
+    index["offset"][1:] += len(newdata) - oldlen
+    save_index(clifn, index)
+
+
+def truncate_days(clifn, valid):
+    """Remove the given date and everything following it."""
+    index = load_index(clifn)
+    fd = os.open(clifn, os.O_RDWR)
+    try:
+        index, row = _verified(fd, clifn, valid, index)
+        if row is None:
+            return
+        size = int(index[row]["offset"])
+        os.ftruncate(fd, size)
+    finally:
+        os.close(fd)
+    index = index[:row].copy()
+    index["length"][0] = size
+    save_index(clifn, index)
+
+
+def append_days(clifn, text):
+    """Append the records in `text`, which must follow the last date."""
+    index = load_index(clifn)
+    newdata = text.encode("ascii")
+    size = int(index[0]["length"])
+    fd = os.open(clifn, os.O_RDWR)
+    try:
+        os.pwrite(fd, newdata, size)
+    finally:
+        os.close(fd)
+    sts = int(index[0]["offset"])
+    days = list(parse_records(newdata.splitlines(True), size))
+    newindex = np.zeros(
+        max(index.shape[0], days[-1][0] - sts + 2), INDEX_DTYPE
+    )
+    newindex["length"][index.shape[0] :] = -1
+    newindex[: index.shape[0]] = index
+    for ordinal, dayoffset, length in days:
+        newindex[ordinal - sts + 1] = (dayoffset, length)
+    newindex["length"][0] = size + len(newdata)
+    save_index(clifn, newindex)
+
+
+def test_replace_day(tmp_path):
+    """Test that we can splice a day into the middle of a file."""
+    lines = [f"header {i}\n" for i in range(15)]
+    lines.extend(
+        [
+            "1\t1\t2007\t0\t-3.2\t-10.0\t 150\t 4.1\t0\t-12.3\n",
+            "2\t1\t2007\t2\t1.0\t-5.0\t 200\t 2.0\t0\t-8.0\n",
+            "05.0333 0.00\n",
+            "05.5000 6.35\n",
+            "3\t1\t2007\t0\t1.0\t-5.0\t 200\t 2.0\t0\t-8.0\n",
+        ]
+    )
+    clifn = str(tmp_path / "test.cli")
+    with open(clifn, "w", encoding="ascii") as fh:
+        fh.write("".join(lines))
+    newday = "1\t1\t2007\t1\t-3.2\t-10.0\t 150\t 4.1\t0\t-12.3\n01.0000 0.0\n"
+    assert replace_day(clifn, datetime.date(2007, 1, 1), newday)
+    assert read_days(clifn, datetime.date(2007, 1, 3)) == lines[-1]
+    assert not replace_day(clifn, datetime.date(2007, 1, 4), newday)
+    # An edit made without the index is detected
+    with open(clifn, "a", encoding="ascii") as fh:
+        fh.write("4\t1\t2007\t0\t1.0\t-5.0\t 200\t 2.0\t0\t-8.0\n")
+    assert has_day(clifn, datetime.date(2007, 1, 4))
+    with open(clifn, encoding="ascii") as fh:
+        assert fh.read().find(newday) > 0
@@ -0,0 +1,544 @@
+"""Binary columnar storage of DEP climate file data.
+
+Every 0.25 degree block of climate file points gets its own directory within
+``/i/<scenario>/clistore`` containing the following:
+
+- ``meta.json`` cell names, start date, number of days and .cli headers
+- ``daily.npy`` (cells, days) memory-mapped structured array of daily fields
+- ``index.npy`` (cells, days) offset and count into the breakpoint heap
+- ``bp.dat`` append-only heap of (hour, accum) breakpoint records
+
+A daily update is then a slice write into ``daily.npy`` and ``index.npy`` plus
+an append to ``bp.dat``, instead of a read and rewrite of the full text file.
+WEPP still wants text, so `export_block` renders .cli files on demand.  Any
+rewrite of a day orphans its previous breakpoint records, which `compact`
+drops.
+
+The store is opt-in and not yet part of the nightly REALTIME.sh, which edits
+the .cli files.  To use it, run ``proctor_tile_edit.py`` with ``store``, then
+``export`` prior to the WEPP runs and ``compact`` now and then.
+
+Usage:
+    python clifile_store.py import <scenario>
+    python clifile_store.py export <scenario>
+    python clifile_store.py compact <scenario>
+"""
+import datetime
+import glob
+import json
+import math
+import os
+import re
+import sys
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+from pyiem.dep import get_cli_fname, read_cli
+from pyiem.util import logger
+
+LOG = logger()
+BLOCKSIZE = 25  # hundredths of a degree
+STS = datetime.date(2007, 1, 1)
+DAILY_DTYPE = np.dtype(
+    [
+        ("high", "f4"),
+        ("low", "f4"),
+        ("solar", "f4"),
+        ("wind", "f4"),
+        ("wdir", "f4"),
+        ("dwpt", "f4"),
+    ]
+)
+INDEX_DTYPE = np.dtype([("offset", "i8"), ("count", "i2")])
+BP_DTYPE = np.dtype([("hour", "f4"), ("accum", "f4")])
+CLIFN_RE = re.compile(
+    r"/i/(?P<scenario>[0-9]+)/cli/[0-9]{3}x[0-9]{3}/"
+    r"(?P<lon>[0-9.]+)x(?P<lat>[0-9.]+)\.cli$"
+)
+
+
+def get_block_name(lon, lat):
+    """Return the name of the 0.25 degree block containing this point."""
+    west = math.floor(round(lon * 100.0) / BLOCKSIZE) * BLOCKSIZE / 100.0
+    south = math.floor(round(lat * 100.0) / BLOCKSIZE) * BLOCKSIZE / 100.0
+    return f"{(0 - west):06.2f}x{south:06.2f}"
+
+
+def get_block_dir(lon, lat, scenario=0):
+    """Return the store directory for the block containing this point."""
+    return f"/i/{scenario}/clistore/{get_block_name(lon, lat)}"
+
+
+def get_cell_name(lon, lat):
+    """Return the cell name, which matches the .cli filename."""
+    return os.path.basename(get_cli_fname(lon, lat))[:-4]
+
+
+def parse_cell_name(name):
+    """Convert a cell name into lon, lat."""
+    tokens = name.split("x")
+    return 0 - float(tokens[0]), float(tokens[1])
+
+
+def expand_ranges(starts, counts):
+    """Return the flat indices covered by these (start, count) ranges."""
+    counts = np.asarray(counts, np.int64)
+    take = np.repeat(np.asarray(starts) - (np.cumsum(counts) - counts), counts)
+    return take + np.arange(take.size)
+
+
+def years_header(lat, lon, years):
+    """Return the .cli header line denoting the years simulated."""
+    return (
+        "    %.2f   %.2f         289          %i        2007"
+        "              %i\n"
+    ) % (lat, lon, years, years)
+
+
+def dayline(valid, bpcount, row):
+    """Return the .cli daily line, matching `daily_clifile_editor`."""
+    return (
+        f"{valid.day}\t{valid.month}\t{valid.year}\t{bpcount}\t"
+        f"{row['high']:3.1f}\t{row['low']:3.1f}\t{row['solar']:4.0f}\t"
+        f"{row['wind']:4.1f}\t{row['wdir']:.0f}\t{row['dwpt']:4.1f}\n"
+    )
+
+
+class CliBlock:
+    """A memory-mapped block of climate file data."""
+
+    def __init__(self, path, mode="r"):
+        """Open an existing block, mode is either `r` or `r+`."""
+        self.path = path
+        self.mode = mode
+        with open(f"{path}/meta.json", encoding="utf8") as fh:
+            self.meta = json.load(fh)
+        self.sts = datetime.date.fromisoformat(self.meta["sts"])
+        self.cells = {name: i for i, name in enumerate(self.meta["cells"])}
+        self.daily = np.load(f"{path}/daily.npy", mmap_mode=mode)
+        self.index = np.load(f"{path}/index.npy", mmap_mode=mode)
+        self._bp = None
+
+    @classmethod
+    def create(cls, path, cells, headers, ndays, sts=STS):
+        """Create a new and empty block on disk."""
+        os.makedirs(path, exist_ok=True)
+        shp = (len(cells), ndays)
+        daily = np.lib.format.open_memmap(
+            f"{path}/daily.npy", "w+", DAILY_DTYPE, shp
+        )
+        for name in DAILY_DTYPE.names:
+            daily[name] = np.nan
+        daily.flush()
+        index = np.lib.format.open_memmap(
+            f"{path}/index.npy", "w+", INDEX_DTYPE, shp
+        )
+        index.flush()
+        open(f"{path}/bp.dat", "wb").close()
+        meta = {
+            "sts": sts.isoformat(),
+            "ndays": ndays,
+            "cells": list(cells),
+            "headers": list(headers),
+        }
+        with open(f"{path}/meta.json", "w", encoding="utf8") as fh:
+            json.dump(meta, fh)
+        return cls(path, "r+")
+
+    @property
+    def bp(self):
+        """The breakpoint heap, memory-mapped on first usage."""
+        if self._bp is None:
+            if os.path.getsize(f"{self.path}/bp.dat") == 0:
+                self._bp = np.zeros(0, BP_DTYPE)
+            else:
+                self._bp = np.memmap(f"{self.path}/bp.dat", BP_DTYPE, "r")
+        return self._bp
+
+    def day_index(self, valid):
+        """Return the day offset for this date."""
+        return (valid - self.sts).days
+
+    def lonlats(self):
+        """Return arrays of the cell longitudes and latitudes."""
+        pts = [parse_cell_name(name) for name in self.meta["cells"]]
+        return np.array([p[0] for p in pts]), np.array([p[1] for p in pts])
+
+    def _write_meta(self):
+        """Save the metadata."""
+        with open(f"{self.path}/meta.json", "w", encoding="utf8") as fh:
+            json.dump(self.meta, fh)
+
+    def _append_bp(self, hours, accums):
+        """Append records to the breakpoint heap, return the start offset."""
+        records = np.empty(len(hours), BP_DTYPE)
+        records["hour"] = hours
+        records["accum"] = accums
+        with open(f"{self.path}/bp.dat", "ab") as fh:
+            offset = fh.tell() // BP_DTYPE.itemsize
+            fh.write(records.tobytes())
+        self._bp = None
+        return offset
+
+    def extend(self, ndays):
+        """Grow the day capacity of this block, happens once a year."""
+        if ndays <= self.meta["ndays"]:
+            return
+        for name, dtype in [("daily", DAILY_DTYPE), ("index", INDEX_DTYPE)]:
+            old = getattr(self, name)
+            new = np.lib.format.open_memmap(
+                f"{self.path}/{name}.npy.tmp",
+                "w+",
+                dtype,
+                (old.shape[0], ndays),
+            )
+            if name == "daily":
+                for field in DAILY_DTYPE.names:
+                    new[field] = np.nan
+            new[:, : old.shape[1]] = old
+            new.flush()
+            del new
+            os.rename(f"{self.path}/{name}.npy.tmp", f"{self.path}/{name}.npy")
+            setattr(
+                self, name, np.load(f"{self.path}/{name}.npy", mmap_mode="r+")
+            )
+        self.meta["ndays"] = ndays
+        self._write_meta()
+
+    def write_day(self, valid, cells, daily, counts, hours, accums):
+        """Write one day of data for many cells.
+
+        Args:
+          valid (date): the date to write.
+          cells (array-like): cell indices to write.
+          daily (dict): arrays of the `DAILY_DTYPE` fields for each cell.
+          counts (array-like): number of breakpoints for each cell.
+          hours (array-like): flat breakpoint times in decimal hours.
+          accums (array-like): flat breakpoint accumulations in mm.
+        """
+        tidx = self.day_index(valid)
+        if tidx >= self.meta["ndays"]:
+            self.extend(self.day_index(datetime.date(valid.year + 1, 1, 1)))
+        cells = np.asarray(cells)
+        counts = np.asarray(counts)
+        offset = self._append_bp(hours, accums)
+        for name in DAILY_DTYPE.names:
+            self.daily[name][cells, tidx] = daily.get(name, 0)
+        self.index["offset"][cells, tidx] = offset + np.cumsum(counts) - counts
+        self.index["count"][cells, tidx] = counts
+
+    def read_day(self, cell, valid):
+        """Return the daily row and breakpoint records for one cell."""
+        tidx = self.day_index(valid)
+        idx = self.index[cell, tidx]
+        return (
+            self.daily[cell, tidx],
+            self.bp[idx["offset"] : idx["offset"] + idx["count"]],
+        )
+
+    def copy_year(self, analogyear, newyear):
+        """Duplicate a year's worth of data, records in the heap are shared."""
+        sidx = self.day_index(datetime.date(analogyear, 1, 1))
+        eidx = self.day_index(datetime.date(analogyear + 1, 1, 1))
+        nidx = self.day_index(datetime.date(newyear, 1, 1))
+        self.extend(nidx + (eidx - sidx))
+        self.daily[:, nidx : nidx + (eidx - sidx)] = self.daily[:, sidx:eidx]
+        self.index[:, nidx : nidx + (eidx - sidx)] = self.index[:, sidx:eidx]
+        years = newyear - self.sts.year + 1
+        for i, name in enumerate(self.meta["cells"]):
+            lon, lat = parse_cell_name(name)
+            lines = self.meta["headers"][i].splitlines(True)
+            lines[4] = years_header(lat, lon, years)
+            self.meta["headers"][i] = "".join(lines)
+        self._write_meta()
+
+    def compact(self):
+        """Rewrite the breakpoint heap without orphaned records.
+
+        Returns:
+          int number of records dropped.
+        """
+        index = np.array(self.index)
+        live = index["count"] > 0
+        offsets = index["offset"][live]
+        counts = index["count"][live].astype(np.int64)
+        dropped = len(self.bp) - int(counts.sum())
+        if dropped == 0:
+            return 0
+        records = np.array(self.bp[expand_ranges(offsets, counts)])
+        index["offset"][live] = np.cumsum(counts) - counts
+        records.tofile(f"{self.path}/bp.dat.tmp")
+        os.rename(f"{self.path}/bp.dat.tmp", f"{self.path}/bp.dat")
+        self.index[:] = index
+        self.index.flush()
+        self._bp = None
+        return dropped
+
+    def valid_days(self, cell):
+        """Return the day indices with data for this cell."""
+        return np.nonzero(~np.isnan(self.daily["high"][cell]))[0]
+
+    def render(self, cell):
+        """Return the WEPP .cli file content for this cell."""
+        tidx = self.valid_days(cell)
+        index = self.index[cell, tidx]
+        records = self.bp[expand_ranges(index["offset"], index["count"])]
+        lines = [
+            f"{hour:07.4f} {accum:.2f}\n"
+            for hour, accum in zip(
+                records["hour"].tolist(), records["accum"].tolist()
+            )
+        ]
+        res = [self.meta["headers"][cell]]
+        pos = 0
+        for i, count in enumerate(index["count"].tolist()):
+            valid = self.sts + datetime.timedelta(days=int(tidx[i]))
+            res.append(dayline(valid, count, self.daily[cell, tidx[i]]))
+            res.extend(lines[pos : pos + count])
+            pos += count
+        return "".join(res)
+
+    def to_dataframe(self, cell):
+        """Return a `pyiem.dep.read_cli` like DataFrame for this cell."""
+        tidx = self.valid_days(cell)
+        daily = self.daily[cell, tidx]
+        index = self.index[cell, tidx]
+        counts = index["count"].astype(np.int64)
+        records = self.bp[expand_ranges(index["offset"], counts)]
+        # the last accumulation of the day is the daily total
+        ends = np.cumsum(counts)
+        pcpn = np.zeros(tidx.size)
+        pcpn[counts > 0] = records["accum"][ends[counts > 0] - 1]
+        # max rate between consecutive breakpoints of the same day
+        with np.errstate(divide="ignore", invalid="ignore"):
+            rate = np.diff(records["accum"]) / np.diff(records["hour"])
+        # rates spanning two days are not of interest
+        sameday = np.ones(rate.size, bool)
+        last = ends[counts > 0] - 1
+        sameday[last[last < rate.size]] = False
+        rate = np.where(sameday & ~np.isnan(rate), rate, 0)
+        maxr = np.zeros(tidx.size)
+        multi = counts > 1
+        if multi.any():
+            maxr[multi] = np.maximum(
+                np.maximum.reduceat(rate, (ends - counts)[multi]), 0
+            )
+        return pd.DataFrame(
+            {
+                "tmax": daily["high"],
+                "tmin": daily["low"],
+                "rad": daily["solar"],
+                "wvl": daily["wind"],
+                "wdir": daily["wdir"],
+                "tdew": daily["dwpt"],
+                "maxr": maxr,
+                "bpcount": counts,
+                "pcpn": pcpn,
+                "rfactor": np.nan,
+            },
+            index=pd.DatetimeIndex(
+                [self.sts + datetime.timedelta(days=int(t)) for t in tidx]
+            ),
+        )
+
+
+def open_cell(fn, mode="r"):
+    """Find the block and cell index storing this .cli filename.
+
+    Returns:
+      (CliBlock, int) or (None, None) when not within the store.
+    """
+    m = CLIFN_RE.search(os.path.abspath(fn))
+    if not m:
+        return None, None
+    d = m.groupdict()
+    lon, lat = 0 - float(d["lon"]), float(d["lat"])
+    blockdir = get_block_dir(lon, lat, d["scenario"])
+    if not os.path.isfile(f"{blockdir}/meta.json"):
+        return None, None
+    block = CliBlock(blockdir, mode)
+    cell = block.cells.get(f"{d['lon']}x{d['lat']}")
+    if cell is None:
+        return None, None
+    return block, cell
+
+
+def read_clilines(fn):
+    """Return the lines of this .cli file, preferring the climate store."""
+    block, cell = open_cell(fn)
+    if block is not None:
+        return block.render(cell).splitlines(True)
+    with open(fn, encoding="utf8") as fh:
+        return fh.readlines()
+
+
+def read_clidf(fn):
+    """Return a `pyiem.dep.read_cli` DataFrame, preferring the store."""
+    block, cell = open_cell(fn)
+    if block is not None:
+        return block.to_dataframe(cell)
+    return read_cli(fn)
+
+
+def parse_clitext(lines, sts=STS):
+    """Parse .cli text lines into arrays suitable for a `CliBlock`.
+
+    Returns:
+      header (str), day indices, daily (dict), counts, hours, accums
+    """
+    linenum = 15
+    tidx = []
+    daily = {name: [] for name in DAILY_DTYPE.names}
+    counts = []
+    hours = []
+    accums = []
+    while linenum < len(lines):
+        tokens = lines[linenum].split()
+        if len(tokens) < 10:
+            linenum += 1
+            continue
+        valid = datetime.date(int(tokens[2]), int(tokens[1]), int(tokens[0]))
+        tidx.append((valid - sts).days)
+        for name, token in zip(DAILY_DTYPE.names, tokens[4:10]):
+            daily[name].append(float(token))
+        bpcount = int(tokens[3])
+        counts.append(bpcount)
+        for line in lines[linenum + 1 : linenum + 1 + bpcount]:
+            tokens = line.split()
+            hours.append(float(tokens[0]))
+            accums.append(float(tokens[1]))
+        linenum += bpcount + 1
+    return (
+        "".join(lines[:15]),
+        np.array(tidx, int),
+        {k: np.array(v) for k, v in daily.items()},
+        np.array(counts, int),
+        np.array(hours),
+        np.array(accums),
+    )
+
+
+def import_block(blockdir, filenames):
+    """Create a block from the given .cli files."""
+    parsed = []
+    for fn in filenames:
+        with open(fn, encoding="utf8") as fh:
+            parsed.append(parse_clitext(fh.readlines()))
+    ndays = max(int(p[1].max()) + 1 for p in parsed if p[1].size)
+    block = CliBlock.create(
+        blockdir,
+        [os.path.basename(fn)[:-4] for fn in filenames],
+        [p[0] for p in parsed],
+        ndays,
+    )
+    for cell, (_, tidx, daily, counts, hours, accums) in enumerate(parsed):
+        offset = block._append_bp(hours, accums)
+        for name in DAILY_DTYPE.names:
+            block.daily[name][cell, tidx] = daily[name]
+        block.index["offset"][cell, tidx] = offset + np.cumsum(counts) - counts
+        block.index["count"][cell, tidx] = counts
+    block.daily.flush()
+    block.index.flush()
+    return block
+
+
+def export_block(blockdir, scenario):
+    """Render all .cli files for this block, just prior to a WEPP run."""
+    block = CliBlock(blockdir)
+    for cell, name in enumerate(block.meta["cells"]):
+        fn = get_cli_fname(*parse_cell_name(name), scenario)
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+        with open(f"{fn}.tmp", "w", encoding="utf8") as fh:
+            fh.write(block.render(cell))
+        os.rename(f"{fn}.tmp", fn)
+    return len(block.meta["cells"])
+
+
+def main(argv):
+    """Go Main Go."""
+    if len(argv) != 3 or argv[1] not in ["import", "export", "compact"]:
+        print(
+            "Usage: python clifile_store.py <import|export|compact> <scenario>"
+        )
+        return
+    scenario = int(argv[2])
+    if argv[1] == "import":
+        blocks = {}
+        for fn in glob.glob(f"/i/{scenario}/cli/*/*.cli"):
+            lon, lat = parse_cell_name(os.path.basename(fn)[:-4])
+            blocks.setdefault(get_block_name(lon, lat), []).append(fn)
+        for name, filenames in tqdm(
+            blocks.items(), disable=not sys.stdout.isatty()
+        ):
+            import_block(f"/i/{scenario}/clistore/{name}", sorted(filenames))
+        LOG.info("imported %s blocks", len(blocks))
+        return
+    if argv[1] == "compact":
+        dropped = 0
+        for blockdir in tqdm(
+            glob.glob(f"/i/{scenario}/clistore/*"),
+            disable=not sys.stdout.isatty(),
+        ):
+            dropped += CliBlock(blockdir, "r+").compact()
+        LOG.info("dropped %s orphaned breakpoint records", dropped)
+        return
+    total = 0
+    for blockdir in tqdm(
+        glob.glob(f"/i/{scenario}/clistore/*"),
+        disable=not sys.stdout.isatty(),
+    ):
+        total += export_block(blockdir, scenario)
+    LOG.info("exported %s .cli files", total)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_block_name():
+    """Test our block naming."""
+    assert get_block_name(-95.51, 42.10) == "095.75x042.00"
+    assert get_block_name(-95.50, 42.25) == "095.50x042.25"
+
+
+def test_roundtrip(tmp_path):
+    """Test that a .cli file survives the trip through the store."""
+    lines = [f"header {i}\n" for i in range(15)]
+    lines.extend(
+        [
+            "1\t1\t2007\t0\t-3.2\t-10.0\t 150\t 4.1\t0\t-12.3\n",
+            "2\t1\t2007\t2\t1.0\t-5.0\t 200\t 2.0\t0\t-8.0\n",
+            "05.0333 0.00\n",
+            "05.5000 6.35\n",
+        ]
+    )
+    fn = tmp_path / "095.50x042.10.cli"
+    fn.write_text("".join(lines))
+    block = import_block(str(tmp_path / "store"), [str(fn)])
+    assert block.render(0) == "".join(lines)
+    block.write_day(
+        datetime.date(2007, 1, 1),
+        [0],
+        {"high": [5.0], "low": [1.0], "solar": [100], "wind": [1], "dwpt": 0},
+        [2],
+        [1.0, 2.0],
+        [0, 2.5],
+    )
+    df = CliBlock(str(tmp_path / "store")).to_dataframe(0)
+    assert abs(df["pcpn"].iloc[0] - 2.5) < 0.01
+    assert abs(df["maxr"].iloc[1] - 6.35 / 0.4667) < 0.01
+    # Rewriting the day orphans its previous breakpoints
+    block.write_day(
+        datetime.date(2007, 1, 1),
+        [0],
+        {"high": [5.0], "low": [1.0], "solar": [100], "wind": [1], "dwpt": 0},
+        [2],
+        [1.0, 2.0],
+        [0, 2.5],
+    )
+    assert block.compact() == 2
+    assert block.compact() == 0
+    df = CliBlock(str(tmp_path / "store")).to_dataframe(0)
+    assert abs(df["pcpn"].iloc[0] - 2.5) < 0.01
+    assert abs(df["maxr"].iloc[1] - 6.35 / 0.4667) < 0.01
@@ -2,9 +2,13 @@
 
 Usage:
     python daily_climate_editor.py <xtile> <ytile> <tilesz>
-        <scenario> <YYYY> <mm> <dd>
+        <scenario> <YYYY> <mm> <dd> [store] [sparse]
 
-Where tiles start in the lower left corner and are 5x5 deg in size
+Where tiles start in the lower left corner and are 5x5 deg in size.  The
+optional `store` argument writes to the binary climate store (see
+clifile_store.py) instead of editing the .cli files in place.  The optional
+`sparse` argument only keeps the precip of the wet cells in memory (see
+sparse_precip.py).
 
 development laptop has data for 3 March 2019, 23 May 2009, and 8 Jun 2009
 
@@ -15,6 +19,7 @@ except ImportError:
     from backports.zoneinfo import ZoneInfo
 from collections import namedtuple
 import datetime
+import glob
 import sys
 import os
 from multiprocessing import cpu_count
@@ -22,11 +27,15 @@ from multiprocessing.pool import ThreadPool
 
 from tqdm import tqdm
 import numpy as np
-from scipy.interpolate import NearestNDInterpolator
 from osgeo import gdal
 from pyiem import iemre
 from pyiem.dep import SOUTH, WEST, NORTH, EAST, get_cli_fname
 from pyiem.util import ncopen, logger, convert_value, utc
+from clifile_index import has_day, replace_day
+from clifile_store import CliBlock, expand_ranges, parse_cell_name
+from frame_cache import open_cache
+from regrid_index import get_index, regrid, tile_slices
+from sparse_precip import SparsePrecip
 
 LOG = logger()
 CENTRAL = ZoneInfo("America/Chicago")
@@ -35,9 +44,12 @@ ST4PATH = "/mesonet/data/stage4"
 # used for breakpoint logic
 ZEROHOUR = datetime.datetime(2000, 1, 1, 0, 0)
 # How many CPUs are we going to burn
-CPUCOUNT = min([4, int(cpu_count() / 4)])
+CPUCOUNT = max(1, min([4, int(cpu_count() / 4)]))
 MEMORY = {"stamp": datetime.datetime.now()}
 BOUNDS = namedtuple("Bounds", ["south", "north", "east", "west"])
+BREAKPOINTS = namedtuple("Breakpoints", ["start", "count", "minute", "accum"])
+# Number of cells to interpolate at once in the legacy precip workflow
+INTERP_CELLS = 128
 
 
 def get_sts_ets_at_localhour(date, local_hour):
@@ -86,15 +98,17 @@ def iemre_bounds_check(name, val, lower, upper):
     return val
 
 
-def load_iemre(nc, data, valid):
+def load_iemre(nc, data, valid, tile_bounds=None):
     """Use IEM Reanalysis for non-precip data
 
-    24km product is smoothed down to the 0.01 degree grid
+    24km product is smoothed down to the 0.01 degree grid, which is the whole
+    DEP domain unless `tile_bounds` is provided.
     """
     offset = iemre.daily_offset(valid)
-    lats = nc.variables["lat"][:]
-    lons = nc.variables["lon"][:]
-    lons, lats = np.meshgrid(lons, lats)
+    lons, lats = np.meshgrid(nc.variables["lon"][:], nc.variables["lat"][:])
+    index = get_index("iemre", lons, lats)
+    if tile_bounds is not None:
+        index = index[tile_slices(tile_bounds)]
 
     # Storage is W m-2, we want langleys per day
     ncdata = (
@@ -104,60 +118,40 @@ def load_iemre(nc, data, valid):
         * 23.9
     )
     # Default to a value of 300 when this data is missing, for some reason
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
     data["solar"][:] = iemre_bounds_check(
-        "rsds", nn(data["lon"], data["lat"]), 0, 1000
+        "rsds", regrid(index, ncdata), 0, 1000
     )
 
     ncdata = convert_value(
         nc.variables["high_tmpk"][offset, :, :].filled(np.nan), "degK", "degC"
     )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
     data["high"][:] = iemre_bounds_check(
-        "high_tmpk", nn(data["lon"], data["lat"]), -60, 60
+        "high_tmpk", regrid(index, ncdata), -60, 60
     )
 
     ncdata = convert_value(
         nc.variables["low_tmpk"][offset, :, :].filled(np.nan), "degK", "degC"
     )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
     data["low"][:] = iemre_bounds_check(
-        "low_tmpk", nn(data["lon"], data["lat"]), -60, 60
+        "low_tmpk", regrid(index, ncdata), -60, 60
     )
 
     ncdata = convert_value(
         nc.variables["avg_dwpk"][offset, :, :].filled(np.nan), "degK", "degC"
     )
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
     data["dwpt"][:] = iemre_bounds_check(
-        "avg_dwpk", nn(data["lon"], data["lat"]), -60, 60
+        "avg_dwpk", regrid(index, ncdata), -60, 60
     )
 
     # Wind is already in m/s, but could be masked
     ncdata = nc.variables["wind_speed"][offset, :, :].filled(np.nan)
-    nn = NearestNDInterpolator(
-        (np.ravel(lons), np.ravel(lats)), np.ravel(ncdata)
-    )
     data["wind"][:] = iemre_bounds_check(
-        "wind_speed", nn(data["lon"], data["lat"]), 0, 30
+        "wind_speed", regrid(index, ncdata), 0, 30
     )
 
 
-def load_stage4(data, valid, xtile, ytile):
-    """It sucks, but we need to load the stage IV data to give us something
-    to benchmark the MRMS data against, to account for two things:
-    1) Wind Farms
-    2) Over-estimates
-    """
-    LOG.debug("called")
+def stage4_totals(valid):
+    """Return the Stage IV lons, lats and 24 hour totals for the date."""
     # The stage4 files store precip in the rears, so compute 1 AM
     one_am, tomorrow = get_sts_ets_at_localhour(valid, 1)
 
@@ -191,12 +185,26 @@ def load_stage4(data, valid, xtile, ytile):
         LOG.info("No StageIV data found, aborting...")
         sys.exit(3)
     # set a small non-zero number to keep things non-zero
-    totals = np.where(totals > 0.001, totals, 0.001)
+    return lons, lats, np.where(totals > 0.001, totals, 0.001)
 
-    nn = NearestNDInterpolator(
-        (lons.flatten(), lats.flatten()), totals.flatten()
-    )
-    data["stage4"][:] = nn(data["lon"], data["lat"])
+
+def regrid_stage4(data, valid, tile_bounds=None):
+    """Set the stage4 grid of the DEP domain, or just of the tile."""
+    lons, lats, totals = stage4_totals(valid)
+    index = get_index("stage4", lons, lats)
+    if tile_bounds is not None:
+        index = index[tile_slices(tile_bounds)]
+    data["stage4"][:] = regrid(index, totals)
+
+
+def load_stage4(data, valid, xtile, ytile, tile_bounds):
+    """It sucks, but we need to load the stage IV data to give us something
+    to benchmark the MRMS data against, to account for two things:
+    1) Wind Farms
+    2) Over-estimates
+    """
+    LOG.debug("called")
+    regrid_stage4(data, valid, tile_bounds)
     write_grid(data["stage4"], valid, xtile, ytile, "stage4")
     LOG.debug("finished")
 
@@ -208,7 +216,7 @@ def qc_precip(data, valid, xtile, ytile):
     Stage IV, then we consider it good.  If not, then we apply a multiplier to
     bring it to near the stage IV value.
     """
-    hires_total = np.sum(data["precip"], 2)
+    hires_total = precip_totals(data["precip"])
     # prevent zeros
     hires_total = np.where(hires_total < 0.01, 0.01, hires_total)
     write_grid(hires_total, valid, xtile, ytile, "inqcprecip")
@@ -219,9 +227,21 @@ def qc_precip(data, valid, xtile, ytile):
         np.logical_and(multiplier > 0.67, multiplier < 1.33), 1.0, multiplier
     )
     write_grid(multiplier, valid, xtile, ytile, "multiplier")
-    data["precip"][:] *= multiplier[:, :, None]
-    data["precip"][np.isnan(data["precip"])] = 0.0
-    write_grid(np.sum(data["precip"], 2), valid, xtile, ytile, "outqcprecip")
+    if isinstance(data["precip"], SparsePrecip):
+        data["precip"].scale(multiplier)
+    else:
+        data["precip"][:] *= multiplier[:, :, None]
+        data["precip"][np.isnan(data["precip"])] = 0.0
+    write_grid(
+        precip_totals(data["precip"]), valid, xtile, ytile, "outqcprecip"
+    )
+
+
+def precip_totals(precip):
+    """Return the (y, x) totals of a dense or `SparsePrecip` cube."""
+    if isinstance(precip, SparsePrecip):
+        return precip.totals()
+    return np.sum(precip, 2)
 
 
 def _reader(filename, tile_bounds):
@@ -232,20 +252,23 @@ def _reader(filename, tile_bounds):
     left = int((tile_bounds.west - -126.0) * 100.0)
 
     imgdata = gdal.Open(filename, 0).ReadAsArray()
+    return n0r_precip(np.flipud(imgdata[top:bottom, left:right]))
+
+
+def n0r_precip(imgdata):
+    """Convert (flipped) N0R composite image data to a precip rate."""
     # Convert the image data to dbz
-    dbz = (np.flipud(imgdata[top:bottom, left:right]) - 7.0) * 5.0
+    dbz = (imgdata - 7.0) * 5.0
     return np.where(dbz < 255, ((10.0 ** (dbz / 10.0)) / 200.0) ** 0.625, 0)
 
 
-def load_precip_legacy(data, valid, tile_bounds):
-    """Compute a Legacy Precip product for dates prior to 1 Jan 2014"""
-    LOG.debug("called")
+def n0r_filenames(valid):
+    """Return the 5 minute (time index, N0R filename) pairs for the date."""
     ts = 12 * 24  # 5 minute
 
     midnight, tomorrow = get_sts_ets_at_localhour(valid, 0)
 
     now = midnight
-    m5 = np.zeros((ts, *data["solar"].shape), np.float16)
     tidx = 0
     filenames = []
     indices = []
@@ -266,54 +289,113 @@ def load_precip_legacy(data, valid, tile_bounds):
 
         now += datetime.timedelta(minutes=5)
         tidx += 1
+    return list(zip(indices, filenames))
+
 
-    for tidx, filename in zip(indices, filenames):
+def load_precip_legacy(data, valid, tile_bounds):
+    """Compute a Legacy Precip product for dates prior to 1 Jan 2014"""
+    LOG.debug("called")
+    m5 = np.zeros((12 * 24, *data["solar"].shape), np.float16)
+    for tidx, filename in n0r_filenames(valid):
         m5[tidx, :, :] = _reader(filename, tile_bounds)
     LOG.debug("finished loading N0R Composites")
-    m5 = np.transpose(m5, (1, 2, 0)).copy()
-    LOG.debug("transposed the data!")
-    m5total = np.sum(m5, 2)
-    LOG.debug("computed sum(m5)")
-    wm5 = m5 / m5total[:, :, None]
-    LOG.debug("computed weights of m5")
+    legacy_precip(data, m5)
 
+
+def legacy_precip(data, m5):
+    """Distribute the Stage IV totals with the (time, y, x) N0R rates.
+
+    This is done in batches of cells, which get the same float16 sums and
+    weights as a per cell computation would.
+    """
     minute2 = np.arange(0, 60 * 24, 2)
     minute5 = np.arange(0, 60 * 24, 5)
 
-    def _compute(yidx, xidx):
-        """expensive computation that needs vectorized, somehow"""
-        s4total = data["stage4"][yidx, xidx]
-        # any stage IV totals less than 0.4mm are ignored, so effectively 0
-        if s4total < 0.4:
-            return
+    # any stage IV totals less than 0.4mm are ignored, so effectively 0
+    wet = ~(data["stage4"] < 0.4)
+    yidx, xidx = np.nonzero(wet)
+    sparse = isinstance(data["precip"], SparsePrecip)
+    if sparse:
+        data["precip"].set_wet(wet)
+    m5 = np.transpose(m5, (1, 2, 0)).copy()
+    LOG.debug("transposed the data!")
+    for start in range(0, yidx.size, INTERP_CELLS):
+        ys = yidx[start : start + INTERP_CELLS]
+        xs = xidx[start : start + INTERP_CELLS]
+        m5cells = m5[ys, xs]
+        wm5 = m5cells / np.sum(m5cells, 1)[:, None]
         # Interpolate weights to a 2 minute interval grid
         # we divide by 2.5 to downscale the 5 minute values to 2 minute
-        weights = np.interp(minute2, minute5, wm5[yidx, xidx, :]) / 2.5
+        weights = interp_rows(minute2, minute5, wm5) / 2.5
         # Now apply the weights to the s4total
-        data["precip"][yidx, xidx, :] = weights * s4total
-
-    for x in range(data["solar"].shape[1]):
-        for y in range(data["solar"].shape[0]):
-            _compute(y, x)
+        weights = weights * data["stage4"][ys, xs, None]
+        if sparse:
+            data["precip"].values[start : start + INTERP_CELLS] = weights
+        else:
+            data["precip"][ys, xs, :] = weights
 
     LOG.debug("finished precip calculation")
 
 
-def load_precip(data, valid, tile_bounds):
-    """Load the 5 minute precipitation data into our ginormus grid"""
-    LOG.debug("called")
-    ts = 30 * 24  # 2 minute
+def interp_rows(x, xp, fp):
+    """Compute `np.interp(x, xp, row)` for every row of the 2D fp.
 
-    midnight, tomorrow = get_sts_ets_at_localhour(valid, 0)
+    Every row shares the same interval lookup, so this is a gather of the
+    interval start points and slopes, done with time as the leading axis.
+    The arithmetic mirrors that of numpy's implementation, so the results
+    are identical.
 
-    top = int((55.0 - tile_bounds.north) * 100.0)
-    bottom = int((55.0 - tile_bounds.south) * 100.0)
-
-    right = int((tile_bounds.east - -130.0) * 100.0)
-    left = int((tile_bounds.west - -130.0) * 100.0)
+    Args:
+      x (array-like): increasing coordinates to evaluate at.
+      xp (array-like): increasing coordinates of the data points.
+      fp (array-like): (rows, xp) data points.
 
+    Returns:
+      (rows, x) array
+    """
+    fp = np.asarray(fp, np.float64).T
+    xp = np.asarray(xp, np.float64)
+    x = np.asarray(x, np.float64)
+    res = np.empty((x.size, fp.shape[1]))
+    # x is sorted, so this is the slice of x within the data points
+    lo, hi = np.searchsorted(x, [xp[0], xp[-1]])
+    res[:lo] = fp[:1]
+    res[hi:] = fp[-1:]
+    j = np.searchsorted(xp, x[lo:hi], side="right") - 1
+    slopes = np.diff(fp, axis=0)
+    slopes /= np.diff(xp)[:, None]
+    vals = res[lo:hi]
+    np.take(slopes, j, axis=0, out=vals)
+    vals *= (x[lo:hi] - xp[j])[:, None]
+    vals += np.take(fp, j, axis=0)
+    # numpy retries from the right end point when the result is NaN
+    bad = np.isnan(vals)
+    if bad.any():
+        retry = np.take(slopes, j, axis=0)
+        retry *= (x[lo:hi] - xp[j + 1])[:, None]
+        retry += np.take(fp, j + 1, axis=0)
+        same = np.take(fp, j, axis=0) == np.take(fp, j + 1, axis=0)
+        retry = np.where(np.isnan(retry) & same, np.take(fp, j, axis=0), retry)
+        vals[bad] = retry[bad]
+    return res.T
+
+
+def a2m_precip(imgdata, valid):
+    """Convert MRMS a2m image data to 2 minute precip [mm]."""
     # Oopsy we discovered a problem
     a2m_divisor = 10.0 if (valid < datetime.date(2015, 1, 1)) else 50.0
+    return np.where(imgdata < 255, imgdata / a2m_divisor, 0)
+
+
+def a2m_filenames(valid):
+    """Return the day's 2 minute MRMS a2m filenames, None when missing.
+
+    Returns:
+      list of filenames, bool if the 75% quorum of files was met
+    """
+    ts = 30 * 24  # 2 minute
+
+    midnight, tomorrow = get_sts_ets_at_localhour(valid, 0)
 
     now = midnight
     # Require at least 75% data coverage, if not, we will abort back to legacy
@@ -335,6 +417,22 @@ def load_precip(data, valid, tile_bounds):
         LOG.info(
             "Failed 75%% quorum with MRMS a2m %.1f, loading legacy", quorum
         )
+    return fns, quorum <= 0
+
+
+def load_precip(data, valid, tile_bounds):
+    """Load the 5 minute precipitation data into our ginormus grid"""
+    LOG.debug("called")
+    ts = 30 * 24  # 2 minute
+
+    top = int((55.0 - tile_bounds.north) * 100.0)
+    bottom = int((55.0 - tile_bounds.south) * 100.0)
+
+    right = int((tile_bounds.east - -130.0) * 100.0)
+    left = int((tile_bounds.west - -130.0) * 100.0)
+
+    fns, quorum = a2m_filenames(valid)
+    if not quorum:
         load_precip_legacy(data, valid, tile_bounds)
         return
     LOG.debug("fns[0]: %s fns[-1]: %s", fns[0], fns[-1])
@@ -352,11 +450,7 @@ def load_precip(data, valid, tile_bounds):
     def _cb(args):
         """write data."""
         tidx, pdata = args
-        data["precip"][:, :, tidx] = np.where(
-            pdata < 255,
-            pdata / a2m_divisor,
-            0,
-        )
+        data["precip"][:, :, tidx] = a2m_precip(pdata, valid)
 
     LOG.debug("starting %s threads to read a2m", CPUCOUNT)
     with ThreadPool(CPUCOUNT) as pool:
@@ -425,6 +519,141 @@ def compute_breakpoint(ar, accumThreshold=2.0, intensityThreshold=1.0):
     return bp
 
 
+def _breakpoint_pass(ar, accum_threshold, intensity_threshold):
+    """Run the `compute_breakpoint` logic over many cells at once.
+
+    The loop is over the time axis, with each step vectorized over the cells,
+    so that the accumulation retains the same dtype and ordering of floating
+    point operations as the scalar implementation.
+
+    Args:
+      ar (np.ndarray): (time, cells) precipitation accumulations.
+      accum_threshold (np.ndarray): per cell accumulation threshold.
+      intensity_threshold (np.ndarray): per cell intensity threshold.
+
+    Returns:
+      (cells, minutes, accums) arrays of breakpoints in time order per cell.
+    """
+    steps, ncells = ar.shape
+    accum = np.zeros(ncells, ar.dtype)
+    lastaccum = np.zeros(ncells, ar.dtype)
+    lasti = np.full(ncells, -1)
+    events = []
+    for i in range(steps):
+        intensity = ar[i]
+        wet = ~(intensity < 0.001)
+        if not wet.any():
+            continue
+        # Need to initialize the breakpoint data
+        first = np.nonzero(wet & (lasti < 0))[0]
+        if first.size:
+            events.append(
+                (first, np.full(first.size, i * 2), np.zeros(first.size))
+            )
+        np.add(accum, intensity, out=accum, where=wet)
+        lasti[wet] = i
+        hit = np.nonzero(
+            wet
+            & (
+                ((accum - lastaccum) > accum_threshold)
+                | (intensity > intensity_threshold)
+            )
+        )[0]
+        if hit.size:
+            lastaccum[hit] = accum[hit]
+            minute = 1439 if (i + 1) == steps else (i + 1) * 2
+            events.append((hit, np.full(hit.size, minute), accum[hit]))
+    flush = np.nonzero((lasti > -1) & (accum != lastaccum))[0]
+    if flush.size:
+        minute = np.where(
+            lasti[flush] + 1 == steps, 1439, (lasti[flush] + 1) * 2
+        )
+        events.append((flush, minute, accum[flush]))
+    if not events:
+        return np.zeros(0, int), np.zeros(0, int), np.zeros(0, ar.dtype)
+    cells, minutes, accums = zip(*events)
+    return (
+        np.concatenate(cells),
+        np.concatenate(minutes),
+        np.concatenate(accums).astype(ar.dtype),
+    )
+
+
+def compute_tile_breakpoints(precip, maxbp=100):
+    """Compute the breakpoint data for every cell of a precipitation cube.
+
+    This is a batched version of `compute_breakpoint`, including the logic
+    previously found within `edit_clifile` that raises the thresholds for any
+    cell that generates `maxbp` or more breakpoints.
+
+    Args:
+      precip (np.ndarray or SparsePrecip): (y, x, time) precipitation
+        accumulations.
+      maxbp (int): number of breakpoints that triggers a threshold increase.
+
+    Returns:
+      BREAKPOINTS with (y, x) `start` and `count` arrays indexing into the
+      flat `minute` and `accum` arrays.
+    """
+    shp = precip.shape[:-1]
+    if isinstance(precip, SparsePrecip):
+        ar = precip.values
+        rowcells = precip.cells
+    else:
+        ar = precip.reshape(-1, precip.shape[-1])
+        rowcells = None
+    # Any total less than (0.01in) is not of concern, might as well be zero
+    todo = np.nonzero(~(np.sum(ar, axis=1) < 0.254))[0]
+    intensity_threshold = 1.0
+    accum_threshold = 2.0
+    results = []
+    while todo.size:
+        cells, minutes, accums = _breakpoint_pass(
+            np.ascontiguousarray(ar[todo].T),
+            accum_threshold,
+            intensity_threshold,
+        )
+        counts = np.bincount(cells, minlength=todo.size)
+        keep = counts[cells] < maxbp
+        results.append((todo[cells[keep]], minutes[keep], accums[keep]))
+        todo = todo[counts >= maxbp]
+        intensity_threshold += 2
+        accum_threshold = intensity_threshold
+        LOG.debug("%s cells >= %s bp t:%s", todo.size, maxbp, accum_threshold)
+    if results:
+        cells, minutes, accums = (np.concatenate(x) for x in zip(*results))
+    else:
+        cells = np.zeros(0, int)
+        minutes = np.zeros(0, int)
+        accums = np.zeros(0, precip.dtype)
+    if rowcells is not None:
+        cells = rowcells[cells]
+    # stable sort retains the time ordering within each cell
+    order = np.argsort(cells, kind="stable")
+    count = np.bincount(cells, minlength=shp[0] * shp[1])
+    start = np.cumsum(count) - count
+    return BREAKPOINTS(
+        start=start.reshape(shp),
+        count=count.reshape(shp),
+        minute=minutes[order].astype(np.int16),
+        accum=accums[order],
+    )
+
+
+def breakpoint_strings(bps, yidx, xidx):
+    """Render the breakpoints for one cell as `compute_breakpoint` would."""
+    sl = slice(
+        bps.start[yidx, xidx], bps.start[yidx, xidx] + bps.count[yidx, xidx]
+    )
+    return [
+        f"{minute // 60:02.0f}.{(minute % 60 / 60. * 10000.):04.0f} "
+        f"{accum:.2f}"
+        for minute, accum in zip(
+            bps.minute[sl].tolist(), bps.accum[sl].tolist()
+        )
+    ]
+
+
 def write_grid(grid, valid, xtile, ytile, fnadd=""):
     """Save off the daily precip totals for usage later in computing huc_12"""
     if fnadd != "" and not sys.stdout.isatty():
@@ -436,52 +665,75 @@ def write_grid(grid, valid, xtile, ytile, fnadd=""):
     np.save(f"{basedir}/{valid:%Y%m%d}{fnadd}.tile_{xtile}_{ytile}", grid)
 
 
+def frame_precip(data, tile, valid):
+    """Compute the precip from a tile's raw a2m or N0R image frames."""
+    frames = np.nonzero(tile["frames"])[0]
+    if "a2m" in tile and isinstance(data["precip"], SparsePrecip):
+        # a2m_precip is zero for the 0 and missing (255) image values
+        wet = np.zeros(data["solar"].shape, bool)
+        for tidx in frames:
+            imgdata = tile["a2m"][tidx]
+            wet |= (imgdata > 0) & (imgdata < 255)
+        data["precip"].set_wet(wet)
+        yidx, xidx = np.nonzero(wet)
+        for tidx in frames:
+            data["precip"].values[:, tidx] = a2m_precip(
+                tile["a2m"][tidx][yidx, xidx], valid
+            )
+    elif "a2m" in tile:
+        for tidx in frames:
+            data["precip"][:, :, tidx] = a2m_precip(tile["a2m"][tidx], valid)
+    else:
+        m5 = np.zeros((12 * 24, *data["solar"].shape), np.float16)
+        for tidx in frames:
+            m5[tidx] = n0r_precip(tile["n0r"][tidx])
+        legacy_precip(data, m5)
+
+
 def precip_workflow(data, valid, xtile, ytile, tile_bounds):
     """Drive the precipitation workflow"""
-    load_stage4(data, valid, xtile, ytile)
-    # We have MRMS a2m RASTER files prior to 1 Jan 2015, but these files used
-    # a very poor choice of data interval of 0.1mm, which is not large enough
-    # to capture low intensity events.  Files after 1 Jan 2015 used a better
-    # 0.02mm resolution
-    if valid.year < 2015:
-        load_precip_legacy(data, valid, tile_bounds)
+    load_stage4(data, valid, xtile, ytile, tile_bounds)
+    cache = open_cache(valid)
+    if cache is not None:
+        ys, xs = tile_slices(tile_bounds)
+        tile = {"frames": cache.frames, cache.source: cache.window(ys, xs)}
+        cache.close()
+        frame_precip(data, tile, valid)
     else:
-        load_precip(data, valid, tile_bounds)
+        # The image readers fill a dense cube, which is then compressed
+        sparse = isinstance(data["precip"], SparsePrecip)
+        if sparse:
+            data["precip"] = data["precip"].todense()
+        # We have MRMS a2m RASTER files prior to 1 Jan 2015, but these files
+        # used a very poor choice of data interval of 0.1mm, which is not
+        # large enough to capture low intensity events.  Files after 1 Jan
+        # 2015 used a better 0.02mm resolution
+        if valid.year < 2015:
+            load_precip_legacy(data, valid, tile_bounds)
+        else:
+            load_precip(data, valid, tile_bounds)
+        if sparse:
+            data["precip"] = SparsePrecip.from_dense(data["precip"])
+    qc_precip(data, valid, xtile, ytile)
+    write_grid(precip_totals(data["precip"]), valid, xtile, ytile)
+
+
+def cube_precip_workflow(data, tile, valid, xtile, ytile):
+    """Drive the precipitation workflow from a `weather_cube` tile."""
+    write_grid(data["stage4"], valid, xtile, ytile, "stage4")
+    frame_precip(data, tile, valid)
     qc_precip(data, valid, xtile, ytile)
-    write_grid(np.sum(data["precip"], 2), valid, xtile, ytile)
+    write_grid(precip_totals(data["precip"]), valid, xtile, ytile)
 
 
 def edit_clifile(xidx, yidx, clifn, data, valid):
     """Edit the climate file, run from thread."""
     # Okay we have work to do
-    with open(clifn, "r", encoding="utf8") as fh:
-        clidata = fh.read()
-    pos = clidata.find(valid.strftime("%-d\t%-m\t%Y"))
-    if pos == -1:
-        LOG.info("Date find failure for %s", clifn)
-        return False
-
-    pos2 = clidata[pos:].find(
-        (valid + datetime.timedelta(days=1)).strftime("%-d\t%-m\t%Y")
-    )
-    if pos2 == -1:
+    if not has_day(clifn, valid + datetime.timedelta(days=1)):
         LOG.info("Date2 find failure for %s", clifn)
         return False
 
-    intensity_threshold = 1.0
-    bpdata = compute_breakpoint(
-        data["precip"][yidx, xidx, :],
-    )
-    if bpdata is None:
-        bpdata = []
-    while len(bpdata) >= 100:
-        intensity_threshold += 2
-        LOG.debug("len(bpdata) %s>100 t:%s", len(bpdata), intensity_threshold)
-        bpdata = compute_breakpoint(
-            data["precip"][yidx, xidx, :],
-            accumThreshold=intensity_threshold,
-            intensityThreshold=intensity_threshold,
-        )
+    bpdata = breakpoint_strings(data["bp"], yidx, xidx)
 
     high = data["high"][yidx, xidx]
     low = data["low"][yidx, xidx]
@@ -499,11 +751,62 @@ def edit_clifile(xidx, yidx, clifn, data, valid):
         f"{dwpt:4.1f}\n{bptext}{bptext2}"
     )
 
-    with open(clifn, "w", encoding="utf8") as fh:
-        fh.write(clidata[:pos] + thisday + clidata[(pos + pos2) :])
+    if not replace_day(clifn, valid, thisday):
+        LOG.info("Date find failure for %s", clifn)
+        return False
     return True
 
 
+def edit_clistore(blockdir, data, valid, tile_bounds):
+    """Write this tile's data into one block of the climate store.
+
+    Returns:
+      (int, int) number of cells written and cells skipped for missing data
+    """
+    block = CliBlock(blockdir, "r+")
+    lons, lats = block.lonlats()
+    xidx = np.rint((lons - tile_bounds.west) * 100).astype(int)
+    yidx = np.rint((lats - tile_bounds.south) * 100).astype(int)
+    shp = data["high"].shape
+    cells = np.nonzero(
+        (xidx >= 0) & (xidx < shp[1]) & (yidx >= 0) & (yidx < shp[0])
+    )[0]
+    xidx = xidx[cells]
+    yidx = yidx[cells]
+    daily = {}
+    for vname in "high low solar wind dwpt".split():
+        daily[vname] = data[vname][yidx, xidx].astype(np.float32)
+    good = ~np.isnan(np.stack(list(daily.values()))).any(axis=0)
+    if not good.all():
+        LOG.info("Missing data for %s cells in %s", (~good).sum(), blockdir)
+    cells, xidx, yidx = cells[good], xidx[good], yidx[good]
+    bps = data["bp"]
+    counts = bps.count[yidx, xidx]
+    take = expand_ranges(bps.start[yidx, xidx], counts)
+    block.write_day(
+        valid,
+        cells,
+        {k: v[good] for k, v in daily.items()},
+        counts,
+        bps.minute[take] / 60.0,
+        bps.accum[take],
+    )
+    return cells.size, int((~good).sum())
+
+
+def find_store_blocks(scenario, tile_bounds):
+    """Return the climate store block directories within this tile."""
+    res = []
+    for blockdir in glob.glob(f"/i/{scenario}/clistore/*"):
+        lon, lat = parse_cell_name(os.path.basename(blockdir))
+        if (
+            tile_bounds.west <= lon < tile_bounds.east
+            and tile_bounds.south <= lat < tile_bounds.north
+        ):
+            res.append(blockdir)
+    return res
+
+
 def compute_tile_bounds(xtile, ytile, tilesize) -> BOUNDS:
     """Return a BOUNDS namedtuple."""
     south = SOUTH + ytile * tilesize
@@ -516,20 +819,33 @@ def compute_tile_bounds(xtile, ytile, tilesize) -> BOUNDS:
     )
 
 
-def main(argv):
-    """The workflow to get the weather data variables we want!"""
-    if len(argv) != 8:
-        print(
-            "Usage: python daily_climate_editor.py <xtile> <ytile> <tilesz> "
-            "<scenario> <YYYY> <mm> <dd>"
-        )
-        return
-    xtile = int(argv[1])
-    ytile = int(argv[2])
-    tilesize = int(argv[3])
-    scenario = int(argv[4])
-    valid = datetime.date(int(argv[5]), int(argv[6]), int(argv[7]))
+def edit_tile(
+    xtile,
+    ytile,
+    tilesize,
+    scenario,
+    valid,
+    store=False,
+    tile=None,
+    sparse=False,
+):
+    """Edit the climate of one tile.
 
+    Args:
+      xtile (int): tile index from the west.
+      ytile (int): tile index from the south.
+      tilesize (int): tile size in degrees.
+      scenario (int): the climate scenario.
+      valid (date): the date to edit.
+      store (bool): write to the binary climate store.
+      tile (dict, optional): this tile's inputs from a `weather_cube`,
+        otherwise they are loaded here.
+      sparse (bool): only store the precip of the wet cells, see
+        `sparse_precip.py`.
+
+    Returns:
+      int exit status
+    """
     tile_bounds = compute_tile_bounds(xtile, ytile, tilesize)
     LOG.debug("bounds %s", tile_bounds)
     shp = (
@@ -539,23 +855,38 @@ def main(argv):
     data = {}
     for vname in "high low dwpt wind solar stage4".split():
         data[vname] = np.zeros(shp, np.float16)
-    # Optimize for continuous memory
-    data["precip"] = np.zeros((*shp, 30 * 24), np.float16)
-
-    xaxis = np.arange(tile_bounds.west, tile_bounds.east, 0.01)
-    yaxis = np.arange(tile_bounds.south, tile_bounds.north, 0.01)
-    data["lon"], data["lat"] = np.meshgrid(xaxis, yaxis)
-
-    # 1. Max Temp C
-    # 2. Min Temp C
-    # 3. Radiation l/d
-    # 4. wind mps
-    # 6. Mean dewpoint C
-    with ncopen(iemre.get_daily_ncname(valid.year)) as nc:
-        load_iemre(nc, data, valid)
-    # 5. wind direction (always zero)
-    # 7. breakpoint precip mm
-    precip_workflow(data, valid, xtile, ytile, tile_bounds)
+    if sparse:
+        data["precip"] = SparsePrecip((*shp, 30 * 24))
+    else:
+        # Optimize for continuous memory
+        data["precip"] = np.zeros((*shp, 30 * 24), np.float16)
+
+    if tile is not None:
+        for vname in "high low dwpt wind solar stage4".split():
+            data[vname][:] = tile[vname]
+        cube_precip_workflow(data, tile, valid, xtile, ytile)
+    else:
+        # 1. Max Temp C
+        # 2. Min Temp C
+        # 3. Radiation l/d
+        # 4. wind mps
+        # 6. Mean dewpoint C
+        with ncopen(iemre.get_daily_ncname(valid.year)) as nc:
+            load_iemre(nc, data, valid, tile_bounds)
+        # 5. wind direction (always zero)
+        # 7. breakpoint precip mm
+        precip_workflow(data, valid, xtile, ytile, tile_bounds)
+    data["bp"] = compute_tile_breakpoints(data["precip"])
+
+    if store:
+        written = 0
+        skipped = 0
+        for blockdir in find_store_blocks(scenario, tile_bounds):
+            res = edit_clistore(blockdir, data, valid, tile_bounds)
+            written += res[0]
+            skipped += res[1]
+        LOG.info("clistore wrote %s cells, skipped %s", written, skipped)
+        return 3 if skipped > 10 else 0
 
     queue = []
     for yidx in range(shp[0]):
@@ -598,6 +929,28 @@ def main(argv):
             )
         pool.close()
         pool.join()
+    return 0
+
+
+def main(argv):
+    """The workflow to get the weather data variables we want!"""
+    if len(argv) not in [8, 9, 10]:
+        print(
+            "Usage: python daily_climate_editor.py <xtile> <ytile> <tilesz> "
+            "<scenario> <YYYY> <mm> <dd> [store] [sparse]"
+        )
+        return
+    status = edit_tile(
+        int(argv[1]),
+        int(argv[2]),
+        int(argv[3]),
+        int(argv[4]),
+        datetime.date(int(argv[5]), int(argv[6]), int(argv[7])),
+        store="store" in argv[8:],
+        sparse="sparse" in argv[8:],
+    )
+    if status != 0:
+        sys.exit(status)
 
 
 if __name__ == "__main__":
@@ -650,3 +1003,99 @@ def test_bp():
                 assert False
             lastts = float(tokens[0])
             lastaccum = float(tokens[1])
+
+
+def test_tile_breakpoints():
+    """Test that the batched breakpoints match compute_breakpoint."""
+    data = np.zeros((2, 3, 30 * 24), np.float16)
+    data[0, 0, 0] = 3.2
+    data[0, 1, 24 * 30 - 1] = 10.99
+    data[1, 0] = np.random.randint(20, size=(30 * 24,))
+    data[1, 1] = np.random.random(30 * 24)
+    data[1, 2, ::7] = 0.5
+    bps = compute_tile_breakpoints(data)
+    assert breakpoint_strings(bps, 0, 0) == ["00.0000 0.00", "00.0333 3.20"]
+    assert breakpoint_strings(bps, 0, 1) == ["23.9667 0.00", "23.9833 10.99"]
+    assert breakpoint_strings(bps, 0, 2) == []
+    for xidx in range(3):
+        bp = compute_breakpoint(data[1, xidx])
+        threshold = 1.0
+        while len(bp) >= 100:
+            threshold += 2
+            bp = compute_breakpoint(data[1, xidx], threshold, threshold)
+        assert breakpoint_strings(bps, 1, xidx) == bp
+
+
+def test_legacy_precip():
+    """Test the batched interpolation against the per cell np.interp."""
+    shp = (5, 7)
+    m5 = np.random.random((12 * 24, *shp)).astype(np.float16)
+    m5[:, 0, 0] = 0
+    m5[:100, 1, 1] = 0
+    m5[10, 2, 2] = np.inf
+    data = {
+        "solar": np.zeros(shp, np.float16),
+        "stage4": (np.random.random(shp) * 2).astype(np.float16),
+        "precip": np.zeros((*shp, 30 * 24), np.float16),
+    }
+    data["stage4"][0, 0] = 1
+    data["stage4"][1, 1] = 1
+    data["stage4"][2, 2] = 1
+    legacy_precip(data, m5)
+    m5 = np.transpose(m5, (1, 2, 0)).copy()
+    wm5 = m5 / np.sum(m5, 2)[:, :, None]
+    minute2 = np.arange(0, 60 * 24, 2)
+    minute5 = np.arange(0, 60 * 24, 5)
+    for y in range(shp[0]):
+        for x in range(shp[1]):
+            s4total = data["stage4"][y, x]
+            if s4total < 0.4:
+                assert (data["precip"][y, x] == 0).all()
+                continue
+            weights = np.interp(minute2, minute5, wm5[y, x]) / 2.5
+            np.testing.assert_array_equal(
+                data["precip"][y, x], (weights * s4total).astype(np.float16)
+            )
+
+
+def test_sparse_workflow():
+    """Test that the sparse precip gives the dense results."""
+    shp = (6, 5)
+    img = np.zeros((30 * 24, *shp), np.uint8)
+    img[100:110, 1, 2] = 40
+    img[200, 3, 4] = 255
+    img[300:400, 4, :] = np.random.randint(0, 255, (100, 5))
+    tile = {"frames": np.ones(30 * 24, bool), "a2m": img}
+    tile["frames"][350] = False
+    m5 = np.zeros((12 * 24, *shp), np.float16)
+    m5[50:60, 2:4] = 1.5
+    valid = datetime.date(2021, 6, 1)
+    results = []
+    for sparse in [False, True]:
+        data = {
+            "solar": np.zeros(shp, np.float16),
+            "stage4": np.full(shp, 3.0, np.float16),
+        }
+        data["stage4"][0] = 0
+        if sparse:
+            data["precip"] = SparsePrecip((*shp, 30 * 24))
+        else:
+            data["precip"] = np.zeros((*shp, 30 * 24), np.float16)
+        frame_precip(data, tile, valid)
+        qc_precip(data, valid, 0, 0)
+        bps = compute_tile_breakpoints(data["precip"])
+        legacy = dict(data)
+        legacy["precip"] = (
+            SparsePrecip((*shp, 30 * 24))
+            if sparse
+            else np.zeros((*shp, 30 * 24), np.float16)
+        )
+        legacy_precip(legacy, m5)
+        results.append((data["precip"], bps, legacy["precip"]))
+    (dense, dbps, dlegacy), (sparse, sbps, slegacy) = results
+    assert sparse.cells.size == 6
+    np.testing.assert_array_equal(sparse.todense(), dense)
+    np.testing.assert_array_equal(precip_totals(sparse), np.sum(dense, 2))
+    for dvals, svals in zip(dbps, sbps):
+        np.testing.assert_array_equal(dvals, svals)
+    np.testing.assert_array_equal(slegacy.todense(), dlegacy)
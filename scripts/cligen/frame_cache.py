@@ -0,0 +1,111 @@
+"""Day cache of the decoded MRMS a2m and N0R composite frames.
+
+Decoding the day's 720 a2m (or 288 N0R) PNG composites is the costly part of
+loading the precip inputs.  Once a day has been decoded and cropped to the
+DEP domain by `weather_cube`, the (time, y, x) uint8 frames are saved as a
+compressed ``.npz`` with one member per 500x500 cell block, so a tile only
+decompresses the blocks it covers.  The ``frames`` member flags the times
+that had an image.
+"""
+import os
+
+import numpy as np
+
+CACHE_DIR = "/mnt/idep2/data/framecache"
+SOURCES = ["a2m", "n0r"]
+# Cells along each side of a cached block, 5 degrees
+BLOCK = 500
+
+
+def get_cache_fn(source, valid):
+    """Return the cache filename for this source and date."""
+    return f"{CACHE_DIR}/{valid:%Y}/{source}_{valid:%Y%m%d}.npz"
+
+
+def blocks(shape, block=BLOCK):
+    """Yield the (member name, y slice, x slice) blocks of a grid."""
+    for y0 in range(0, shape[0], block):
+        for x0 in range(0, shape[1], block):
+            yield (
+                f"b_{y0 // block}_{x0 // block}",
+                slice(y0, min(y0 + block, shape[0])),
+                slice(x0, min(x0 + block, shape[1])),
+            )
+
+
+def write_cache(fn, cube, frames, block=BLOCK):
+    """Save the (time, y, x) cube and frame flags to the cache file."""
+    arrays = {"frames": np.asarray(frames), "shape": np.array(cube.shape)}
+    for name, ys, xs in blocks(cube.shape[1:], block):
+        arrays[name] = np.asarray(cube[:, ys, xs])
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    with open(f"{fn}.tmp", "wb") as fh:
+        np.savez_compressed(fh, **arrays)
+    os.rename(f"{fn}.tmp", fn)
+
+
+class FrameCache:
+    """Read access to a cached day of frames."""
+
+    def __init__(self, fn, source, block=BLOCK):
+        """Open the cache file."""
+        self.source = source
+        self.block = block
+        self.npz = np.load(fn)
+        self.frames = self.npz["frames"]
+        self.shape = tuple(self.npz["shape"])
+
+    def window(self, ys, xs):
+        """Return the (time, y, x) frames of a window of the grid."""
+        res = np.zeros(
+            (self.shape[0], ys.stop - ys.start, xs.stop - xs.start), np.uint8
+        )
+        for name, bys, bxs in blocks(self.shape[1:], self.block):
+            y0, y1 = max(ys.start, bys.start), min(ys.stop, bys.stop)
+            x0, x1 = max(xs.start, bxs.start), min(xs.stop, bxs.stop)
+            if y0 >= y1 or x0 >= x1:
+                continue
+            res[
+                :, y0 - ys.start : y1 - ys.start, x0 - xs.start : x1 - xs.start
+            ] = self.npz[name][
+                :,
+                y0 - bys.start : y1 - bys.start,
+                x0 - bxs.start : x1 - bxs.start,
+            ]
+        return res
+
+    def copy_to(self, out):
+        """Copy all of the cached frames into the (time, y, x) out array."""
+        for name, ys, xs in blocks(self.shape[1:], self.block):
+            out[:, ys, xs] = self.npz[name]
+
+    def close(self):
+        """Close the file."""
+        self.npz.close()
+
+
+def open_cache(valid):
+    """Return the `FrameCache` of this date or None if not cached."""
+    for source in SOURCES:
+        fn = get_cache_fn(source, valid)
+        if os.path.isfile(fn):
+            return FrameCache(fn, source)
+    return None
+
+
+def test_window(tmp_path):
+    """Test that windows across blocks come back right."""
+    cube = np.random.randint(0, 255, (3, 7, 9)).astype(np.uint8)
+    frames = np.array([True, False, True])
+    fn = str(tmp_path / "test.npz")
+    write_cache(fn, cube, frames, block=4)
+    cache = FrameCache(fn, "a2m", block=4)
+    np.testing.assert_array_equal(cache.frames, frames)
+    np.testing.assert_array_equal(
+        cache.window(slice(2, 7), slice(3, 9)), cube[:, 2:7, 3:9]
+    )
+    out = np.zeros_like(cube)
+    cache.copy_to(out)
+    np.testing.assert_array_equal(out, cube)
+    np.testing.assert_array_equal(cache.window(slice(0, 7), slice(0, 9)), cube)
+    cache.close()
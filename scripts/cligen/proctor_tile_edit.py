@@ -1,13 +1,19 @@
 """Proctor the editing of DEP CLI files.
 
 Usage:
-    python proctor_tile_edit.py <scenario> <yyyy> <mm> <dd>
+    python proctor_tile_edit.py <scenario> <yyyy> <mm> <dd> [store] [sparse]
+
+The day's weather inputs are loaded once into a `weather_cube`, which the
+tile workers slice, see `daily_clifile_editor.py` to run a single tile.  With
+`store`, the tiles are written to the binary climate store in place of the
+.cli files, see `clifile_store.py`.  With `sparse`, the tiles only keep the
+precip of their wet cells in memory, which allows for twice the workers.
 """
 import sys
 import os
 import stat
 import datetime
-import subprocess
+import tempfile
 import time
 from multiprocessing import cpu_count
 from concurrent.futures import ProcessPoolExecutor
@@ -15,6 +21,8 @@ from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from pyiem.dep import SOUTH, NORTH, EAST, WEST
 from pyiem.util import logger
+from stage_spans import span
+from weather_cube import CUBE_DIR, build_cube, run_tile
 
 LOG = logger()
 DATADIR = "/mnt/idep2/data/dailyprecip"
@@ -44,48 +52,40 @@ def assemble_grids(tilesz, date):
     np.save(get_fn(date), res)
 
 
-def myjob(cmd):
-    """Run this command and return any result."""
-    proc = subprocess.Popen(
-        cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-    )
-    stdout, stderr = proc.communicate()
-    if stdout != b"" or stderr != b"":
-        LOG.info(
-            "CMD: %s\nSTDOUT: %s\nSTDERR: %s",
-            cmd,
-            stdout.decode("ascii", "ignore").strip(),
-            stderr.decode("ascii", "ignore").strip(),
-        )
-    return proc.returncode
-
-
 def main(argv):
     """Go Main Go."""
     tilesz = 5
-    scenario = argv[1]
+    scenario = int(argv[1])
     date = datetime.date(int(argv[2]), int(argv[3]), int(argv[4]))
+    store = "store" in argv[5:]
+    sparse = "sparse" in argv[5:]
     fn = get_fn(date)
     if os.path.isfile(fn):
         filets = os.stat(fn)[stat.ST_MTIME]
         LOG.info("%s was last processed on %s", date, time.ctime(filets))
-    jobs = []
-    for i, _lon in enumerate(np.arange(WEST, EAST, tilesz)):
-        for j, _lat in enumerate(np.arange(SOUTH, NORTH, tilesz)):
-            cmd = (
-                f"python daily_clifile_editor.py {i} {j} {tilesz} "
-                f"{scenario} {date:%Y %m %d}"
-            )
-            jobs.append(cmd)
     failed = False
-    # 12 Nov 2021 audit shows per process usage in the 2-3 GB range
-    workers = int(min([4, cpu_count() / 4]))
-    LOG.debug("starting %s workers", workers)
-    with ProcessPoolExecutor(max_workers=workers) as executor:
-        for job, res in zip(jobs, executor.map(myjob, jobs)):
-            if res != 0:
-                failed = True
-                LOG.info("job: %s exited with status code %s", job, res)
+    with span("proctor_tile_edit") as rec, tempfile.TemporaryDirectory(
+        dir=CUBE_DIR, prefix="depcube"
+    ) as tmpd:
+        with span("proctor_tile_edit.build_cube"):
+            build_cube(tmpd, date)
+        jobs = []
+        for i, _lon in enumerate(np.arange(WEST, EAST, tilesz)):
+            for j, _lat in enumerate(np.arange(SOUTH, NORTH, tilesz)):
+                jobs.append(
+                    (tmpd, i, j, tilesz, scenario, date, store, sparse)
+                )
+        # Tiles no longer load their own inputs, so are about 1 GB each, or
+        # about half of that when sparse
+        workers = cpu_count() if sparse else cpu_count() // 2
+        workers = max(1, min(len(jobs), workers))
+        LOG.debug("starting %s workers", workers)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for job, res in zip(jobs, executor.map(run_tile, jobs)):
+                if res != 0:
+                    failed = True
+                    LOG.info("job: %s exited with status code %s", job, res)
+        rec["items"] = len(jobs)
     if failed:
         LOG.info("Aborting due to job failures")
         sys.exit(3)
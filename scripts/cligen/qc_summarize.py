@@ -7,9 +7,9 @@ import netCDF4
 import pytz
 import pandas as pd
 import requests
-from pyiem.dep import read_cli
 from pyiem.iemre import hourly_offset
 from pyiem.util import c2f, mm2inch
+from clifile_store import read_clidf, read_clilines
 
 
 def compute_stage4(lon, lat, year):
@@ -60,7 +60,7 @@ def do_qc(fn, df, year):
     if len(df.index) != len(df.resample("D").mean().index):
         print("ERROR: Appears to be missing dates!")
 
-    if open(fn).read()[-1] != "\n":
+    if read_clilines(fn)[-1][-1] != "\n":
         print("ERROR: File does not end with \\n")
 
     print("--------- Summary stats from the .cli file")
@@ -220,7 +220,7 @@ def main(argv):
     """Do Stuff"""
     fn = argv[1]
     year = int(argv[2])
-    df = read_cli(fn)
+    df = read_clidf(fn)
     df["pcpn_in"] = mm2inch(df["pcpn"].values)
     do_qc(fn, df, year)
 
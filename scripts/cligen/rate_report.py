@@ -0,0 +1 @@
+../RT/rate_report.py
\ No newline at end of file
@@ -0,0 +1,101 @@
+"""Nearest neighbour regridding of IEMRE and Stage IV onto the DEP grid.
+
+The index maps each 0.01 degree cell of the DEP domain to the flat index of
+the nearest source grid cell, the same neighbour that
+`scipy.interpolate.NearestNDInterpolator` finds.  It is computed once per
+source grid geometry and cached as ``<name>_<digest>.npy``, so regridding a
+variable is a fancy index gather.
+"""
+import hashlib
+import os
+
+import numpy as np
+from pyiem.dep import EAST, NORTH, SOUTH, WEST
+from scipy.spatial import cKDTree
+
+CACHE_DIR = "/mnt/idep2/data/regrid"
+GRID_SHAPE = (int((NORTH - SOUTH) * 100), int((EAST - WEST) * 100))
+# Rows of the DEP grid to query at once, bounds the memory used
+QUERY_ROWS = 100
+
+
+def tile_slices(tile_bounds):
+    """Return the (y, x) slices of the DEP grid covered by a tile."""
+    y0 = int(round((tile_bounds.south - SOUTH) * 100))
+    x0 = int(round((tile_bounds.west - WEST) * 100))
+    return (
+        slice(y0, y0 + int((tile_bounds.north - tile_bounds.south) * 100)),
+        slice(x0, x0 + int((tile_bounds.east - tile_bounds.west) * 100)),
+    )
+
+
+def grid_digest(lons, lats, shape):
+    """Return the digest of the source and destination grid geometry."""
+    digest = hashlib.sha1()
+    for arr in (lons, lats):
+        digest.update(np.ascontiguousarray(arr, np.float64).tobytes())
+    digest.update(f"{shape} {WEST} {SOUTH}".encode("ascii"))
+    return digest.hexdigest()[:16]
+
+
+def build_index(lons, lats, shape=GRID_SHAPE):
+    """Compute the (y, x) array of nearest source flat indices."""
+    tree = cKDTree(np.column_stack([np.ravel(lons), np.ravel(lats)]))
+    xaxis = WEST + np.arange(shape[1]) * 0.01
+    res = np.zeros(shape, np.int32)
+    for row in range(0, shape[0], QUERY_ROWS):
+        yaxis = SOUTH + np.arange(row, min(row + QUERY_ROWS, shape[0])) * 0.01
+        qlons, qlats = np.meshgrid(xaxis, yaxis)
+        _, idx = tree.query(np.column_stack([qlons.ravel(), qlats.ravel()]))
+        res[row : row + yaxis.size] = idx.reshape(qlons.shape)
+    return res
+
+
+def get_index(name, lons, lats, shape=GRID_SHAPE):
+    """Return the cached regridding index for this source grid.
+
+    Args:
+      name (str): label of the source grid, ie ``iemre``.
+      lons (array-like): source grid longitudes, any shape.
+      lats (array-like): source grid latitudes, same shape as lons.
+      shape (tuple): the DEP grid shape.
+    """
+    lons = np.asarray(lons)
+    lats = np.asarray(lats)
+    fn = f"{CACHE_DIR}/{name}_{grid_digest(lons, lats, shape)}.npy"
+    if os.path.isfile(fn):
+        return np.load(fn, mmap_mode="r")
+    res = build_index(lons, lats, shape)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(f"{fn}.{os.getpid()}.npy", res)
+        os.rename(f"{fn}.{os.getpid()}.npy", fn)
+    except OSError:
+        pass
+    return res
+
+
+def regrid(index, values):
+    """Gather the source values onto the grid of the index."""
+    return np.ravel(values)[index]
+
+
+def test_regrid(tmp_path, monkeypatch):
+    """Test that we match NearestNDInterpolator."""
+    from scipy.interpolate import NearestNDInterpolator
+
+    monkeypatch.setattr("regrid_index.CACHE_DIR", str(tmp_path))
+    shape = (37, 23)
+    lons, lats = np.meshgrid(
+        np.arange(WEST - 0.1, WEST + 0.4, 0.0417),
+        np.arange(SOUTH - 0.1, SOUTH + 0.5, 0.0417),
+    )
+    values = np.random.random(lons.shape)
+    index = get_index("test", lons, lats, shape)
+    assert len(os.listdir(tmp_path)) == 1
+    np.testing.assert_array_equal(index, get_index("test", lons, lats, shape))
+    qlons, qlats = np.meshgrid(
+        WEST + np.arange(shape[1]) * 0.01, SOUTH + np.arange(shape[0]) * 0.01
+    )
+    nn = NearestNDInterpolator((lons.ravel(), lats.ravel()), values.ravel())
+    np.testing.assert_array_equal(regrid(index, values), nn(qlons, qlats))
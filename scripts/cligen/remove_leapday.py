@@ -5,6 +5,8 @@ import os
 def main():
     for root, dirs, filenames in os.walk("/i/0/cli"):
         for fn in filenames:
+            if not fn.endswith(".cli"):
+                continue
             clifn = "%s/%s" % (root, fn)
             data = open(clifn).read()
             pos1 = data.find("\n29\t2\t2017")
@@ -1,27 +1,23 @@
 """For some reason, we have corrupt files to start the new year
 
 So this script does a replacement, and some QC in the process"""
+import datetime
 import glob
 import os
 
+from clifile_index import append_days, has_day, read_days, truncate_days
+
 
 def do(fn):
     """Do."""
-    data = open(fn).read()
-    pos1 = data.find("\n1\t1\t2015")
-    pos2 = data.find("\n1\t1\t2016")
-    pos3 = data.find("\n1\t1\t2017")
-
-    newfp = open("new%s" % (fn,), "w")
+    # Repeat 2015 data, with 2015 replaced
+    content = read_days(
+        fn, datetime.date(2015, 1, 1), datetime.date(2015, 12, 31)
+    )
     # everything up till 1 Jan 2017
-    newfp.write(data[:pos3])
-    # Then repeat 2015 data, with 2015 replaced
-    newfp.write(data[pos1:pos2].replace("\t2015", "\t2017") + "\n")
-    newfp.close()
-
-    data = open("new%s" % (fn,)).read()
-    print("%s %s" % (fn, data.find("31\t12\t2017")))
-    os.rename("new%s" % (fn,), fn)
+    truncate_days(fn, datetime.date(2017, 1, 1))
+    append_days(fn, content.replace("\t2015", "\t2017"))
+    print("%s %s" % (fn, has_day(fn, datetime.date(2017, 12, 31))))
 
 
 def main():
@@ -0,0 +1 @@
+../RT/stage_spans.py
\ No newline at end of file
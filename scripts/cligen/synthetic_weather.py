@@ -0,0 +1,136 @@
+"""Synthetic weather inputs for the benchmarks, see `bench_cligen.py`.
+
+Everything is generated from a seeded random state, so repeated benchmark
+runs see the same data, without any need for the /i tree, the database or
+the archive of MRMS images.
+"""
+import datetime
+
+import numpy as np
+from PIL import Image
+from clifile_store import dayline, years_header
+
+# The a2m image is 0.01 degree from 130W to 60W and from 55N to 20N
+A2M_SHAPE = (3500, 7000)
+
+
+def make_precip(steps, wet_fraction, rng, shape=()):
+    """Return a float16 (*shape, steps) cube of 2 minute precip [mm].
+
+    Wet spells are runs of a few hours that cover about `wet_fraction` of
+    the time steps, with the spiky intensities of convective rainfall.
+    """
+    res = np.zeros((*shape, steps), np.float16)
+    flat = res.reshape(-1, steps)
+    spell = 90
+    nspells = max(1, int(round(steps * wet_fraction / spell)))
+    for row in flat:
+        for start in rng.integers(0, steps - spell, nspells):
+            row[start : start + spell] = rng.gamma(0.5, 0.4, spell)
+    return res
+
+
+def make_a2m_frames(shape, wet_fraction, rng, steps=30 * 24):
+    """Return the uint8 (steps, y, x) raw a2m image values of a day.
+
+    The values are 0.02 mm units, with 255 for missing, over a band of rain
+    that covers `wet_fraction` of the grid at any time and drifts its own
+    width to the east over the day.
+    """
+    res = np.zeros((steps, *shape), np.uint8)
+    width = max(1, int(shape[1] * wet_fraction))
+    for tidx in range(steps):
+        x0 = int(tidx / steps * min(width, shape[1] - width))
+        res[tidx, :, x0 : x0 + width] = rng.integers(
+            0, 60, (shape[0], width), dtype=np.uint8
+        )
+    res[steps // 2, :2] = 255
+    return res
+
+
+def write_a2m_png(fn, frame, tile_bounds):
+    """Write a full a2m image with the south up frame at the tile bounds."""
+    top = int((55.0 - tile_bounds.north) * 100.0)
+    left = int((tile_bounds.west - -130.0) * 100.0)
+    img = np.zeros(A2M_SHAPE, np.uint8)
+    img[top : top + frame.shape[0], left : left + frame.shape[1]] = np.flipud(
+        frame
+    )
+    Image.fromarray(img).save(fn)
+
+
+def make_clifile(fn, sts, ets, rng, lon=-95.17, lat=38.13):
+    """Write a .cli file with daily and breakpoint data from sts to ets."""
+    lines = [
+        "5.32300\n",
+        "   1   0   0\n",
+        "   Station:  DEP synthetic                  "
+        "CLIGEN VERSION 5.32300\n",
+        " Latitude Longitude Elevation (m) Obs. Years   Beginning year  "
+        "Years simulated Command Line:\n",
+        years_header(lat, lon, ets.year - sts.year + 1),
+        " Observed monthly ave max temperature (C)\n",
+        "  -1.6   1.6   8.4  15.8  21.8  27.1  29.6  28.6  24.4  17.3   8.4"
+        "   0.8\n",
+        " Observed monthly ave min temperature (C)\n",
+        " -11.2  -8.5  -2.7   3.3   9.7  15.2  17.9  16.8  11.9   5.3  -1.9"
+        "  -8.4\n",
+        " Observed monthly ave solar radiation (Langleys/day)\n",
+        " 182.0 249.0 335.0 422.0 504.0 554.0 559.0 496.0 403.0 291.0 189.0"
+        " 150.0\n",
+        " Observed monthly ave precipitation (mm)\n",
+        "  20.6  23.1  57.2  84.6 118.1 116.8 102.9 104.1  79.0  61.7  40.1"
+        "  28.4\n",
+        " da mo year  nbrkpt tmax  tmin   rad  w-vel  w-dir  tdew\n",
+        "                   (mm)  (C)   (C) (l/d)  (m/s)  (deg)   (C)\n",
+    ]
+    now = sts
+    while now <= ets:
+        bpcount = 0
+        bps = []
+        if rng.random() < 0.3:
+            bpcount = int(rng.integers(2, 30))
+            minutes = np.sort(rng.choice(1440, bpcount, replace=False))
+            accum = np.cumsum(rng.gamma(0.5, 2.0, bpcount))
+            accum[0] = 0
+            bps = [
+                f"{m // 60:02.0f}.{(m % 60 / 60. * 10000.):04.0f} {a:.2f}\n"
+                for m, a in zip(minutes, accum)
+            ]
+        row = {
+            "high": rng.normal(15, 10),
+            "low": rng.normal(3, 10),
+            "solar": rng.uniform(50, 700),
+            "wind": rng.uniform(0, 10),
+            "wdir": 0,
+            "dwpt": rng.normal(2, 8),
+        }
+        lines.append(dayline(now, bpcount, row))
+        lines.extend(bps)
+        now += datetime.timedelta(days=1)
+    with open(fn, "w", encoding="ascii") as fh:
+        fh.write("".join(lines))
+
+
+def test_make_clifile(tmp_path):
+    """Test that the climate file is indexable."""
+    from clifile_index import has_day, read_days
+
+    fn = str(tmp_path / "test.cli")
+    rng = np.random.default_rng(0)
+    make_clifile(
+        fn, datetime.date(2007, 1, 1), datetime.date(2008, 12, 31), rng
+    )
+    assert has_day(fn, datetime.date(2008, 12, 31))
+    assert read_days(fn, datetime.date(2007, 3, 1)).startswith("1\t3\t2007\t")
+
+
+def test_make_precip():
+    """Test the shape and wetness of the synthetic cubes."""
+    rng = np.random.default_rng(0)
+    precip = make_precip(720, 0.25, rng, (3, 4))
+    assert precip.shape == (3, 4, 720)
+    assert 0.1 < np.mean(precip > 0) < 0.3
+    frames = make_a2m_frames((5, 20), 0.25, rng)
+    assert frames.shape == (720, 5, 20)
+    assert 0.15 < np.mean((frames > 0) & (frames < 255)) < 0.3
@@ -2,11 +2,12 @@
 import sys
 import datetime
 
+from clifile_store import read_clilines
+
 
 def main(argv):
     """Run for a given file."""
-    with open(argv[1], encoding="ascii") as fh:
-        lines = fh.readlines()
+    lines = read_clilines(argv[1])
     tokens = lines[4].strip().split()
     syear = int(tokens[4])
     # simyears = int(tokens[5])
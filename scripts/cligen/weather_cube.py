@@ -0,0 +1,197 @@
+"""Load the day's weather inputs once for all of the climate file tiles.
+
+Rather than each tile of `daily_clifile_editor.py` opening the IEMRE and
+Stage IV files and decoding every MRMS a2m (or N0R) image of the day for
+itself, the whole DEP domain is loaded once into memory mapped .npy files:
+
+    high, low, dwpt, wind, solar, stage4.npy  (y, x) float16 daily grids
+    a2m.npy or n0r.npy  (time, y, x) uint8 raw image values
+    frames.npy  (time,) bool, if the image of that time was found
+
+The raw image values are a quarter of the size of the float16 precip cube
+and are converted by the tiles, which slice out what they need.  Decoded
+frames are kept in the `frame_cache` so that reruns of a date skip the PNGs.
+"""
+import os
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+from osgeo import gdal
+from pyiem import iemre
+from pyiem.dep import SOUTH, WEST
+from pyiem.util import logger, ncopen
+from daily_clifile_editor import (
+    a2m_filenames,
+    compute_tile_bounds,
+    edit_tile,
+    load_iemre,
+    n0r_filenames,
+    regrid_stage4,
+)
+from frame_cache import get_cache_fn, open_cache, write_cache
+from regrid_index import GRID_SHAPE, tile_slices
+from stage_spans import span
+
+LOG = logger()
+# Default location of the cube files, roughly 12 GB for an a2m day
+CUBE_DIR = "/dev/shm"
+DAILY_VARS = ["high", "low", "dwpt", "wind", "solar", "stage4"]
+# Image row of the domain's south edge and column of its west edge
+IMAGE_ORIGIN = {
+    "a2m": (int((55.0 - SOUTH) * 100), int((WEST - -130.0) * 100)),
+    "n0r": (int((50.0 - SOUTH) * 100), int((WEST - -126.0) * 100)),
+}
+# The opened cube of this worker process
+CUBE = {"dir": None, "arrays": None}
+
+
+def crop_image(imgdata, source, shape=GRID_SHAPE):
+    """Return the domain from an image, flipped to be south up."""
+    bottom, left = IMAGE_ORIGIN[source]
+    return np.flipud(
+        imgdata[bottom - shape[0] : bottom, left : left + shape[1]]
+    )
+
+
+def open_frames(cubedir, source):
+    """Create the (time, y, x) memory mapped cube of this image source."""
+    ts = 30 * 24 if source == "a2m" else 12 * 24
+    return np.lib.format.open_memmap(
+        f"{cubedir}/{source}.npy", "w+", np.uint8, (ts, *GRID_SHAPE)
+    )
+
+
+def load_cached_frames(cubedir, cache):
+    """Fill the cube from a `frame_cache.FrameCache` of the day."""
+    cube = open_frames(cubedir, cache.source)
+    cache.copy_to(cube)
+    cube.flush()
+    np.save(f"{cubedir}/frames.npy", cache.frames)
+    LOG.info(
+        "Loaded %s/%s cached %s frames",
+        cache.frames.sum(),
+        cache.frames.size,
+        cache.source,
+    )
+
+
+def load_frames(cubedir, source, fns, valid):
+    """Decode the images into the cube, fns is a list of (tidx, filename).
+
+    The decoded frames are then saved to the `frame_cache` of the date.
+    """
+    cube = open_frames(cubedir, source)
+    ts = cube.shape[0]
+    frames = np.zeros(ts, bool)
+
+    def _reader(tidx, fn):
+        """Reader, GDAL releases the GIL."""
+        cube[tidx] = crop_image(gdal.Open(fn, 0).ReadAsArray(), source)
+        frames[tidx] = True
+
+    with ThreadPool(cpu_count()) as pool:
+        for tidx, fn in fns:
+            # we ignore an hour for CDT->CST, meh
+            if fn is None or tidx >= ts:
+                continue
+            pool.apply_async(_reader, (tidx, fn))
+        pool.close()
+        pool.join()
+    cube.flush()
+    np.save(f"{cubedir}/frames.npy", frames)
+    LOG.info("Loaded %s/%s %s frames", frames.sum(), ts, source)
+    try:
+        write_cache(get_cache_fn(source, valid), cube, frames)
+    except OSError as exp:
+        LOG.info("Failed to write frame cache: %s", exp)
+
+
+def build_cube(cubedir, valid):
+    """Load the day's weather inputs for the domain into cubedir."""
+    data = {}
+    for vname in DAILY_VARS:
+        data[vname] = np.lib.format.open_memmap(
+            f"{cubedir}/{vname}.npy", "w+", np.float16, GRID_SHAPE
+        )
+    with ncopen(iemre.get_daily_ncname(valid.year)) as nc:
+        load_iemre(nc, data, valid)
+    regrid_stage4(data, valid)
+    for vname in DAILY_VARS:
+        data[vname].flush()
+    LOG.info("Loaded IEMRE and Stage IV")
+    cache = open_cache(valid)
+    if cache is not None:
+        load_cached_frames(cubedir, cache)
+        cache.close()
+        return
+    # See precip_workflow for the legacy product usage prior to 2015
+    fns, quorum = (None, False)
+    if valid.year >= 2015:
+        fns, quorum = a2m_filenames(valid)
+    if quorum:
+        load_frames(cubedir, "a2m", list(enumerate(fns)), valid)
+    else:
+        load_frames(cubedir, "n0r", n0r_filenames(valid), valid)
+
+
+def open_cube(cubedir):
+    """Return the dict of memory mapped cube arrays."""
+    res = {}
+    for fn in os.listdir(cubedir):
+        if fn.endswith(".npy"):
+            res[fn[:-4]] = np.load(f"{cubedir}/{fn}", mmap_mode="r")
+    return res
+
+
+def tile_inputs(cube, tile_bounds):
+    """Return the `daily_clifile_editor.edit_tile` inputs for a tile."""
+    ys, xs = tile_slices(tile_bounds)
+    res = {"frames": np.array(cube["frames"])}
+    for vname in DAILY_VARS:
+        res[vname] = np.array(cube[vname][ys, xs])
+    for source in ["a2m", "n0r"]:
+        if source in cube:
+            res[source] = np.array(cube[source][:, ys, xs])
+    return res
+
+
+def run_tile(job):
+    """Process worker entry to edit one tile from the cube."""
+    cubedir, xtile, ytile, tilesize, scenario, valid, store, sparse = job
+    if CUBE["dir"] != cubedir:
+        CUBE["arrays"] = open_cube(cubedir)
+        CUBE["dir"] = cubedir
+    with span("proctor_tile_edit", key=f"{xtile}_{ytile}"):
+        tile_bounds = compute_tile_bounds(xtile, ytile, tilesize)
+        tile = tile_inputs(CUBE["arrays"], tile_bounds)
+        return edit_tile(
+            xtile,
+            ytile,
+            tilesize,
+            scenario,
+            valid,
+            store=store,
+            tile=tile,
+            sparse=sparse,
+        )
+
+
+def test_tile_inputs():
+    """Test that tiles get the right slice of the cube."""
+    cube = {"frames": np.ones(3, bool)}
+    grid = np.arange(GRID_SHAPE[0] * GRID_SHAPE[1]).reshape(GRID_SHAPE)
+    for vname in DAILY_VARS:
+        cube[vname] = grid
+    cube["a2m"] = np.stack([grid, grid, grid])
+    tile_bounds = compute_tile_bounds(12, 5, 5)
+    res = tile_inputs(cube, tile_bounds)
+    assert res["high"].shape == (187, 87)
+    assert res["high"][-1, -1] == grid[-1, -1]
+    assert res["a2m"].shape == (3, 187, 87)
+    res = tile_inputs(cube, compute_tile_bounds(1, 1, 5))
+    assert res["low"][0, 0] == grid[500, 500]
+    img = np.zeros((4000, 7000), np.uint8)
+    bottom, left = IMAGE_ORIGIN["a2m"]
+    img[bottom - 1, left] = 1
+    assert crop_image(img, "a2m")[0, 0] == 1
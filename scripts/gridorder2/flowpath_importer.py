@@ -11,11 +11,18 @@ to.
 import glob
 import os
 import sys
+from multiprocessing import Pool
 
 import geopandas as gpd
 import pandas as pd
 import numpy as np
 from pyiem.util import get_dbconn, logger
+from flowpath_loader import (
+    FlowpathLoader,
+    flowpath_slopes,
+    make_flowpaths,
+    point_geoms,
+)
 
 LOG = logger()
 print(" * BE CAREFUL!  The GeoJSON files may not be 5070, but 26915")
@@ -26,42 +33,6 @@ SCENARIO = int(sys.argv[1])
 PREFIX = "fp"
 
 PGCONN = get_dbconn("idep")
-INSERT_SQL = """
-    INSERT into flowpath_points(flowpath, segid,
-    elevation, length,  surgo, management, slope, geom,
-    landuse, scenario, gridorder)
-    values(%s, %s, %s, %s, %s, %s, %s, 'SRID=5070;POINT(%s %s)',
-    %s, %s, %s)
-"""
-
-
-def get_flowpath(cursor, huc12, fpath):
-    """Get or create a database flowpath identifier
-
-    Args:
-      cursor (psycopg2.cursor): database cursor
-      huc12 (str): HUC12 identifier
-      fpath (int): the flowpath id value for this HUC12
-
-    Returns:
-      int the value of this huc12 flowpath
-    """
-    cursor.execute(
-        """
-        SELECT fid from flowpaths where huc_12 = %s and fpath = %s
-        and scenario = %s
-    """,
-        (huc12, fpath, SCENARIO),
-    )
-    if cursor.rowcount == 0:
-        cursor.execute(
-            """
-            INSERT into flowpaths(huc_12, fpath, scenario)
-            values (%s, %s, %s) RETURNING fid
-        """,
-            (huc12, fpath, SCENARIO),
-        )
-    return cursor.fetchone()[0]
 
 
 def run_checks(df):
@@ -156,25 +127,6 @@ def get_data(filename):
     return df, snapdf
 
 
-def delete_previous(cursor, huc12):
-    """This file is the authority for the HUC12, so we cull previous content."""
-    cursor.execute(
-        """
-        DELETE from flowpath_points p USING flowpaths f WHERE
-        p.scenario = %s and p.flowpath = f.fid and f.huc_12 = %s
-        and f.scenario = %s
-    """,
-        (SCENARIO, huc12, SCENARIO),
-    )
-    cursor.execute(
-        """
-        DELETE from flowpaths WHERE
-        scenario = %s and huc_12 = %s
-    """,
-        (SCENARIO, huc12),
-    )
-
-
 def truncation_logic(df, snappt, lencolname, gordcolname, elevcolname):
     """Figure out where to stop this flowpath."""
     df["distance"] = df["geometry"].distance(snappt["geometry"])
@@ -211,7 +163,7 @@ def truncation_logic(df, snappt, lencolname, gordcolname, elevcolname):
                 df[elevcolname.replace("ep3m", "fp")].values[0],
                 df[gordcolname].min(),
             )
-            sys.exit()
+            raise Exception("gridorder min is not 1")
         df = df[df[gordcolname] < gords[SCENARIO]]
     # 92 Dynamic 3-4
     elif SCENARIO == 92:
@@ -234,141 +186,71 @@ def truncation_logic(df, snappt, lencolname, gordcolname, elevcolname):
     return df
 
 
-def process_flowpath(cursor, huc12, db_fid, df, snappt):
-    """Do one flowpath please."""
-    lencolname = "%sLen%s" % (PREFIX, huc12)
-    elevcolname = "ep3m%s" % (huc12,)
-    gordcolname = "gord_%s" % (huc12,)
-    # Remove any previous data for this flowpath
-    cursor.execute(
-        "DELETE from flowpath_points WHERE flowpath = %s", (db_fid,)
-    )
-    linestring = []
-    sz = len(df.index)
-    maxslope = 0
-    elev_change = 0
-    x_change = 0
-    truncated_df = truncation_logic(
-        df, snappt, lencolname, gordcolname, elevcolname
-    )
-    for segid, (_idx, row) in enumerate(truncated_df.iterrows()):
-        if (segid + 1) == sz:  # Last row!
-            # This effectively repeats the slope of the previous point
-            row2 = df.iloc[segid - 1]
-        else:
-            row2 = df.iloc[segid + 1]
-            if pd.isna(row2[lencolname]):
-                print("Null fpLen")
-                print(row2)
-                sys.exit()
-        dy = abs(row[elevcolname] - row2[elevcolname])
-        elev_change += dy
-        dx = abs(row2[lencolname] - row[lencolname])
-        if dx == 0:
-            print(huc12)
-            print(
-                df[["OBJECTID", elevcolname, lencolname, gordcolname]].head(10)
-            )
-            sys.exit()
-        x_change += dx
-        gridorder = row[gordcolname]
-        slope = dy / dx
-
-        if slope > maxslope:
-            maxslope = slope
-        args = (
-            db_fid,
-            segid,
-            row[elevcolname] / 100.0,
-            row[lencolname] / 100.0,
-            row["SOL_FY_2018"],
-            row["management"],
-            slope,
-            row["geometry"].x,
-            row["geometry"].y,
-            row["landuse"],
-            SCENARIO,
-            gridorder,
-        )
-        cursor.execute(INSERT_SQL, args)
-
-        linestring.append("%s %s" % (row["geometry"].x, row["geometry"].y))
-
-    # Line string must have at least 2 points
-    if len(linestring) > 1:
-        if x_change == 0:
-            print()
-            print(df)
-            sys.exit()
-        sql = """
-            UPDATE flowpaths SET geom = 'SRID=5070;LINESTRING(%s)',
-            max_slope = %s, bulk_slope = %s
-            WHERE fid = %s
-        """ % (
-            ",".join(linestring),
-            maxslope,
-            elev_change / x_change,
-            db_fid,
-        )
-        cursor.execute(sql)
-    else:
-        # Cull our work above if this flowpath is too short
-        delete_flowpath(cursor, db_fid)
-
-
-def delete_flowpath(cursor, fid):
-    """Delete the flowpath."""
-    cursor.execute("DELETE from flowpath_points where flowpath = %s", (fid,))
-    cursor.execute("DELETE from flowpaths where fid = %s", (fid,))
-
-
-def process(cursor, filename, huc12df, snapdf):
-    """Processing of a HUC12's data into the database
+def build_huc12(filename):
+    """Build the flowpaths and points tables of a HUC12's GeoJSON.
 
     Args:
-      cursor (psycopg2.cursor): database cursor
       filename (str): the geojson filename
-      huc12df (pd.DataFrame): the dataframe containing the data
 
     Returns:
-      None
+      (str, pd.DataFrame, pd.DataFrame): the HUC12, its flowpaths and points.
     """
     # We get the huc12 code based on the filename
     huc12 = filename.split(".")[0].split("_")[-1][-12:]
-    # lencolname = "%sLen%s" % (PREFIX, huc12)
-    # res = huc12df[huc12df[lencolname] == 0].groupby(
-    #   "%s%s" % (PREFIX, huc12)).count()
-    # for _, row in res[res[lencolname] > 1].iterrows():
-    #    print(row)
-    # return
-
-    delete_previous(cursor, huc12)
-    # the inbound dataframe has lots of data, one row per flowpath point
-    # We group the dataframe by the column which uses a PREFIX and the huc8
-    for flowpath_num, df in huc12df.groupby(f"fp{huc12}"):
-        snappt = snapdf[snapdf["grid_code"] == flowpath_num].iloc[0]
-        # These are upstream errors I should ignore
-        if flowpath_num == 0 or len(df.index) < 2:
-            continue
-        # Get or create the flowpathid from the database
-        db_fid = get_flowpath(cursor, huc12, flowpath_num)
+    fpcol = f"{PREFIX}{huc12}"
+    lencolname = f"{PREFIX}Len{huc12}"
+    elevcolname = f"ep3m{huc12}"
+    gordcolname = f"gord_{huc12}"
+    huc12df, snapdf = get_data(filename)
+    # These are upstream errors I should ignore
+    df = huc12df[huc12df[fpcol] != 0]
+    df = df[df.groupby(fpcol)[fpcol].transform("size") > 1]
+    # The slopes are to the neighbouring points of the untruncated flowpath
+    df = flowpath_slopes(df, fpcol, lencolname, elevcolname)
+    df["fpath"] = df[fpcol]
+    keep = []
+    for flowpath_num, fpdf in df.groupby(fpcol):
         try:
-            process_flowpath(cursor, huc12, db_fid, df, snappt)
+            snappt = snapdf[snapdf["grid_code"] == flowpath_num].iloc[0]
+            truncated_df = truncation_logic(
+                fpdf, snappt, lencolname, gordcolname, elevcolname
+            )
+            dx = truncated_df["dx"]
+            if dx.isna().any() or (dx == 0).any():
+                raise Exception("dx is zero or null")
         except Exception as exp:
             LOG.info(
                 "huc12: %s flowpath_num: %s hit exception", huc12, flowpath_num
             )
             LOG.exception(exp)
-            delete_flowpath(cursor, db_fid)
-            print(df)
-            print(df[[f"gord_{huc12}", f"fpLen{huc12}"]])
-            # sys.exit()
-    return huc12
+            continue
+        keep.extend(truncated_df.index)
+    kept = df.loc[keep]
+    points = pd.DataFrame(
+        {
+            "huc_12": huc12,
+            "fpath": kept["fpath"],
+            "segid": kept.groupby("fpath").cumcount(),
+            "elevation": kept[elevcolname] / 100.0,
+            "length": kept[lencolname] / 100.0,
+            "surgo": pd.to_numeric(kept["SOL_FY_2018"]).astype("Int64"),
+            "management": kept["management"],
+            "slope": kept["slope"],
+            "x": kept["geometry"].x,
+            "y": kept["geometry"].y,
+            "landuse": kept["landuse"],
+            "gridorder": kept[gordcolname].astype("Int64"),
+        }
+    )
+    flowpaths = make_flowpaths(huc12, points, kept)
+    points = points[points["fpath"].isin(flowpaths["fpath"])]
+    points["geom"] = point_geoms(points)
+    return huc12, flowpaths, points.drop(columns=["x", "y"])
 
 
 def main():
     """Our main function, the starting point for code execution"""
-    cursor = PGCONN.cursor()
+    loader = FlowpathLoader(PGCONN, SCENARIO)
     # track our work
     with open("myhucs.txt", "w") as fh:
         # Change the working directory to where we have data files
@@ -376,24 +258,19 @@ def main():
         # collect up the GeoJSONs in that directory
         fns = glob.glob("smpldef3m_*.json")
         fns.sort()
-        i = 0
 
-        for fn in fns:
-            # Save our work every 100 HUC12s,
-            # so to keep the database transaction
-            # at a reasonable size
-            if i > 0 and i % 100 == 0:
-                PGCONN.commit()
-                cursor = PGCONN.cursor()
-            df, snapdf = get_data(fn)
-            huc12 = process(cursor, fn, df, snapdf)
-            fh.write("%s\n" % (huc12,))
-            i += 1
-
-    # Commit the database changes
-    cursor.close()
-    PGCONN.commit()
-    LOG.info("Complete.")
+        with Pool() as pool:
+            for huc12, flowpaths, points in pool.imap(build_huc12, fns):
+                # Each HUC12 is its own transaction
+                loader.load(huc12, flowpaths, points)
+                fh.write("%s\n" % (huc12,))
+
+    loader.close()
+    LOG.info(
+        "Complete, loaded %s flowpaths with %s points",
+        loader.flowpaths,
+        loader.points,
+    )
 
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+../import/flowpath_loader.py
\ No newline at end of file
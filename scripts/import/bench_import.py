@@ -0,0 +1,93 @@
+"""Benchmarks of the flowpath to WEPP project file hot paths.
+
+    python -m pytest bench_import.py --benchmark-autosave
+
+Each benchmark is run at several data sizes and reports its throughput as
+``extra_info``, see `scripts/run_benchmarks.sh` for tracking these over time.
+The flowpath points come from `synthetic_flowpaths.py` in place of the
+database, and the .rot and .prj files are written below a temporary directory.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import flowpath2prj
+from flowpath2prj import do_flowpath, do_huc12
+from rate_report import report_rate
+from synthetic_flowpaths import make_flowpath_points
+
+HUC12 = "102400130105"
+
+
+class NullCursor:
+    """Stands in for the database cursor that flowpath edits are sent to."""
+
+    rowcount = 1
+
+    def execute(self, *args):
+        """Discard the statement."""
+
+
+def patch_outputs(monkeypatch, tmp_path, points):
+    """Write the .rot and .prj files below tmp_path."""
+    # The soil files are assumed to exist
+    soilfiles = frozenset(points["soilfile"])
+    monkeypatch.setattr(flowpath2prj, "get_soilfiles", lambda _: soilfiles)
+
+    monkeypatch.setattr(flowpath2prj, "ROT_DIR", str(tmp_path / "%s" / "rot"))
+    monkeypatch.setattr(flowpath2prj, "ROTATIONS", {})
+    write_prj = flowpath2prj.write_prj
+
+    def _write_prj(data):
+        """Write the .prj file below tmp_path."""
+        write_prj({**data, "prj_fn": str(tmp_path / "fp.prj")})
+
+    monkeypatch.setattr(flowpath2prj, "write_prj", _write_prj)
+
+
+@pytest.mark.parametrize("npoints", [10, 19, 100, 500])
+def test_do_flowpath(benchmark, tmp_path, monkeypatch, npoints):
+    """Building the project data of one flowpath."""
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    points = make_flowpath_points(npoints, np.random.default_rng(0))
+    monkeypatch.setattr(
+        flowpath2prj, "read_sql", lambda *args, **kwargs: points.copy()
+    )
+    patch_outputs(monkeypatch, tmp_path, points)
+    metadata = {
+        "fid": 1,
+        "huc_12": HUC12,
+        "fpath": 1,
+        "climate_file": "/i/0/cli/093x042/093.60x042.00.cli",
+    }
+    res = benchmark(do_flowpath, None, NullCursor(), 0, "IA_CENTRAL", metadata)
+    assert res is not None
+    report_rate(benchmark, npoints, "rows")
+
+
+@pytest.mark.parametrize("flowpaths", [10, 100])
+def test_do_huc12(benchmark, tmp_path, monkeypatch, flowpaths):
+    """Building and writing the project files of a HUC12's flowpaths."""
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    rng = np.random.default_rng(0)
+    points = pd.concat(
+        [
+            make_flowpath_points(int(n), rng).assign(fid=fid)
+            for fid, n in enumerate(rng.integers(10, 200, flowpaths), 1)
+        ],
+        ignore_index=True,
+    )
+    patch_outputs(monkeypatch, tmp_path, points)
+    meta = pd.DataFrame(
+        {
+            "lat": 42.0,
+            "fpath": np.arange(1, flowpaths + 1),
+            "fid": np.arange(1, flowpaths + 1),
+            "huc_12": HUC12,
+            "climate_file": "/i/0/cli/093x042/093.60x042.00.cli",
+        }
+    ).set_index("fid", drop=False)
+    res = benchmark(do_huc12, (0, meta, points, False))
+    assert res[4] + len(res[1]) == flowpaths
+    report_rate(benchmark, flowpaths, "flowpaths")
@@ -29,25 +29,71 @@ Here's a listing of project landuse codes used
   q - Orchards
   v - Vegetables
 
+The scenario's flowpath points are streamed from the database by one query,
+each HUC12 is then built and written by a process pool while the main process
+makes the flowpath deletes and rewrites.
 
+    python flowpath2prj.py <scenario> [slpsol]
+
+With ``slpsol``, the .slp and .sol files are also written, see
+`slpsol_writer.py`.  This is EXPERIMENTAL, the standard workflow remains to
+have prj2wepp generate these.
 """
 import sys
 import os
 import datetime
-from functools import partial
+import hashlib
+from functools import lru_cache, partial
+from io import StringIO
+from itertools import islice
 from math import atan2, degrees, pi
+from multiprocessing import Pool
 
+import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from pandas.io.sql import read_sql
 from pyiem.util import get_dbconn, logger
 from pyiem.dep import load_scenarios
+from slpsol_writer import write_slp, write_sol
 
 LOG = logger()
 MISSED_SOILS = {}
 MAX_SLOPE_RATIO = 0.9
 MIN_SLOPE = 0.003
+# Rows fetched per round trip of the streamed points query
+CHUNKSIZE = 200000
+# HUC12s handed to the process pool at once, bounding the memory used
+BATCHSIZE = 200
+POINTS_SELECT = """
+    f.segid, f.elevation, f.length, f.surgo, f.slope, f.management,
+    'DEP_'||f.surgo||'.SOL' as soilfile, f.landuse,
+    ST_x(f.geom) as xx, ST_y(f.geom) as yy, f.fbndid, f.genlu, f.gridorder,
+    round(ST_X(ST_Transform(f.geom,4326))::numeric,2) as x,
+    round(ST_Y(ST_Transform(f.geom,4326))::numeric,2) as y
+"""
+REWRITE_COLUMNS = [
+    "flowpath",
+    "segid",
+    "elevation",
+    "length",
+    "surgo",
+    "slope",
+    "geom",
+    "scenario",
+    "gridorder",
+    "landuse",
+    "management",
+    "fbndid",
+    "genlu",
+]
 
 SURGO2FILE = {}
+# The shared rotation files, below a directory per cropping zone
+ROT_DIR = "/i/%s/rot"
+# (scenario, zone, landuse, management) to the rotation file written by this
+# process
+ROTATIONS = {}
 
 # Note that the default used below is
 INITIAL_COND_DEFAULT = "IniCropDef.Default"
@@ -106,6 +152,16 @@ def load_surgo2file(cursor):
         SURGO2FILE[row[0]] = row[1]
 
 
+@lru_cache(maxsize=None)
+def read_block(blockfn):
+    """Return the block file template, None if it does not exist."""
+    if not os.path.isfile(blockfn):
+        # LOG.debug("Missing %s", blockfn)
+        return None
+    with open(blockfn, "r", encoding="utf8") as fh:
+        return fh.read()
+
+
 def read_file(scenario, zone, prevcode, code, cfactor, year):
     """Read a block file and do replacements
 
@@ -120,12 +176,9 @@ def read_file(scenario, zone, prevcode, code, cfactor, year):
     Returns:
       str with the raw data used for the .rot file
     """
-    blockfn = f"blocks/{code}{cfactor}.txt"
-    if not os.path.isfile(blockfn):
-        # LOG.debug("Missing %s", blockfn)
+    data = read_block(f"blocks/{code}{cfactor}.txt")
+    if data is None:
         return ""
-    with open(blockfn, "r", encoding="utf8") as fh:
-        data = fh.read()
     # Special consideration for planting alfalfa
     if code == "P" and prevcode != "P":
         # Best we can do now is plant it on Apr 15, sigh
@@ -190,7 +243,9 @@ def do_rotation(scenario, zone, rotfn, landuse, management):
             landuse[i - 1], landuse[i], int(management[i]), i + 1
         )
 
-    with open(rotfn, "w", encoding="utf8") as fh:
+    # Written aside and renamed, as other processes may use the same file
+    tmpfn = f"{rotfn}.{os.getpid()}.tmp"
+    with open(tmpfn, "w", encoding="utf8") as fh:
         fh.write(
             f"""#
 # WEPP rotation saved on: {datetime.datetime.now()}
@@ -225,27 +280,35 @@ Operations {{
 }}
 """
         )
+    os.replace(tmpfn, rotfn)
     return True
 
 
-def rotation_magic(scenario, zone, seqnum, row, metadata):
+def rotation_magic(scenario, zone, landuse, management):
     """Rotation Magic happens here.
 
     Generates the needed prj2wepp rotation file and then returns the name of
-    that file.
+    that file.  The file is shared by every flowpath with this rotation and
+    is written once per process.
 
     Args:
       scenario (int): The DEP scenario we are on.
       zone (str): the cropping zone we are in.
-      seqnum (int): the sequential number of this .rot file we generate
-      row (dict): the database info for this row.
+      landuse (str): the landuse rotation string.
+      management (str): the management rotation string.
     """
-    rotfn = (
-        f"/i/{scenario}/rot/{metadata['huc_12'][:8]}/{metadata['huc_12'][8:]}"
-        f"/{metadata['huc_12']}_{metadata['fpath']}_{seqnum}.rot"
-    )
+    key = (scenario, zone, landuse, management)
+    rotfn = ROTATIONS.get(key)
+    if rotfn is not None:
+        return rotfn
+    name = f"{landuse}-{management}"
+    shard = hashlib.sha1(name.encode("utf8")).hexdigest()[:2]
+    rotdir = f"{ROT_DIR % (scenario,)}/{zone}/{shard}"
+    os.makedirs(rotdir, exist_ok=True)
+    rotfn = f"{rotdir}/{name}.rot"
     # Oh my cats, we are about to create the .rot file here
-    do_rotation(scenario, zone, rotfn, row["landuse"], row["management"])
+    do_rotation(scenario, zone, rotfn, landuse, management)
+    ROTATIONS[key] = rotfn
     return rotfn
 
 
@@ -273,7 +336,7 @@ def simplify(df):
     df.iat[0, df.columns.get_loc("useme")] = True
     df.iat[-1, df.columns.get_loc("useme")] = True
     # Take the top 18 values by slope
-    df.at[df.sort_values("slope", ascending=False).index[:18], "useme"] = True
+    df.loc[df.sort_values("slope", ascending=False).index[:18], "useme"] = True
     df = df[df["useme"]].copy()
     # We need to recompute slope values to keep elevation values correct,
     # the value is ahead down the hill
@@ -286,15 +349,9 @@ def simplify(df):
     return df
 
 
-def compute_slope(cursor, fid):
-    """Compute the simple slope for the fid"""
-    cursor.execute(
-        "SELECT max(elevation), min(elevation), max(length) "
-        "from flowpath_points where flowpath = %s and length < 9999",
-        (fid,),
-    )
-    row2 = cursor.fetchone()
-    return (row2[0] - row2[1]) / row2[2]
+def compute_slope(df):
+    """Compute the simple slope of the flowpath's points"""
+    return (df["elevation"].max() - df["elevation"].min()) / df["length"].max()
 
 
 def delete_flowpath(cursor, fid):
@@ -305,25 +362,46 @@ def delete_flowpath(cursor, fid):
         print(f"Whoa, delete_flowpath failed for {fid}")
 
 
+@lru_cache(maxsize=None)
+def get_soilfiles(scenario):
+    """Return the set of soil files available to this scenario."""
+    soildir = f"/i/{scenario}/sol_input"
+    if not os.path.isdir(soildir):
+        return frozenset()
+    return frozenset(os.listdir(soildir))
+
+
 def filter_soils_slopes(df, scenario):
     """Remove things we can't deal with"""
-    df["useme"] = False
     if df["slope"].min() < 0:
         return None
-    for idx, row in df.iterrows():
-        if row["soilfile"] == "DEP_9999.SOL":
-            continue
-        if not os.path.isfile(f"/i/{scenario}/sol_input/{row['soilfile']}"):
-            if row["soilfile"] not in MISSED_SOILS:
-                LOG.info("Missing soilfile: %s", row["soilfile"])
-                MISSED_SOILS[row["soilfile"]] = 0
-            MISSED_SOILS[row["soilfile"]] += 1
-            continue
-        if row["slope"] < MIN_SLOPE:
-            df.at[idx, "slope"] = MIN_SLOPE
-        df.at[idx, "useme"] = True
+    known = df["soilfile"].isin(get_soilfiles(scenario))
+    missing = df.loc[~known & (df["soilfile"] != "DEP_9999.SOL"), "soilfile"]
+    for soilfile, count in missing.value_counts(sort=False).items():
+        if soilfile not in MISSED_SOILS:
+            LOG.info("Missing soilfile: %s", soilfile)
+            MISSED_SOILS[soilfile] = 0
+        MISSED_SOILS[soilfile] += int(count)
+    df = df[known & (df["soilfile"] != "DEP_9999.SOL")].copy()
+    df["slope"] = df["slope"].clip(lower=MIN_SLOPE)
+    return df
+
 
-    return df[df["useme"]].copy()
+def segment_ends(df, columns):
+    """Return the positions that end each run of equal values.
+
+    A change of value at a point ends the run of the points above it and the
+    last point ends the final run.
+    """
+    changed = np.zeros(max(len(df.index) - 1, 0), dtype=bool)
+    for column in columns:
+        values = df[column].to_numpy()
+        changed |= values[1:] != values[:-1]
+    ends = np.flatnonzero(changed) + 1
+    last = len(df.index) - 1
+    if ends.size == 0 or ends[-1] != last:
+        ends = np.append(ends, last)
+    return ends
 
 
 def rewrite_flowpath(cursor, scenario, flowpath_id, df):
@@ -356,24 +434,22 @@ def rewrite_flowpath(cursor, scenario, flowpath_id, df):
         )
 
 
-def do_flowpath(pgconn, cursor, scenario, zone, metadata):
-    """Process a given flowpathid"""
-    # slope = compute_slope(fid)
-    # I need bad soilfiles so that the length can be computed
-    df = read_sql(
-        """
-        SELECT segid, elevation, length, f.surgo,
-        slope, management, 'DEP_'||surgo||'.SOL' as soilfile, landuse,
-        ST_x(geom) as xx, ST_y(geom) as yy, fbndid, genlu, gridorder,
-        round(ST_X(ST_Transform(geom,4326))::numeric,2) as x,
-        round(ST_Y(ST_Transform(geom,4326))::numeric,2) as y from
-        flowpath_points f
-        WHERE flowpath = %s and length < 9999
-        ORDER by segid ASC
-    """,
-        pgconn,
-        params=(metadata["fid"],),
-    )
+def build_flowpath(df, scenario, zone, metadata):
+    """Build the project data of a flowpath from its points.
+
+    Nothing is done to the database here, the caller is told what to edit.
+
+    Args:
+      df (pd.DataFrame): the flowpath points, ordered by segid.
+      scenario (int): The DEP scenario
+      zone (str): The DEP cropping zone
+      metadata (dict): the flowpaths row with huc_12, fpath and climate_file.
+
+    Returns:
+      (dict or None, str or None, pd.DataFrame): the data for `write_prj`,
+      the database edit of the flowpath (``delete``, ``rewrite`` or None)
+      and the points kept.
+    """
     origsize = len(df.index)
     df = filter_soils_slopes(df, scenario)
     if df is None or len(df.index) < 2:
@@ -382,17 +458,14 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
             metadata["huc_12"],
             metadata["fpath"],
         )
-        delete_flowpath(cursor, metadata["fid"])
-        return None
+        return None, "delete", df
     if len(df.index) > 19:
         df = simplify(df)
     # If the size changed, we need to rewrite this flowpath to database
-    if origsize != len(df.index):
-        rewrite_flowpath(cursor, scenario, metadata["fid"], df)
+    edit = "rewrite" if origsize != len(df.index) else None
 
     maxslope = df["slope"].max()
     if maxslope > MAX_SLOPE_RATIO:
-        s = compute_slope(cursor, metadata["fid"])
         LOG.info(
             "Error max-slope>%s %s[%3i] max:%4.1f len:%5.1f bulk:%5.1f",
             MAX_SLOPE_RATIO,
@@ -400,10 +473,9 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
             metadata["fpath"],
             maxslope,
             df.iloc[-1]["length"],
-            s,
+            compute_slope(df),
         )
-        delete_flowpath(cursor, metadata["fid"])
-        return None
+        return None, "delete", df
 
     res = {}
     res["clifile"] = metadata["climate_file"]
@@ -424,8 +496,10 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
     res["length"] = df.iloc[-1]["length"]
     res["slope_points"] = len(df.index)
 
-    # Iterate over the rows and figure out the slopes and distance fracs
+    # The slopes and distance fracs
     slpdata = ""
+    xs = df["length"].to_numpy()
+    slopes = df["slope"].to_numpy()
     if df.iloc[0]["length"] != 0:
         LOG.info(
             "WARNING: HUC12:%s FPATH:%s had missing soil at top of slope",
@@ -434,25 +508,32 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
         )
         slpdata = " 0.000,0.00001"
         res["slope_points"] = len(df.index) + 1
+        xs = np.append(0, xs)
+        slopes = np.append(0.00001, slopes)
+    # NEED lots of precision to get grid rectifying right
+    # see dailyerosion/dep#79
+    slpdata += "".join(
+        f" {frac},{slope:5f}"
+        for frac, slope in zip(
+            (df["length"] / res["length"]).tolist(), df["slope"].tolist()
+        )
+    )
 
-    soil = df.iloc[0]["surgo"]
-    soilstart = 0
-    soils = []
-    soillengths = []
-
-    for idx, row in df.iterrows():
-        if soil != row["surgo"] or idx == df.index[-1]:
-            soils.append(soil)
-            soillengths.append(row["length"] - soilstart)
-            soil = row["surgo"]
-            soilstart = row["length"]
-        # NEED lots of precision to get grid rectifying right
-        # see dailyerosion/dep#79
-        slpdata += f" {row['length'] / res['length']},{row['slope']:5f}"
+    lengths = df["length"].to_numpy()
+    ends = segment_ends(df, ["surgo"])
+    soils = df["surgo"].to_numpy()[ends - 1]
+    soillengths = lengths[ends] - np.append(0, lengths[ends[:-1]])
 
     res["soilbreaks"] = len(soillengths) - 1
     res["soils"] = ""
     res["slpdata"] = slpdata
+    # The profile [m] and where each soil and rotation ends down the slope
+    # [m], for writing the .slp and .sol files directly
+    res["profile"] = (xs, slopes)
+    res["soil_runs"] = [
+        (x, f"/i/{scenario}/sol_input/DEP_{s}.SOL")
+        for x, s in zip(lengths[ends].tolist(), soils.tolist())
+    ]
 
     for d, s in zip(soillengths, soils):
         res[
@@ -462,28 +543,16 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
         File = "/i/{scenario}/sol_input/DEP_{s}.SOL"
     }}\n"""
 
-    prev_landuse = df.iloc[0]["landuse"]
-    manstart = 0
-    prev_man = df.iloc[0]["management"]
-    mans = []
-    manlengths = []
-
-    # Figure out our landuse situation
-    for idx, row in df.iterrows():
-        if (
-            prev_landuse == row["landuse"]
-            and prev_man == row["management"]
-            and idx != df.index[-1]
-        ):
-            continue
-        # Management has changed, write out the old row
-        mans.append(
-            rotation_magic(scenario, zone, len(mans), df.loc[idx], metadata)
+    # Figure out our landuse situation, the rotation comes from the point
+    # ending each run
+    ends = segment_ends(df, ["landuse", "management"])
+    mans = [
+        rotation_magic(scenario, zone, landuse, management)
+        for landuse, management in zip(
+            df["landuse"].to_numpy()[ends], df["management"].to_numpy()[ends]
         )
-        manlengths.append(row["length"] - manstart)
-        prev_landuse = row["landuse"]
-        prev_man = row["management"]
-        manstart = row["length"]
+    ]
+    manlengths = lengths[ends] - np.append(0, lengths[ends[:-1]])
 
     if not mans:
         LOG.info(
@@ -491,8 +560,9 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
             metadata["huc_12"],
             metadata["fpath"],
         )
-        return None
+        return None, edit, df
     res["manbreaks"] = len(manlengths) - 1
+    res["man_runs"] = list(zip(lengths[ends].tolist(), mans))
     res["managements"] = ""
 
     for d, s in zip(manlengths, mans):
@@ -503,6 +573,26 @@ def do_flowpath(pgconn, cursor, scenario, zone, metadata):
         File = "{s}"
     }}\n"""
 
+    return res, edit, df
+
+
+def do_flowpath(pgconn, cursor, scenario, zone, metadata):
+    """Process a given flowpathid"""
+    # I need bad soilfiles so that the length can be computed
+    df = read_sql(
+        f"""
+        SELECT {POINTS_SELECT} from flowpath_points f
+        WHERE flowpath = %s and length < 9999
+        ORDER by segid ASC
+    """,
+        pgconn,
+        params=(metadata["fid"],),
+    )
+    res, edit, df = build_flowpath(df, scenario, zone, metadata)
+    if edit == "delete":
+        delete_flowpath(cursor, metadata["fid"])
+    elif edit == "rewrite":
+        rewrite_flowpath(cursor, scenario, metadata["fid"], df)
     return res
 
 
@@ -567,9 +657,142 @@ def get_flowpath_scenario(scenario):
     return int(sdf.at[scenario, "flowpath_scenario"])
 
 
+def get_zone(lat):
+    """Return the cropping zone for this latitude."""
+    if lat >= 42.5:
+        return "IA_NORTH"
+    if lat >= 41.5:
+        return "IA_CENTRAL"
+    if lat >= 40.5:
+        return "IA_SOUTH"
+    return "KS_NORTH"
+
+
+def read_scenario_points(pgconn, flowpath_scenario, chunksize=CHUNKSIZE):
+    """Yield the points of each HUC12 from one streamed query.
+
+    Args:
+      pgconn (psycopg2.connection): database connection, used for this alone.
+      flowpath_scenario (int): the scenario the flowpaths belong to.
+      chunksize (int): rows fetched per round trip.
+
+    Yields:
+      (str, pd.DataFrame): HUC12 and its points, ordered by fid and segid.
+    """
+    # A named cursor is server side, so the rows are streamed
+    cursor = pgconn.cursor("flowpath_points_stream")
+    cursor.itersize = chunksize
+    cursor.execute(
+        f"""
+        SELECT p.huc_12, f.flowpath as fid, {POINTS_SELECT}
+        from flowpath_points f JOIN flowpaths p on (f.flowpath = p.fid)
+        WHERE p.scenario = %s and p.fpath != 0 and f.length < 9999
+        ORDER by p.huc_12 ASC, f.flowpath ASC, f.segid ASC
+    """,
+        (flowpath_scenario,),
+    )
+    pending = None
+    while True:
+        rows = cursor.fetchmany(chunksize)
+        if not rows:
+            break
+        chunk = pd.DataFrame.from_records(
+            rows,
+            columns=[desc[0] for desc in cursor.description],
+            coerce_float=True,
+        )
+        if pending is not None:
+            chunk = pd.concat([pending, chunk], ignore_index=True)
+        # The last HUC12 may continue into the next chunk
+        last = chunk["huc_12"].iat[-1]
+        done = chunk["huc_12"] != last
+        for huc12, df in chunk[done].groupby("huc_12", sort=False):
+            yield huc12, df.reset_index(drop=True)
+        pending = chunk[~done]
+    if pending is not None:
+        yield pending["huc_12"].iat[0], pending.reset_index(drop=True)
+    cursor.close()
+
+
+def do_huc12(args):
+    """Build and write the project files of a HUC12's flowpaths.
+
+    Returns:
+      (str, list, list, dict, int): the HUC12, the fids to delete, the
+      (fid, points) to rewrite, the missed soils and the prj files written.
+    """
+    scenario, meta, points, slpsol = args
+    MISSED_SOILS.clear()
+    deletes = []
+    rewrites = []
+    written = 0
+    groups = {} if points is None else dict(list(points.groupby("fid")))
+    for fid, metadata in meta.iterrows():
+        if fid not in groups:
+            # Nothing left to compute a length with
+            deletes.append(fid)
+            continue
+        res, edit, df = build_flowpath(
+            groups[fid], scenario, get_zone(metadata["lat"]), metadata
+        )
+        if edit == "delete":
+            deletes.append(fid)
+        elif edit == "rewrite":
+            rewrites.append((fid, df))
+        if res is not None:
+            write_prj(res)
+            if slpsol:
+                write_slp(res)
+                write_sol(res)
+            written += 1
+    return (
+        meta["huc_12"].iat[0],
+        deletes,
+        rewrites,
+        dict(MISSED_SOILS),
+        written,
+    )
+
+
+def apply_edits(cursor, scenario, deletes, rewrites):
+    """Delete and rewrite flowpaths with set-based SQL and COPY."""
+    deletes = [int(fid) for fid in deletes]
+    fids = deletes + [int(fid) for fid, _ in rewrites]
+    if not fids:
+        return
+    cursor.execute(
+        "DELETE from flowpath_points where flowpath = ANY(%s)", (fids,)
+    )
+    if deletes:
+        cursor.execute("DELETE from flowpaths where fid = ANY(%s)", (deletes,))
+        if cursor.rowcount != len(deletes):
+            print(f"Whoa, delete_flowpath failed for some of {deletes}")
+    if not rewrites:
+        return
+    df = pd.concat(
+        [df.assign(flowpath=int(fid)) for fid, df in rewrites],
+        ignore_index=True,
+    )
+    df["geom"] = [
+        f"SRID=5070;POINT({xx} {yy})"
+        for xx, yy in zip(df["xx"].tolist(), df["yy"].tolist())
+    ]
+    df["scenario"] = scenario
+    buffer = StringIO()
+    df[REWRITE_COLUMNS].to_csv(
+        buffer, sep="\t", index=False, header=False, na_rep="\\N"
+    )
+    buffer.seek(0)
+    cursor.copy_from(buffer, "flowpath_points", columns=REWRITE_COLUMNS)
+
+
 def main(argv):
     """Go main go"""
     scenario = int(argv[1])
+    slpsol = argv[2:] == ["slpsol"]
+    if slpsol:
+        LOG.warning("Writing the .slp and .sol files is EXPERIMENTAL")
+    flowpath_scenario = get_flowpath_scenario(scenario)
     pgconn = get_dbconn("idep")
     cursor = pgconn.cursor()
     load_surgo2file(cursor)
@@ -578,32 +801,121 @@ def main(argv):
         "climate_file from flowpaths WHERE scenario = %s and fpath != 0 "
         "ORDER by huc_12 ASC",
         pgconn,
-        params=(get_flowpath_scenario(scenario),),
-    )
+        params=(flowpath_scenario,),
+    ).set_index("fid", drop=False)
     if os.path.isfile("myhucs.txt"):
         myhucs = []
         with open("myhucs.txt", encoding="utf8") as fh:
             myhucs = fh.read().split("\n")
         LOG.info("Only running for HUC_12s in myhucs.txt")
         df = df[df["huc_12"].isin(myhucs)]
-    progress = tqdm(df.iterrows(), total=len(df.index))
-    for _idx, row in progress:
-        progress.set_description(f"{row['huc_12']} {row['fpath']:04.0f}")
-        zone = "KS_NORTH"
-        if row["lat"] >= 42.5:
-            zone = "IA_NORTH"
-        elif row["lat"] >= 41.5:
-            zone = "IA_CENTRAL"
-        elif row["lat"] >= 40.5:
-            zone = "IA_SOUTH"
-        data = do_flowpath(pgconn, cursor, scenario, zone, row)
-        if data is not None:
-            write_prj(data)
+    hucmeta = dict(list(df.groupby("huc_12")))
+
+    def _jobs():
+        """Pair up the streamed points with their flowpaths."""
+        seen = set()
+        for huc12, points in read_scenario_points(
+            get_dbconn("idep"), flowpath_scenario
+        ):
+            if huc12 in hucmeta:
+                seen.add(huc12)
+                yield scenario, hucmeta[huc12], points, slpsol
+        for huc12, meta in hucmeta.items():
+            if huc12 not in seen:
+                yield scenario, meta, None, slpsol
+
+    jobs = _jobs()
+    written = 0
+    progress = tqdm(total=len(hucmeta))
+    with Pool() as pool:
+        # Batches keep the streamed points from piling up in the pool's queue
+        while True:
+            batch = list(islice(jobs, BATCHSIZE))
+            if not batch:
+                break
+            for res in pool.imap_unordered(do_huc12, batch):
+                huc12, deletes, rewrites, missed, count = res
+                progress.set_description(huc12)
+                progress.update(1)
+                apply_edits(cursor, scenario, deletes, rewrites)
+                for soilfile, misses in missed.items():
+                    MISSED_SOILS[soilfile] = (
+                        MISSED_SOILS.get(soilfile, 0) + misses
+                    )
+                written += count
+    progress.close()
     cursor.close()
     pgconn.commit()
+    LOG.info("Wrote %s prj files for %s HUC12s", written, len(hucmeta))
     for fn, sn in MISSED_SOILS.items():
-        print(f"{sn:6s} {fn}")
+        print(f"{sn:6d} {fn}")
 
 
 if __name__ == "__main__":
     main(sys.argv)
+
+
+def test_segment_ends():
+    """Test the runs of soils and managements down a flowpath."""
+    df = pd.DataFrame({"surgo": [1, 1, 2, 2, 3], "man": ["a"] * 5})
+    assert segment_ends(df, ["surgo"]).tolist() == [2, 4]
+    assert segment_ends(df, ["man"]).tolist() == [4]
+    assert segment_ends(df, ["surgo", "man"]).tolist() == [2, 4]
+    df = pd.DataFrame({"surgo": [1, 1, 2, 2, 2], "man": ["a"] * 5})
+    assert segment_ends(df, ["surgo"]).tolist() == [2, 4]
+
+
+def test_read_scenario_points():
+    """Test that the streamed chunks are split at HUC12 boundaries."""
+
+    class _Cursor:
+        """Serve the rows in chunks like a named cursor."""
+
+        description = [("huc_12",), ("fid",), ("segid",)]
+        itersize = None
+
+        def __init__(self):
+            self.rows = [("a", 1, 1), ("a", 1, 2), ("b", 2, 1)]
+            self.rows += [("b", 3, i) for i in range(1, 5)] + [("c", 4, 1)]
+
+        def execute(self, *args):
+            """Nothing to do."""
+
+        def fetchmany(self, size):
+            """Return the next rows."""
+            res, self.rows = self.rows[:size], self.rows[size:]
+            return res
+
+        def close(self):
+            """Nothing to do."""
+
+    class _Conn:
+        """Stands in for the database connection."""
+
+        def cursor(self, _name):
+            """Return the cursor."""
+            return _Cursor()
+
+    res = list(read_scenario_points(_Conn(), 0, chunksize=2))
+    assert [huc12 for huc12, _ in res] == ["a", "b", "c"]
+    assert res[1][1]["segid"].tolist() == [1, 1, 2, 3, 4]
+
+
+def test_rotation_magic(tmp_path, monkeypatch):
+    """Test that a rotation is written once and shared."""
+    monkeypatch.chdir(os.path.dirname(os.path.abspath(__file__)))
+    monkeypatch.setattr("flowpath2prj.ROT_DIR", str(tmp_path / "%s" / "rot"))
+    monkeypatch.setattr("flowpath2prj.ROTATIONS", {})
+    args = ("CBCBCBCBCBCBCBCB", "1111222233334444")
+    rotfn = rotation_magic(0, "IA_NORTH", *args)
+    os.unlink(rotfn)
+    assert rotation_magic(0, "IA_NORTH", *args) == rotfn
+    assert not os.path.isfile(rotfn)
+    rotfn2 = rotation_magic(0, "IA_SOUTH", *args)
+    assert rotfn2 != rotfn
+    with open(rotfn2, encoding="utf8") as fh:
+        data = fh.read()
+    assert "CropDef.Cor_0965" in data
+    assert not [
+        fn for fn in os.listdir(os.path.dirname(rotfn2)) if "tmp" in fn
+    ]
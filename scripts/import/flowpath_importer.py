@@ -11,12 +11,18 @@ to.
 import glob
 import os
 import sys
+from multiprocessing import Pool
 
 from tqdm import tqdm
-from shapely.geometry import LineString
 import geopandas as gpd
 import pandas as pd
 from pyiem.util import get_dbconn, logger
+from flowpath_loader import (
+    FlowpathLoader,
+    flowpath_slopes,
+    make_flowpaths,
+    point_geoms,
+)
 
 LOG = logger()
 print(" * BE CAREFUL!  The GeoJSON files may not be 5070, but 26915")
@@ -28,31 +34,6 @@ TRUNC_GRIDORDER_AT = 4
 GENLU_CODES = {}
 
 
-def get_flowpath(cursor, scenario, huc12, fpath):
-    """Get or create a database flowpath identifier
-
-    Args:
-      cursor (psycopg2.cursor): database cursor
-      huc12 (str): HUC12 identifier
-      fpath (int): the flowpath id value for this HUC12
-
-    Returns:
-      int the value of this huc12 flowpath
-    """
-    cursor.execute(
-        "SELECT fid from flowpaths where huc_12 = %s and fpath = %s "
-        "and scenario = %s",
-        (huc12, fpath, scenario),
-    )
-    if cursor.rowcount == 0:
-        cursor.execute(
-            "INSERT into flowpaths(huc_12, fpath, scenario) "
-            "values (%s, %s, %s) RETURNING fid",
-            (huc12, fpath, scenario),
-        )
-    return cursor.fetchone()[0]
-
-
 def get_data(filename):
     """Converts a GeoJSON file into a pandas dataframe
 
@@ -75,20 +56,6 @@ def get_data(filename):
     return df
 
 
-def delete_previous(cursor, scenario, huc12):
-    """This file is the authority, so we cull previous content."""
-    cursor.execute(
-        "DELETE from flowpath_points p USING flowpaths f WHERE "
-        "p.scenario = %s and p.flowpath = f.fid and f.huc_12 = %s "
-        "and f.scenario = %s",
-        (scenario, huc12, scenario),
-    )
-    cursor.execute(
-        "DELETE from flowpaths WHERE scenario = %s and huc_12 = %s",
-        (scenario, huc12),
-    )
-
-
 def load_genlu_codes(cursor):
     """Populate dict."""
     cursor.execute("SELECT id, label from general_landuse")
@@ -111,135 +78,66 @@ def get_genlu_code(cursor, label):
     return GENLU_CODES[label]
 
 
-def process_flowpath(cursor, scenario, huc12, db_fid, df):
-    """Do one flowpath please."""
-    lencolname = f"{PREFIX}Len{huc12}"
-    elevcolname = f"ep3m{huc12}"
-    gordcolname = f"gord_{huc12}"
-    # Sort along the length column, which orders the points from top
-    # to bottom
-    df = df.sort_values(lencolname, ascending=True)
-    # Remove any previous data for this flowpath
-    cursor.execute(
-        "DELETE from flowpath_points WHERE flowpath = %s", (db_fid,)
-    )
-    points = []
-    sz = len(df.index)
-    maxslope = 0
-    elev_change = 0
-    x_change = 0
-    for segid, (_, row) in enumerate(df.iterrows()):
-        if (segid + 1) == sz:  # Last row!
-            # This effectively repeats the slope of the previous point
-            row2 = df.iloc[segid - 1]
-        else:
-            row2 = df.iloc[segid + 1]
-            if pd.isna(row2[lencolname]):
-                print("Null fpLen")
-                print(row2)
-                sys.exit()
-        dy = abs(row[elevcolname] - row2[elevcolname])
-        elev_change += dy
-        dx = abs(row2[lencolname] - row[lencolname])
-        if dx == 0:
-            raise Exception(f"dx is zero at segid: {segid} {row} {row2}")
-        x_change += dx
-        gridorder = row[gordcolname]
-        if gridorder > TRUNC_GRIDORDER_AT or pd.isnull(gridorder):
-            continue
-        slope = dy / dx
-
-        if slope > maxslope:
-            maxslope = slope
-        args = (
-            db_fid,
-            segid,
-            row[elevcolname] / 100.0,
-            row[lencolname] / 100.0,
-            row["SOL_FY_2020"],
-            row["management"],
-            slope,
-            row["geometry"].x,
-            row["geometry"].y,
-            row["landuse"],
-            scenario,
-            gridorder,
-            get_genlu_code(cursor, row["GenLU"]),
-            row["FBndID"].split("_")[1],
-        )
-        cursor.execute(
-            "INSERT into flowpath_points(flowpath, segid, elevation, length, "
-            "surgo, management, slope, geom, landuse, scenario, gridorder, "
-            "genlu, fbndid) "
-            "values(%s, %s, %s, %s, %s, %s, %s, 'SRID=5070;POINT(%s %s)', "
-            "%s, %s, %s, %s, %s)",
-            args,
-        )
-
-        points.append((row["geometry"].x, row["geometry"].y))
-
-    # Line string must have at least 2 points
-    if len(points) > 1:
-        ls = LineString(points)
-        assert ls.is_valid
-        if x_change == 0:
-            print("x_change equals 0, abort")
-            print(df)
-            sys.exit()
-        cursor.execute(
-            "UPDATE flowpaths SET geom = %s, "
-            "max_slope = %s, bulk_slope = %s WHERE fid = %s",
-            (f"SRID=5070;{ls.wkt}", maxslope, elev_change / x_change, db_fid),
-        )
-    else:
-        # Cull our work above if this flowpath is too short
-        delete_flowpath(cursor, db_fid)
-
-
-def delete_flowpath(cursor, fid):
-    """Delete the flowpath."""
-    cursor.execute("DELETE from flowpath_points where flowpath = %s", (fid,))
-    cursor.execute("DELETE from flowpaths where fid = %s", (fid,))
+def get_huc12(huc12df):
+    """Hack compute the huc12 by finding the fp field name"""
+    for col in huc12df.columns:
+        if col.startswith(PREFIX):
+            return col[len(PREFIX) :]
+    raise Exception(f"Could not find huc12 from {huc12df.columns}")
 
 
-def process(cursor, scenario, huc12df):
-    """Processing of a HUC12's data into the database
+def build_huc12(filename):
+    """Build the flowpaths and points tables of a HUC12's GeoJSON.
 
     Args:
-      cursor (psycopg2.cursor): database cursor
-        scenario (int): the scenario to process
-      huc12df (pd.DataFrame): the dataframe containing the data
+      filename (str): The geojson filename to process
 
     Returns:
-      None
+      (str, pd.DataFrame, pd.DataFrame): the HUC12, its flowpaths and its
+      points, which have the GenLU label in place of the genlu code.
     """
-    # Hack compute the huc12 by finding the fp field name
-    huc12 = None
-    for col in huc12df.columns:
-        if col.startswith(PREFIX):
-            huc12 = col[len(PREFIX) :]
-            break
-    if huc12 is None:
-        raise Exception(f"Could not find huc12 from {huc12df.columns}")
-
-    delete_previous(cursor, scenario, huc12)
-    # the inbound dataframe has lots of data, one row per flowpath point
-    # We group the dataframe by the column which uses a PREFIX and the huc8
-    for flowpath_num, df in huc12df.groupby(f"{PREFIX}{huc12}"):
-        # These are upstream errors I should ignore
-        if flowpath_num == 0 or len(df.index) < 2:
-            continue
-        # Get or create the flowpathid from the database
-        db_fid = get_flowpath(cursor, scenario, huc12, flowpath_num)
-        try:
-            process_flowpath(cursor, scenario, huc12, db_fid, df)
-        except Exception as exp:
-            LOG.info("flowpath_num: %s hit exception", flowpath_num)
-            LOG.exception(exp)
-            delete_flowpath(cursor, db_fid)
-            # print(df)
-            # sys.exit()
-    return huc12
+    huc12df = get_data(filename)
+    huc12 = get_huc12(huc12df)
+    fpcol = f"{PREFIX}{huc12}"
+    lencolname = f"{PREFIX}Len{huc12}"
+    elevcolname = f"ep3m{huc12}"
+    gordcolname = f"gord_{huc12}"
+    # These are upstream errors I should ignore
+    df = huc12df[huc12df[fpcol] != 0]
+    df = df[df.groupby(fpcol)[fpcol].transform("size") > 1]
+    # Sort along the length column, which orders the points from top
+    # to bottom
+    df = df.sort_values([fpcol, lencolname], kind="stable")
+    df = flowpath_slopes(df, fpcol, lencolname, elevcolname)
+    df["fpath"] = df[fpcol]
+    bad = df.loc[df["dx"].isna() | (df["dx"] == 0), "fpath"].unique()
+    for fpath in bad:
+        LOG.info("%s flowpath %s has a zero or null dx, culling", huc12, fpath)
+    df = df[~df["fpath"].isin(bad)]
+    gridorder = df[gordcolname]
+    kept = df[gridorder.notna() & (gridorder <= TRUNC_GRIDORDER_AT)]
+    points = pd.DataFrame(
+        {
+            "huc_12": huc12,
+            "fpath": kept["fpath"],
+            "segid": kept["segid"],
+            "elevation": kept[elevcolname] / 100.0,
+            "length": kept[lencolname] / 100.0,
+            "surgo": pd.to_numeric(kept["SOL_FY_2020"]).astype("Int64"),
+            "management": kept["management"],
+            "slope": kept["slope"],
+            "x": kept["geometry"].x,
+            "y": kept["geometry"].y,
+            "landuse": kept["landuse"],
+            "gridorder": kept[gordcolname].astype(int),
+            "GenLU": kept["GenLU"],
+            "fbndid": kept["FBndID"].str.split("_").str[1],
+        }
+    )
+    flowpaths = make_flowpaths(huc12, points, df)
+    points = points[points["fpath"].isin(flowpaths["fpath"])]
+    points["geom"] = point_geoms(points)
+    return huc12, flowpaths, points.drop(columns=["x", "y"])
 
 
 def main(argv):
@@ -248,32 +146,63 @@ def main(argv):
     cursor = pgconn.cursor()
     load_genlu_codes(cursor)
     scenario = int(argv[1])
+    loader = FlowpathLoader(pgconn, scenario)
+    datadir = os.path.join("..", "..", "data", argv[2])
+    # collect up the GeoJSONs in that directory
+    fns = glob.glob(f"{datadir}/smpl3m_*.json")
+    fns.sort()
     # track our work
-    with open("myhucs.txt", "w", encoding="utf8") as fh:
-        datadir = os.path.join("..", "..", "data", argv[2])
-        # collect up the GeoJSONs in that directory
-        fns = glob.glob(f"{datadir}/smpl3m_*.json")
-        fns.sort()
-        i = 0
-
-        progress = tqdm(fns)
-        for fn in progress:
-            progress.set_description(os.path.basename(fn))
-            # Save our work every 100 HUC12s,
-            # so to keep the database transaction
-            # at a reasonable size
-            if i > 0 and i % 100 == 0:
-                pgconn.commit()
-                cursor = pgconn.cursor()
-            df = get_data(fn)
-            huc12 = process(cursor, scenario, df)
+    with open("myhucs.txt", "w", encoding="utf8") as fh, Pool() as pool:
+        progress = tqdm(pool.imap(build_huc12, fns), total=len(fns))
+        for huc12, flowpaths, points in progress:
+            progress.set_description(huc12)
+            labels = points.pop("GenLU")
+            codes = {
+                label: get_genlu_code(cursor, label)
+                for label in labels.unique()
+            }
+            points["genlu"] = labels.map(codes)
+            # Each HUC12 is its own transaction
+            loader.load(huc12, flowpaths, points)
             fh.write(f"{huc12}\n")
-            i += 1
 
-    # Commit the database changes
+    loader.close()
     cursor.close()
     pgconn.commit()
+    LOG.info(
+        "Loaded %s flowpaths with %s points", loader.flowpaths, loader.points
+    )
 
 
 if __name__ == "__main__":
     main(sys.argv)
+
+
+def test_build_huc12(tmp_path):
+    """Test the flowpaths and points of a small HUC12."""
+    huc12 = "102400130105"
+    df = gpd.GeoDataFrame(
+        {
+            f"fp{huc12}": [1, 1, 1, 2, 2, 3, 3],
+            f"fpLen{huc12}": [200, 0, 100.0, 0, 0, 0, 100],
+            f"ep3m{huc12}": [980, 1000, 990, 100, 90, 100, 90.0],
+            f"gord_{huc12}": [5, 1, 1, 1, 1, 1, 5],
+            "CropRotatn_CY_2020": ["CB"] * 7,
+            "Management_CY_2020": ["12"] * 7,
+            "SOL_FY_2020": [400123] * 7,
+            "GenLU": ["Cropland"] * 7,
+            "FBndID": [f"{huc12}_1"] * 7,
+        },
+        geometry=gpd.points_from_xy(range(7), range(7)),
+        crs="EPSG:5070",
+    )
+    fn = str(tmp_path / "smpl3m_test.json")
+    df.to_file(fn, driver="GeoJSON")
+    res, flowpaths, points = build_huc12(fn)
+    assert res == huc12
+    # flowpath 2 has a zero dx and flowpath 3 one point below gridorder 5
+    assert flowpaths["fpath"].tolist() == [1]
+    assert points["segid"].tolist() == [0, 1]
+    assert points["fbndid"].tolist() == ["1", "1"]
+    assert flowpaths["geom"].iat[0] == "SRID=5070;LINESTRING (1 1, 2 2)"
+    assert flowpaths["bulk_slope"].iat[0] == 0.1
@@ -0,0 +1,208 @@
+"""Bulk load of the flowpaths of a HUC12 into the database.
+
+The flowpath_importer.py scripts build each HUC12's flowpaths and points
+tables in memory, which are then COPYed into temporary staging tables and
+swapped for the HUC12's previous flowpaths with set-based SQL, one
+transaction per HUC12.
+
+This module is shared with scripts/gridorder2 by a symlink.
+"""
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+import shapely
+
+FLOWPATH_COLUMNS = ["huc_12", "fpath", "geom", "max_slope", "bulk_slope"]
+POINT_COLUMNS = [
+    "segid",
+    "elevation",
+    "length",
+    "surgo",
+    "management",
+    "slope",
+    "geom",
+    "landuse",
+    "gridorder",
+    "genlu",
+    "fbndid",
+]
+
+
+def flowpath_slopes(df, fpcol, lencol, elevcol):
+    """Add the segid, dx, dy and slope of each point of the flowpaths.
+
+    The points are ordered by flowpath and then down the flowpath.  The slope
+    is to the next point down, the last point repeats the slope to the point
+    above it.
+    """
+    grp = df.groupby(fpcol, sort=False)
+    last = (grp.cumcount(ascending=False) == 0).to_numpy()
+    len2 = np.where(last, grp[lencol].shift(1), grp[lencol].shift(-1))
+    elev2 = np.where(last, grp[elevcol].shift(1), grp[elevcol].shift(-1))
+    df = df.assign(
+        segid=grp.cumcount(),
+        dy=np.abs(df[elevcol].to_numpy() - elev2),
+        dx=np.abs(len2 - df[lencol].to_numpy()),
+    )
+    df["slope"] = df["dy"] / df["dx"]
+    return df
+
+
+def make_flowpaths(huc12, points, changes):
+    """Return the flowpaths table for these points.
+
+    Args:
+      huc12 (str): the HUC12.
+      points (pd.DataFrame): the points kept, with fpath, x, y and slope.
+      changes (pd.DataFrame): the points the bulk slope is computed over,
+        with fpath, dy and dx.
+
+    Returns:
+      pd.DataFrame of the flowpaths with at least two points and a valid
+      linestring.
+    """
+    counts = points.groupby("fpath", sort=False).size()
+    points = points[points["fpath"].isin(counts[counts > 1].index)]
+    if points.empty:
+        return pd.DataFrame(columns=FLOWPATH_COLUMNS)
+    codes, fpaths = pd.factorize(points["fpath"])
+    lines = shapely.linestrings(points[["x", "y"]].to_numpy(), indices=codes)
+    totals = changes.groupby("fpath")[["dy", "dx"]].sum()
+    valid = shapely.is_valid(lines)
+    fpaths = fpaths[valid]
+    lines = lines[valid]
+    points = points[points["fpath"].isin(fpaths)]
+    res = pd.DataFrame(
+        {
+            "huc_12": huc12,
+            "fpath": fpaths,
+            "geom": [
+                f"SRID=5070;{wkt}"
+                for wkt in shapely.to_wkt(lines, rounding_precision=-1)
+            ],
+            "max_slope": np.maximum(
+                points.groupby("fpath", sort=False)["slope"].max(), 0
+            ).to_numpy(),
+        }
+    )
+    totals = totals.reindex(res["fpath"])
+    res["bulk_slope"] = (totals["dy"] / totals["dx"]).to_numpy()
+    return res
+
+
+def point_geoms(points):
+    """Return the EWKT of the points."""
+    return [
+        f"SRID=5070;POINT({x} {y})"
+        for x, y in zip(points["x"].tolist(), points["y"].tolist())
+    ]
+
+
+def _copy(cursor, df, table):
+    """COPY the DataFrame into the table."""
+    buffer = StringIO()
+    df.to_csv(buffer, sep="\t", index=False, header=False, na_rep="\\N")
+    buffer.seek(0)
+    cursor.copy_from(buffer, table, columns=list(df.columns))
+
+
+class FlowpathLoader:
+    """Replace the flowpaths of a HUC12 through staging tables."""
+
+    def __init__(self, pgconn, scenario):
+        """Setup the staging tables."""
+        self.pgconn = pgconn
+        self.scenario = scenario
+        self.cursor = pgconn.cursor()
+        self.cursor.execute(
+            "CREATE TEMP TABLE flowpaths_stage ON COMMIT DELETE ROWS AS "
+            f"SELECT {','.join(FLOWPATH_COLUMNS)} from flowpaths WITH NO DATA"
+        )
+        self.cursor.execute(
+            "CREATE TEMP TABLE flowpath_points_stage ON COMMIT DELETE ROWS AS "
+            "SELECT f.huc_12, f.fpath, "
+            f"{','.join('p.' + col for col in POINT_COLUMNS)} "
+            "from flowpath_points p, flowpaths f WITH NO DATA"
+        )
+        self.pgconn.commit()
+        self.flowpaths = 0
+        self.points = 0
+
+    def load(self, huc12, flowpaths, points):
+        """Replace the HUC12's flowpaths and points, in one transaction.
+
+        Args:
+          huc12 (str): the HUC12.
+          flowpaths (pd.DataFrame): the FLOWPATH_COLUMNS of each flowpath.
+          points (pd.DataFrame): huc_12, fpath and any of POINT_COLUMNS.
+        """
+        _copy(self.cursor, flowpaths[FLOWPATH_COLUMNS], "flowpaths_stage")
+        _copy(self.cursor, points, "flowpath_points_stage")
+        # This file is the authority, so we cull previous content.
+        self.cursor.execute(
+            "DELETE from flowpath_points p USING flowpaths f WHERE "
+            "p.scenario = %s and p.flowpath = f.fid and f.huc_12 = %s "
+            "and f.scenario = %s",
+            (self.scenario, huc12, self.scenario),
+        )
+        self.cursor.execute(
+            "DELETE from flowpaths WHERE scenario = %s and huc_12 = %s",
+            (self.scenario, huc12),
+        )
+        cols = ",".join(FLOWPATH_COLUMNS)
+        self.cursor.execute(
+            f"INSERT into flowpaths({cols}, scenario) "
+            f"SELECT {cols}, %s from flowpaths_stage",
+            (self.scenario,),
+        )
+        self.flowpaths += self.cursor.rowcount
+        cols = [col for col in POINT_COLUMNS if col in points.columns]
+        self.cursor.execute(
+            "INSERT into flowpath_points(flowpath, scenario, "
+            f"{','.join(cols)}) SELECT f.fid, %s, "
+            f"{','.join('s.' + col for col in cols)} "
+            "from flowpath_points_stage s JOIN flowpaths f on "
+            "(f.huc_12 = s.huc_12 and f.fpath = s.fpath and f.scenario = %s)",
+            (self.scenario, self.scenario),
+        )
+        self.points += self.cursor.rowcount
+        self.pgconn.commit()
+
+    def close(self):
+        """Close the cursor."""
+        self.cursor.close()
+
+
+def test_flowpath_slopes():
+    """Test the slopes along two flowpaths."""
+    df = pd.DataFrame(
+        {
+            "fp": [1, 1, 1, 2, 2],
+            "len": [0, 100, 300, 0, 50.0],
+            "elev": [1000, 990, 970, 500, 495.0],
+        }
+    )
+    df = flowpath_slopes(df, "fp", "len", "elev")
+    assert df["segid"].tolist() == [0, 1, 2, 0, 1]
+    np.testing.assert_allclose(df["slope"], [0.1, 0.1, 0.1, 0.1, 0.1])
+    np.testing.assert_allclose(df["dx"], [100, 200, 200, 50, 50])
+
+
+def test_make_flowpaths():
+    """Test that flowpaths of one point are dropped."""
+    points = pd.DataFrame(
+        {
+            "fpath": [1, 1, 2],
+            "x": [0, 1.5, 3.0],
+            "y": [0, 1, 2.0],
+            "slope": [0.1, 0.3, 0.2],
+            "dy": [1, 3, 2.0],
+            "dx": [10, 10, 10.0],
+        }
+    )
+    df = make_flowpaths("102400130105", points, points)
+    assert df["fpath"].tolist() == [1]
+    assert df["geom"].iat[0] == "SRID=5070;LINESTRING (0 0, 1.5 1)"
+    assert df["max_slope"].iat[0] == 0.3
+    assert df["bulk_slope"].iat[0] == 0.2
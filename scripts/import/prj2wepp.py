@@ -1,85 +1,228 @@
-""" Generate WEPP project files, which we then hand off to prj2wepp for run"""
-import subprocess
-import os
-import sys
+"""Generate the WEPP man, slp and sol files from our prj files with prj2wepp.
+
+prj2wepp is run from within its install dir, so that the local userdb is
+used, and writes its test.* outputs there.  So each worker of the process
+pool runs within its own copy of the install dir, made below the scenario's
+directory so that the outputs are moved into place with a rename.
+
+    python prj2wepp.py <scenario> [man]
+
+With ``man``, only the .man files are kept, to go with the .slp and .sol
+files written by `slpsol_writer.py`.  This is EXPERIMENTAL until that writer
+has been validated against prj2wepp on sample HUC12s, and any flowpath whose
+.man has a different number of OFEs than its .slp is refused, with its .man
+file removed.
+"""
 import glob
+import os
 import shutil
+import subprocess
+import sys
+import tempfile
+from multiprocessing import Pool
 
 from tqdm import tqdm
+from pyiem.dep import read_slp
 from pyiem.util import logger
 
 LOG = logger()
 PROJDIR = "/opt/dep/prj2wepp"
-EXE = f"{PROJDIR}/prj2wepp"
-WEPP = f"{PROJDIR}/wepp"
+# Seconds to allow one prj2wepp run
+TIMEOUT = 120
+# The outputs kept
+SUFFIXES = ["man", "slp", "sol"]
+# The sandbox of this worker process
+SANDBOX = None
+
+
+def get_output_fn(prjfn, suffix):
+    """Return the filename of the prj2wepp output for this prj file."""
+    basedir, _prj, huc8, huc4, pfile = prjfn.rsplit("/", 4)
+    return f"{basedir}/{suffix}/{huc8}/{huc4}/{pfile[:-4]}.{suffix}"
+
+
+def find_prjs(scenario, myhucs):
+    """Return the prj files to process, limited to myhucs if provided."""
+    res = []
+    for prjfn in sorted(glob.glob(f"/i/{scenario}/prj/*/*/*.prj")):
+        huc12 = os.path.basename(prjfn).split("_")[0]
+        if myhucs and huc12 not in myhucs:
+            continue
+        res.append(prjfn)
+    return res
+
+
+def init_sandbox(tmpdir):
+    """Copy the prj2wepp install dir for this worker process."""
+    global SANDBOX  # pylint: disable=global-statement
+    SANDBOX = os.path.join(tmpdir, str(os.getpid()))
+    shutil.copytree(
+        PROJDIR,
+        SANDBOX,
+        symlinks=True,
+        ignore=shutil.ignore_patterns("test.*"),
+    )
+
+
+def run_prj2wepp(sandbox, prjfn, suffixes=SUFFIXES, outdir=None):
+    """Run prj2wepp for the prj file and move its outputs into place.
+
+    Args:
+      sandbox (str): the copy of the prj2wepp install dir to run within.
+      prjfn (str): the prj file.
+      suffixes (list): the outputs to keep.
+      outdir (str): move the outputs here, in place of the scenario's dirs.
+
+    Returns:
+      str error message or None if successful.
+    """
+    cmd = [f"{sandbox}/prj2wepp", prjfn, "test", f"{sandbox}/wepp", "no"]
+    try:
+        try:
+            proc = subprocess.run(
+                cmd,
+                cwd=sandbox,
+                stderr=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                timeout=TIMEOUT,
+                check=False,
+            )
+        except subprocess.TimeoutExpired:
+            return f"timed out after {TIMEOUT}s"
+        if not os.path.isfile(f"{sandbox}/test.man"):
+            return (
+                f"no output, exit {proc.returncode}\n"
+                f"{proc.stderr.decode('ascii', 'ignore')}\n"
+                f"{proc.stdout.decode('ascii', 'ignore')}"
+            )
+        # This generates .cli, .man, .run, .slp, .sol
+        # We need the .man , .slp , .sol from this process
+        for suffix in suffixes:
+            if outdir is None:
+                outfn = get_output_fn(prjfn, suffix)
+            else:
+                outfn = f"{outdir}/{os.path.basename(prjfn)[:-4]}.{suffix}"
+            shutil.move(f"{sandbox}/test.{suffix}", outfn)
+    except OSError as exp:
+        return str(exp)
+    finally:
+        for suffix in ["cli", "man", "run", "slp", "sol"]:
+            if os.path.isfile(f"{sandbox}/test.{suffix}"):
+                os.unlink(f"{sandbox}/test.{suffix}")
+    return None
+
+
+def read_man_ofes(manfn):
+    """Return the number of OFEs of a management file, see `read_man`."""
+    with open(manfn, encoding="ascii") as fh:
+        lines = [line[: line.find("#")].strip() for line in fh]
+    return int(lines[6])
+
+
+def check_ofes(prjfn):
+    """Return an error if the .man and .slp disagree on the number of OFEs.
+
+    The .man file is removed in that case, so that WEPP is not run with it.
+    """
+    manfn = get_output_fn(prjfn, "man")
+    try:
+        manofes = read_man_ofes(manfn)
+        slpofes = len(read_slp(get_output_fn(prjfn, "slp")))
+    except (OSError, IndexError, ValueError) as exp:
+        manofes, slpofes = None, str(exp)
+    if manofes == slpofes:
+        return None
+    if os.path.isfile(manfn):
+        os.unlink(manfn)
+    return f".man has {manofes} OFEs, .slp {slpofes}"
+
+
+def do_prj(args):
+    """Pool worker for one prj file."""
+    prjfn, suffixes = args
+    error = run_prj2wepp(SANDBOX, prjfn, suffixes)
+    if error is None and "slp" not in suffixes:
+        error = check_ofes(prjfn)
+    return prjfn, error
 
 
 def main(argv):
     """Go Main Go."""
     scenario = int(argv[1])
-    basedir = f"/i/{scenario}/prj"
+    # The .slp and .sol files may come from `flowpath2prj.py <s> slpsol`
+    suffixes = ["man"] if argv[2:] == ["man"] else SUFFIXES
+    if suffixes == ["man"]:
+        LOG.warning("Only keeping the .man files is EXPERIMENTAL")
     myhucs = []
     if os.path.isfile("myhucs.txt"):
         with open("myhucs.txt", encoding="utf8") as fh:
             myhucs = fh.read().split("\n")
         LOG.info("using HUC12s found in myhucs.txt...")
-    os.chdir(basedir)
-    huc8s = glob.glob("*")
+    prjfns = find_prjs(scenario, myhucs)
     errors = 0
-    for huc8 in tqdm(huc8s):
-        os.chdir(huc8)
-        for huc4 in glob.glob("*"):
-            huc12 = f"{huc8}{huc4}"
-            if myhucs and huc12 not in myhucs:
+    with tempfile.TemporaryDirectory(
+        prefix="prj2wepp", dir=f"/i/{scenario}"
+    ) as tmpdir, Pool(initializer=init_sandbox, initargs=(tmpdir,)) as pool:
+        for prjfn, error in tqdm(
+            pool.imap_unordered(
+                do_prj, [(prjfn, suffixes) for prjfn in prjfns], 100
+            ),
+            total=len(prjfns),
+        ):
+            if error is None:
                 continue
-            os.chdir(huc4)
-            for pfile in glob.glob("*.prj"):
-                # Run prj2wepp in its install dir so that the local userdb
-                # is used
-                os.chdir(PROJDIR)
-                fullfn = f"/i/{scenario}/prj/{huc8}/{huc4}/{pfile}"
-                cmd = f"{EXE} {fullfn} test {WEPP} no"
-                proc = subprocess.Popen(
-                    cmd,
-                    shell=True,
-                    stderr=subprocess.PIPE,
-                    stdout=subprocess.PIPE,
-                )
-                # Need to block the above
-                stdout = proc.stdout.read()
-                if not os.path.isfile("test.man"):
-                    LOG.info(
-                        "---> ERROR generating output for %s\n%s\n%s\n%s",
-                        huc12,
-                        cmd,
-                        proc.stderr.read(),
-                        stdout,
-                    )
-                    errors += 1
-                    if errors > 10:
-                        LOG.info("Aborting due to errors...")
-                        sys.exit()
-                    os.chdir(os.path.join(basedir, huc8, huc4))
-                    continue
-                # This generates .cli, .man, .run, .slp, .sol
-                # We need the .man , .slp , .sol from this process
-                for suffix in ["man", "slp", "sol"]:
-                    shutil.copyfile(
-                        f"test.{suffix}",
-                        (
-                            f"/i/{scenario}/{suffix}/{huc8}/{huc4}/"
-                            f"{pfile[:-4]}.{suffix}"
-                        ),
-                    )
-
-                for suffix in ["cli", "man", "run", "slp", "sol"]:
-                    if os.path.isfile(f"test.{suffix}"):
-                        os.unlink(f"test.{suffix}")
-                os.chdir(os.path.join(basedir, huc8, huc4))
-            os.chdir("..")
-        os.chdir("..")
+            LOG.info("---> ERROR generating output for %s\n%s", prjfn, error)
+            errors += 1
+    LOG.info("Processed %s prj files, %s errors", len(prjfns), errors)
 
 
 if __name__ == "__main__":
     # Go Main Go
     main(sys.argv)
+
+
+def test_run_prj2wepp(tmp_path):
+    """Test that the outputs are moved into place and errors returned."""
+    sandbox = tmp_path / "sandbox"
+    sandbox.mkdir()
+    exe = sandbox / "prj2wepp"
+    exe.write_text(
+        "#!/bin/sh\n"
+        'grep -q fail "$1" && printf "bad\\377" >&2 && exit 1\n'
+        "for s in cli man run slp sol; do echo $s > test.$s; done\n"
+    )
+    exe.chmod(0o755)
+    for suffix in ["prj", "man", "slp", "sol"]:
+        (tmp_path / "0" / suffix / "10240013" / "0105").mkdir(parents=True)
+    prjfn = str(tmp_path / "0/prj/10240013/0105/102400130105_1.prj")
+    with open(prjfn, "w", encoding="utf8") as fh:
+        fh.write("ok")
+    assert run_prj2wepp(str(sandbox), prjfn) is None
+    assert os.path.isfile(get_output_fn(prjfn, "slp"))
+    assert not glob.glob(f"{sandbox}/test.*")
+    with open(prjfn, "w", encoding="utf8") as fh:
+        fh.write("fail")
+    assert run_prj2wepp(str(sandbox), prjfn).startswith(
+        "no output, exit 1\nbad\n"
+    )
+
+
+def test_check_ofes(tmp_path):
+    """Test that a .man with a different number of OFEs is refused."""
+    for suffix in ["prj", "man", "slp"]:
+        (tmp_path / suffix / "10240013" / "0105").mkdir(parents=True)
+    prjfn = f"{tmp_path}/prj/10240013/0105/102400130105_1.prj"
+    with open(get_output_fn(prjfn, "slp"), "w", encoding="ascii") as fh:
+        fh.write(
+            "97.3\n#\n#\n#\n#\n2\n180.0 1.0\n"
+            "2 10.0\n0.0, 0.1 1.0, 0.1\n2 10.0\n0.0, 0.1 1.0, 0.1\n"
+        )
+    manfn = get_output_fn(prjfn, "man")
+    man = "98.4\n#\n#\n#\n#\n\n{} # number of OFE's\n"
+    with open(manfn, "w", encoding="ascii") as fh:
+        fh.write(man.format(2))
+    assert check_ofes(prjfn) is None
+    with open(manfn, "w", encoding="ascii") as fh:
+        fh.write(man.format(1))
+    assert check_ofes(prjfn) == ".man has 1 OFEs, .slp 2"
+    assert not os.path.isfile(manfn)
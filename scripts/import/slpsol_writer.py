@@ -0,0 +1,258 @@
+"""Write the WEPP slope (.slp) and soil (.sol) files without prj2wepp.
+
+The project data built by `flowpath2prj.build_flowpath` has the slope
+profile and where each soil and rotation ends down the hillslope.  An OFE
+starts at every change of either, gets the profile points within it, with
+the slope interpolated at its ends, and the soil of its map unit from the
+single OFE sol_input files.
+
+    python flowpath2prj.py <scenario> slpsol
+
+writes these alongside the .prj files, prj2wepp is then only needed for the
+.man files.  To validate them against what prj2wepp generates from the same
+.prj files:
+
+    python slpsol_writer.py <scenario> <huc12> [<huc12> ...]
+
+This is EXPERIMENTAL and not part of the import workflow (see README.md)
+until that validation has been done on sample HUC12s.  In particular, the
+OFE splits are assumed to be those of prj2wepp, as are the profile width of
+1.0 and the restricting layer line of each OFE of the .sol file.
+`prj2wepp.py <scenario> man` refuses any flowpath whose .man and .slp differ
+in their number of OFEs.
+"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from functools import lru_cache
+
+import numpy as np
+from pyiem.dep import read_slp
+from pyiem.util import logger
+from prj2wepp import PROJDIR, get_output_fn, run_prj2wepp
+
+LOG = logger()
+SLP_VERSION = "97.3"
+# Tolerances when comparing with the prj2wepp files, [m] and [-]
+XTOL = 0.01
+SLOPETOL = 1e-4
+
+
+def get_ofes(res):
+    """Return the OFEs down the hillslope.
+
+    Returns:
+      list of (start [m], end [m], soil file, rotation file)
+    """
+    soil_x = np.array([x for x, _ in res["soil_runs"]])
+    man_x = np.array([x for x, _ in res["man_runs"]])
+    ends = np.union1d(soil_x, man_x)
+    starts = np.append(0, ends[:-1])
+    soilidx = np.searchsorted(soil_x, ends)
+    manidx = np.searchsorted(man_x, ends)
+    return [
+        (start, end, res["soil_runs"][i][1], res["man_runs"][j][1])
+        for start, end, i, j in zip(starts, ends, soilidx, manidx)
+    ]
+
+
+def ofe_profile(xs, slopes, start, end):
+    """Return the (fraction of the OFE length, slope) of the OFE's points."""
+    inside = (xs > start) & (xs < end)
+    x = np.concatenate([[start], xs[inside], [end]])
+    return (x - start) / (end - start), np.interp(x, xs, slopes)
+
+
+def write_slp(res):
+    """Write the multiple OFE .slp file for the project data."""
+    xs, slopes = res["profile"]
+    ofes = get_ofes(res)
+    lines = [
+        SLP_VERSION,
+        "#",
+        "# Written by scripts/import/slpsol_writer.py",
+        "#",
+        "#",
+        f"{len(ofes)}",
+        f"{res['aspect']:.4f} 1.0",
+    ]
+    for start, end, _soilfn, _rotfn in ofes:
+        fracs, ofe_slopes = ofe_profile(xs, slopes, start, end)
+        lines.append(f"{len(fracs)} {end - start:.4f}")
+        # NEED lots of precision to get grid rectifying right
+        # see dailyerosion/dep#79
+        lines.append(
+            " ".join(
+                f"{frac}, {slope:5f}"
+                for frac, slope in zip(fracs.tolist(), ofe_slopes.tolist())
+            )
+        )
+    with open(
+        get_output_fn(res["prj_fn"], "slp"), "w", encoding="ascii"
+    ) as fh:
+        fh.write("\n".join(lines) + "\n")
+
+
+@lru_cache(maxsize=None)
+def read_soil(fn):
+    """Read a WEPP soil file.
+
+    Returns:
+      (list, str, list): the lines up to the OFE count, the ksflag and the
+      lines following, which are the OFE(s).
+    """
+    with open(fn, encoding="ascii") as fh:
+        lines = fh.read().rstrip().splitlines()
+    # The OFE count and ksflag follow the version, comments and any text
+    for i, line in enumerate(lines[1:], 1):
+        tokens = line.split()
+        if line.startswith("#") or len(tokens) != 2:
+            continue
+        if tokens[0].isdigit() and tokens[1].isdigit():
+            return lines[:i], tokens[1], lines[i + 1 :]
+    raise ValueError(f"{fn} has no OFE count line")
+
+
+def write_sol(res):
+    """Write the multiple OFE .sol file for the project data."""
+    ofes = get_ofes(res)
+    header, ksflag, _ = read_soil(ofes[0][2])
+    lines = header + [f"{len(ofes)} {ksflag}"]
+    for _start, _end, soilfn, _rotfn in ofes:
+        lines.extend(read_soil(soilfn)[2])
+    with open(
+        get_output_fn(res["prj_fn"], "sol"), "w", encoding="ascii"
+    ) as fh:
+        fh.write("\n".join(lines) + "\n")
+
+
+def compare_slp(fn, reffn):
+    """Return the differences of the .slp file from the reference."""
+    slp = read_slp(fn)
+    ref = read_slp(reffn)
+    if len(slp) != len(ref):
+        return [f"{len(slp)} OFEs vs {len(ref)}"]
+    res = []
+    for i, (ofe, refofe) in enumerate(zip(slp, ref)):
+        # Compare the slope along the reference's points
+        slopes = np.interp(refofe["x"], ofe["x"], ofe["slopes"])
+        if abs(ofe["x"][-1] - refofe["x"][-1]) > XTOL:
+            res.append(f"OFE {i + 1} ends at {ofe['x'][-1]:.3f}m")
+        elif np.abs(slopes - refofe["slopes"]).max() > SLOPETOL:
+            res.append(f"OFE {i + 1} slopes differ")
+    return res
+
+
+def _values(lines):
+    """Return the tokens of the lines, numbers as floats."""
+    res = []
+    for token in " ".join(lines).split():
+        try:
+            res.append(float(token))
+        except ValueError:
+            res.append(token.strip("'\""))
+    return res
+
+
+def compare_sol(fn, reffn):
+    """Return the differences of the .sol file from the reference."""
+    _, _, lines = read_soil.__wrapped__(fn)
+    _, _, reflines = read_soil.__wrapped__(reffn)
+    values = _values(lines)
+    refvalues = _values(reflines)
+    if len(values) != len(refvalues):
+        return [f"{len(values)} values vs {len(refvalues)}"]
+    return [
+        f"value {i} is {value} vs {ref}"
+        for i, (value, ref) in enumerate(zip(values, refvalues))
+        if value != ref
+        and not (
+            isinstance(value, float)
+            and isinstance(ref, float)
+            and np.isclose(value, ref, rtol=1e-4)
+        )
+    ]
+
+
+def main(argv):
+    """Go Main Go."""
+    scenario = int(argv[1])
+    checked = 0
+    failed = 0
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sandbox = f"{tmpdir}/sandbox"
+        shutil.copytree(PROJDIR, sandbox, symlinks=True)
+        for huc12 in argv[2:]:
+            prjfns = glob.glob(
+                f"/i/{scenario}/prj/{huc12[:8]}/{huc12[8:]}/*.prj"
+            )
+            for prjfn in sorted(prjfns):
+                name = os.path.basename(prjfn)[:-4]
+                error = run_prj2wepp(sandbox, prjfn, outdir=tmpdir)
+                if error is not None:
+                    LOG.info("prj2wepp failed for %s\n%s", prjfn, error)
+                    continue
+                checked += 1
+                diffs = []
+                for suffix, func in [
+                    ("slp", compare_slp),
+                    ("sol", compare_sol),
+                ]:
+                    diffs.extend(
+                        f"{suffix}: {diff}"
+                        for diff in func(
+                            get_output_fn(prjfn, suffix),
+                            f"{tmpdir}/{name}.{suffix}",
+                        )
+                    )
+                if diffs:
+                    failed += 1
+                    LOG.info("%s differs\n%s", name, "\n".join(diffs))
+    LOG.info("%s of %s flowpaths differ from prj2wepp", failed, checked)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
+
+
+def test_write_slp_sol(tmp_path):
+    """Test the OFEs of a flowpath with two soils and two rotations."""
+    soilfns = []
+    for name in ["A", "B"]:
+        soilfns.append(str(tmp_path / f"{name}.SOL"))
+        with open(soilfns[-1], "w", encoding="ascii") as fh:
+            fh.write(
+                "2006.2\n#\n# a soil\n#\nAny comments:\n1 1\n"
+                f"'{name}' 'L' 1 0.23 0.75 4508587.0 0.0063 3.5 31.0\n"
+                "\t200\t44.2\t19.5\t3.25\t19.9\t0.0\n1 10000.0 1.2\n"
+            )
+    for suffix in ["prj", "slp", "sol"]:
+        (tmp_path / suffix / "10240013" / "0105").mkdir(parents=True)
+    res = {
+        "prj_fn": f"{tmp_path}/prj/10240013/0105/102400130105_1.prj",
+        "aspect": 180.0,
+        "profile": (np.array([0, 10, 20, 40.0]), np.array([0.1, 0.2, 0, 0])),
+        "soil_runs": [(15.0, soilfns[0]), (40.0, soilfns[1])],
+        "man_runs": [(20.0, "r1.rot"), (40.0, "r2.rot")],
+    }
+    assert [ofe[:2] for ofe in get_ofes(res)] == [(0, 15), (15, 20), (20, 40)]
+    write_slp(res)
+    slp = read_slp(get_output_fn(res["prj_fn"], "slp"))
+    assert len(slp) == 3
+    np.testing.assert_allclose(slp[0]["x"], [0, 10, 15])
+    np.testing.assert_allclose(slp[0]["slopes"], [0.1, 0.2, 0.1])
+    np.testing.assert_allclose(slp[2]["x"], [20, 40])
+    write_sol(res)
+    header, ksflag, lines = read_soil.__wrapped__(
+        get_output_fn(res["prj_fn"], "sol")
+    )
+    assert header[-1] == "Any comments:"
+    assert ksflag == "1"
+    assert [line.split()[0] for line in lines[::3]] == ["'A'", "'B'", "'B'"]
+    solfn = get_output_fn(res["prj_fn"], "sol")
+    assert not compare_sol(solfn, solfn)
+    assert compare_sol(solfn, soilfns[0]) == ["54 values vs 18"]
+    slpfn = get_output_fn(res["prj_fn"], "slp")
+    assert not compare_slp(slpfn, slpfn)
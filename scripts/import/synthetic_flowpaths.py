@@ -0,0 +1,66 @@
+"""Synthetic flowpath point tables for the benchmarks, see `bench_import.py`.
+
+The tables have the columns that `flowpath2prj.do_flowpath` selects from the
+``flowpath_points`` table, drawn from a seeded random state.
+"""
+import numpy as np
+import pandas as pd
+
+# Crop codes that have scripts/import/blocks files
+LANDUSE_CODES = "BCGPRW"
+
+
+def make_rotation(rng):
+    """Return a (landuse, management) pair of 16 year rotation strings."""
+    landuse = "".join(rng.choice(list(LANDUSE_CODES), 16))
+    management = "".join(str(x) for x in rng.integers(1, 7, 16))
+    return landuse, management
+
+
+def make_flowpath_points(npoints, rng, fields=3, soils=4):
+    """Return the points of a flowpath running down a hillslope.
+
+    Args:
+      npoints (int): number of points, starting at the top of the slope.
+      rng (np.random.Generator): the random state.
+      fields (int): number of fields, each with its own rotation.
+      soils (int): number of soil map units along the flowpath.
+    """
+    dx = rng.uniform(1, 5, npoints)
+    dx[0] = 0
+    length = np.cumsum(dx)
+    slope = rng.uniform(0.005, 0.12, npoints)
+    elevation = 300.0 - np.cumsum(dx * slope)
+    fieldidx = np.sort(rng.integers(0, fields, npoints))
+    rotations = [make_rotation(rng) for _ in range(fields)]
+    surgo = np.sort(rng.integers(0, soils, npoints)) + 400000
+    xx = 400000 + length * 0.7
+    yy = 2100000 - length * 0.7
+    return pd.DataFrame(
+        {
+            "segid": np.arange(1, npoints + 1),
+            "elevation": elevation,
+            "length": length,
+            "surgo": surgo,
+            "slope": slope,
+            "management": [rotations[i][1] for i in fieldidx],
+            "soilfile": [f"DEP_{s}.SOL" for s in surgo],
+            "landuse": [rotations[i][0] for i in fieldidx],
+            "xx": xx,
+            "yy": yy,
+            "fbndid": fieldidx + 1,
+            "genlu": 1,
+            "gridorder": 1,
+            "x": np.round(-93.6 + length * 1e-5, 2),
+            "y": np.round(42.0 - length * 1e-5, 2),
+        }
+    )
+
+
+def test_make_flowpath_points():
+    """Test that the flowpath runs downhill."""
+    df = make_flowpath_points(25, np.random.default_rng(0))
+    assert len(df.index) == 25
+    assert df["length"].iloc[0] == 0
+    assert (df["elevation"].diff().iloc[1:] < 0).all()
+    assert df["landuse"].str.len().eq(16).all()
@@ -0,0 +1,21 @@
+# Run the benchmark suite, saving the results for tracking over time
+#
+#   sh run_benchmarks.sh [compare]
+#
+# With `compare`, any benchmark with a mean that is more than 20% slower than
+# the last saved run fails, so run this prior to deploying to production.
+STORAGE=${DEP_BENCHMARKS:-/mnt/idep2/data/benchmarks}
+OPTS="--benchmark-autosave --benchmark-columns=min,mean,stddev,rounds"
+if [ "$1" = "compare" ]
+ then
+	OPTS="$OPTS --benchmark-compare --benchmark-compare-fail=mean:20%"
+fi
+STATUS=0
+
+cd $(dirname $0)
+for DIR in cligen RT import
+do
+	(cd $DIR && python -m pytest bench_*.py $OPTS \
+		--benchmark-storage=file://$STORAGE/$DIR) || STATUS=1
+done
+exit $STATUS